@@ -0,0 +1 @@
+"""benchmarks module: repeatable performance tests over synthetic data"""
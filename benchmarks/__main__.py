@@ -0,0 +1,52 @@
+"""
+Run the benchmark suite:
+
+    python -m benchmarks --tickets 10000 --users 2000 --output results.json
+    python -m benchmarks --only users. email. --repeat 10
+"""
+
+import logging
+import argparse
+
+from benchmarks.runner import Runner, DEFAULT_REPEAT
+from benchmarks.suite import Context
+
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="netbot benchmarks")
+    parser.add_argument("--tickets", type=int, default=10_000, help="number of synthetic tickets")
+    parser.add_argument("--users", type=int, default=2_000, help="number of synthetic users")
+    parser.add_argument("--journals", type=int, default=5, help="average journals per ticket")
+    parser.add_argument("--emails", type=int, default=500, help="number of synthetic email messages")
+    parser.add_argument("--synced", type=float, default=0.1, help="fraction of tickets synced to discord")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of latency added to each redmine request")
+    parser.add_argument("--messages", type=int, default=2, help="average new discord messages per synced thread")
+    parser.add_argument("--discord-latency", type=float, default=0.0, help="seconds of latency added to each discord request")
+    parser.add_argument("--rate-limit", type=int, default=0, help="discord requests per channel per 5 seconds, 0 for no limit")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic data")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="timed runs per benchmark")
+    parser.add_argument("--only", nargs="*", help="only run benchmarks starting with these names")
+    parser.add_argument("--output", help="write JSON results to this file, rather than stdout")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="{asctime} {levelname:<8s} {name:<16} {message}", style='{')
+    logging.getLogger("benchmarks").setLevel(logging.INFO)
+
+    context = Context(tickets=args.tickets, users=args.users, journals=args.journals, emails=args.emails,
+                      synced=args.synced, latency=args.latency, messages=args.messages,
+                      discord_latency=args.discord_latency, rate_limit=args.rate_limit, seed=args.seed)
+    runner = Runner(context, repeat=args.repeat)
+    try:
+        runner.run(args.only)
+    finally:
+        context.close()
+    runner.write(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Benchmark registry, timing and JSON results"""
+
+import sys
+import time
+import json
+import logging
+import platform
+import statistics
+import subprocess
+from dataclasses import dataclass, field
+from collections.abc import Callable
+
+from redmine import synctime
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_REPEAT = 5
+
+# name -> setup function. setup is called once with the context, and returns
+# the function to time. The timed function returns the number of operations performed.
+BENCHMARKS: dict[str, Callable] = {}
+
+
+def benchmark(name: str):
+    """decorator to register a benchmark setup function"""
+    def register(setup: Callable) -> Callable:
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+@dataclass
+class BenchmarkResult():
+    """timing of a single benchmark, over several runs"""
+    name: str
+    ops: int = 0 # operations per run
+    times: list[float] = field(default_factory=list) # seconds, per run
+    error: str | None = None
+
+    @property
+    def best(self) -> float:
+        return min(self.times) if self.times else 0.0
+
+    def summary(self) -> dict:
+        result = {
+            "name": self.name,
+            "ops": self.ops,
+            "runs": len(self.times),
+        }
+        if self.times:
+            result.update({
+                "min": self.best,
+                "mean": statistics.mean(self.times),
+                "median": statistics.median(self.times),
+                "max": max(self.times),
+                "us_per_op": self.best / max(self.ops, 1) * 1_000_000,
+            })
+        if self.error:
+            result["error"] = self.error
+        return result
+
+    def __str__(self) -> str:
+        if self.error:
+            return f"{self.name:<32} FAILED: {self.error}"
+        return f"{self.name:<32} {self.ops:>8} ops  best {self.best:9.4f}s  {self.summary()['us_per_op']:10.2f} us/op"
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Runner():
+    """run the registered benchmarks against a shared context"""
+    def __init__(self, context, repeat: int = DEFAULT_REPEAT):
+        self.context = context
+        self.repeat = repeat
+        self.results: list[BenchmarkResult] = []
+
+
+    def run(self, names: list[str] | None = None) -> list[BenchmarkResult]:
+        for name, setup in BENCHMARKS.items():
+            if names and not any(name.startswith(prefix) for prefix in names):
+                continue
+            self.results.append(self.run_one(name, setup))
+        return self.results
+
+
+    def run_one(self, name: str, setup: Callable) -> BenchmarkResult:
+        result = BenchmarkResult(name)
+        try:
+            func = setup(self.context)
+            func() # warm up, not timed
+            for _ in range(self.repeat):
+                start = time.perf_counter()
+                result.ops = func()
+                result.times.append(time.perf_counter() - start)
+        except Exception as ex:
+            log.exception(f"benchmark {name} failed")
+            result.error = str(ex) or ex.__class__.__name__
+        log.info(str(result))
+        return result
+
+
+    def report(self) -> dict:
+        """the results, with enough metadata to compare across releases"""
+        return {
+            "version": git_version(),
+            "timestamp": synctime.zulu(synctime.now()),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "repeat": self.repeat,
+            "params": self.context.params(),
+            "results": [result.summary() for result in self.results],
+        }
+
+
+    def write(self, path: str | None) -> None:
+        report = json.dumps(self.report(), indent=2)
+        if path:
+            with open(path, 'w', encoding="utf-8") as file:
+                file.write(report)
+            log.info(f"wrote results to {path}")
+        else:
+            print(report)
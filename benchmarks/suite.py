@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""The benchmarks: model parsing, user cache, ticket buckets, formatting, email and sync"""
+
+import types
+import asyncio
+import logging
+
+from redmine.model import Ticket, User
+from redmine.users import UserCache
+from redmine.tickets import TicketManager
+from redmine.session import RedmineSession
+from redmine.redmine import Client
+from netbot.formatting import DiscordFormatter
+from threader import imap
+from threader.threadindex import ThreadIndex
+from tests.local_redmine import LocalRedmine
+from tests.fake_discord import FakeDiscord
+
+from benchmarks.runner import benchmark
+from benchmarks.synthetic import Synthetic
+
+
+log = logging.getLogger(__name__)
+
+
+REPORT_SIZE = 50 # tickets per formatted report, a typical query result
+
+
+class Context(Synthetic):
+    """synthetic data, plus a local redmine server and a fake discord, started on first use"""
+    def __init__(self, latency: float = 0.0, messages: int = 2, discord_latency: float = 0.0,
+                 rate_limit: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.messages = messages # average new discord messages per synced thread
+        self.discord_latency = discord_latency
+        self.rate_limit = rate_limit # discord requests per channel per 5 seconds, 0 for none
+        self._server: LocalRedmine | None = None
+        self._client: Client | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._index: ThreadIndex | None = None
+
+
+    def params(self) -> dict:
+        return super().params() | {
+            "latency": self.latency,
+            "messages": self.messages,
+            "discord_latency": self.discord_latency,
+            "rate_limit": self.rate_limit,
+        }
+
+
+    def server(self) -> LocalRedmine:
+        if self._server is None:
+            self._server = LocalRedmine(self.data(), latency=self.latency, seed=self.seed)
+            self._server.start()
+        return self._server
+
+
+    def client(self) -> Client:
+        """a redmine client, connected to the local server"""
+        if self._client is None:
+            self._client = Client.from_session(self.server().session(), default_project=1)
+        return self._client
+
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """the event loop for the async benchmarks, set as current so the bot can be created"""
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        return self._loop
+
+
+    def thread_index(self) -> ThreadIndex:
+        """an in-memory index of email threads"""
+        if self._index is None:
+            self._index = ThreadIndex()
+        return self._index
+
+
+    def discord(self) -> FakeDiscord:
+        """a fake discord guild with a thread for each synced ticket"""
+        return FakeDiscord.from_data(self.data(), messages=self.messages, seed=self.seed,
+                                     latency=self.discord_latency, rate_limit=self.rate_limit)
+
+
+    def close(self) -> None:
+        if self._server:
+            self._server.stop()
+        if self._loop:
+            asyncio.set_event_loop(None)
+            self._loop.close()
+        if self._index is not None:
+            self._index.close()
+
+
+@benchmark("model.parse_tickets")
+def parse_tickets(ctx: Context):
+    issues = ctx.issue_dicts()
+    def run() -> int:
+        for issue in issues:
+            Ticket(**issue)
+        return len(issues)
+    return run
+
+
+@benchmark("model.parse_users")
+def parse_users(ctx: Context):
+    users = ctx.user_dicts()
+    def run() -> int:
+        for user in users:
+            User(**user)
+        return len(users)
+    return run
+
+
+@benchmark("users.cache_users")
+def cache_users(ctx: Context):
+    users = ctx.users()
+    def run() -> int:
+        UserCache().cache_users(users)
+        return len(users)
+    return run
+
+
+@benchmark("users.lookup")
+def user_lookup(ctx: Context):
+    users = ctx.users()
+    cache = UserCache()
+    cache.cache_users(users)
+    cache.cache_teams(ctx.teams())
+    def run() -> int:
+        for user in users:
+            cache.find(user.login)
+            cache.find(user.mail)
+            if user.discord_id:
+                cache.find_discord_user(user.discord_id.name)
+        return len(users) * 3
+    return run
+
+
+@benchmark("users.autocomplete")
+def user_autocomplete(ctx: Context):
+    users = ctx.users()
+    cache = UserCache()
+    cache.cache_users(users)
+    prefixes = [user.login[:4 + i % 4] for i, user in enumerate(users)]
+    def run() -> int:
+        for prefix in prefixes:
+            cache.complete_user(prefix)
+        return len(prefixes)
+    return run
+
+
+@benchmark("tickets.bucket_tickets")
+def bucket_tickets(ctx: Context):
+    tickets = ctx.tickets()
+    ticket_mgr = TicketManager(RedmineSession("http://localhost", ""), default_project=1, reindex=False)
+    def run() -> int:
+        ticket_mgr.bucket_tickets(tickets)
+        return len(tickets)
+    return run
+
+
+@benchmark("formatter.ticket_report")
+def ticket_report(ctx: Context):
+    tickets = ctx.tickets()
+    reports = [tickets[i:i + REPORT_SIZE] for i in range(0, len(tickets), REPORT_SIZE)]
+    formatter = DiscordFormatter("http://localhost")
+    app_ctx = types.SimpleNamespace(bot=types.SimpleNamespace(find_ticket_thread=lambda _ticket_id: None))
+    def run() -> int:
+        for report in reports:
+            formatter.format_ticket_report(app_ctx, "Benchmark", report)
+        return len(reports)
+    return run
+
+
+@benchmark("formatter.ticket_details")
+def ticket_details(ctx: Context):
+    tickets = ctx.tickets()
+    formatter = DiscordFormatter("http://localhost")
+    def run() -> int:
+        for ticket in tickets:
+            formatter.format_ticket_details(ticket)
+        return len(tickets)
+    return run
+
+
+@benchmark("email.parse_message")
+def parse_message(ctx: Context):
+    emails = ctx.emails()
+    client = imap.Client(ctx.client(), ctx.thread_index())
+    def run() -> int:
+        for data in emails:
+            client.parse_message(data).close_attachments()
+        return len(emails)
+    return run
+
+
+@benchmark("sync.sweep")
+def sync_sweep(ctx: Context):
+    """the scheduled sync tick over the fake guild and the local redmine, with every thread due"""
+    loop = ctx.loop()
+    fake = ctx.discord()
+    bot = fake.bot(ctx.client())
+
+    def run() -> int:
+        loop.run_until_complete(bot.sweep())
+        log.info(f"sync.sweep discord requests: {dict(fake.stats)}, throttled {fake.throttled:.2f}s")
+        return len(fake.guilds[0].threads)
+    return run
+
+
+@benchmark("discord.find_ticket_thread")
+def find_ticket_thread(ctx: Context):
+    ctx.loop()
+    bot = ctx.discord().bot(ctx.client())
+    ticket_ids = ctx.synced_ids()
+    def run() -> int:
+        for ticket_id in ticket_ids:
+            bot.find_ticket_thread(ticket_id)
+        return len(ticket_ids)
+    return run
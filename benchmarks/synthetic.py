@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Seeded generator of synthetic tickets, journals, users, teams and email"""
+
+import random
+import logging
+import datetime as dt
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+from redmine.model import Team, Ticket, User, SYNC_FIELD_NAME
+from redmine import synctime
+from tests.local_redmine import RedmineData, WORDS
+
+
+log = logging.getLogger(__name__)
+
+
+class Synthetic():
+    """
+    Synthetic data at a configurable scale. The same parameters and seed
+    always produce the same data, so benchmark runs are comparable.
+    """
+    def __init__(self, tickets: int = 10_000, users: int = 2_000, journals: int = 5,
+                 emails: int = 500, synced: float = 0.1, seed: int = 0):
+        self.num_tickets = tickets
+        self.num_users = users
+        self.num_journals = journals # average per ticket
+        self.num_emails = emails
+        self.synced = synced # fraction of tickets with a discord sync record
+        self.seed = seed
+        self._data: RedmineData | None = None
+        self._emails: list[bytes] | None = None
+
+
+    def params(self) -> dict:
+        return {
+            "tickets": self.num_tickets,
+            "users": self.num_users,
+            "journals": self.num_journals,
+            "emails": self.num_emails,
+            "synced": self.synced,
+            "seed": self.seed,
+        }
+
+
+    def data(self) -> RedmineData:
+        """the redmine dataset, as served by tests.local_redmine"""
+        if self._data is None:
+            self._data = RedmineData.generate(self.num_users, self.num_tickets, self.num_journals, self.seed)
+            self._data.sync_issues(self.synced, self.seed)
+        return self._data
+
+
+    def synced_ids(self) -> list[int]:
+        """ids of the tickets with a sync record"""
+        return [issue["id"] for issue in self.data().issues.values()
+                if any(field["name"] == SYNC_FIELD_NAME and field["value"] for field in issue["custom_fields"])]
+
+
+    def issue_dicts(self) -> list[dict]:
+        """the issues as the API returns them with include=journals"""
+        return [{k: v for k, v in issue.items() if k not in ("watchers", "attachments")}
+                for issue in self.data().issues.values()]
+
+
+    def user_dicts(self) -> list[dict]:
+        return list(self.data().users.values())
+
+
+    def tickets(self) -> list[Ticket]:
+        return [Ticket(**issue) for issue in self.issue_dicts()]
+
+
+    def users(self) -> list[User]:
+        return [User(**user) for user in self.user_dicts()]
+
+
+    def teams(self) -> dict[str, Team]:
+        data = self.data()
+        return {group["name"]: Team(id=group["id"], name=group["name"],
+                                    users=[data.named(user_id) for user_id in group["user_ids"]])
+                for group in data.groups.values()}
+
+
+    def emails(self) -> list[bytes]:
+        if self._emails is None:
+            rand = random.Random(self.seed)
+            self._emails = [self.email(rand, i) for i in range(self.num_emails)]
+        return self._emails
+
+
+    def email(self, rand: random.Random, index: int) -> bytes:
+        """a single .eml message: plain or html, sometimes quoted, sometimes with an attachment"""
+        def words(low: int, high: int) -> str:
+            return " ".join(rand.choices(WORDS, k=rand.randint(low, high)))
+
+        sent = synctime.now() - dt.timedelta(minutes=rand.randint(0, 60 * 24 * 30))
+        sender = f"sender{rand.randint(0, max(self.num_users, 1)):05d}"
+
+        message = EmailMessage()
+        message["From"] = f"Sender {index} <{sender}@example.org>"
+        message["To"] = "help@example.com"
+        if rand.random() < 0.3:
+            message["Cc"] = f"cc{index}@example.net"
+        message["Subject"] = ("Re: " if rand.random() < 0.4 else "") + words(3, 9).capitalize()
+        message["Date"] = format_datetime(sent)
+        message["Message-ID"] = f"<synthetic.{self.seed}.{index}@example.org>"
+
+        body = "\n\n".join(words(10, 80) for _ in range(rand.randint(1, 5)))
+        if rand.random() < 0.4:
+            # quoted reply, to be stripped
+            quoted = "\n".join("> " + words(5, 15) for _ in range(rand.randint(2, 20)))
+            body += f"\n\nOn {format_datetime(sent)}, Someone <someone@example.org> wrote:\n{quoted}\n"
+
+        message.set_content(body)
+        if rand.random() < 0.3:
+            paragraphs = "".join(f"<p>{paragraph}</p>" for paragraph in body.split("\n\n"))
+            message.add_alternative(f"<html><body>{paragraphs}</body></html>", subtype="html")
+        if rand.random() < 0.2:
+            payload = rand.randbytes(rand.randint(1_000, 50_000))
+            message.add_attachment(payload, maintype="application", subtype="octet-stream", filename=f"file{index}.bin")
+
+        return message.as_bytes()
@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 """Cog to manage SCN-related functions"""
 
+import asyncio
 import logging
 
 import discord
 from discord.commands import SlashCommandGroup, option
 from discord.ext import commands
 
+from redmine import accounting, profiling
 from redmine.model import Message, User
 from redmine.redmine import Client, BLOCKED_TEAM_NAME
 
-from netbot.netbot import NetBot
+from netbot.netbot import NetBot, complete_user, complete_team
 
 log = logging.getLogger(__name__)
 
@@ -185,7 +187,7 @@ class SCNCog(commands.Cog):
 
     # FIXME rename to "register"?
     @scn.command(description="Add a Discord user to redmine")
-    @option("redmine_login", description="Your redmine user login")
+    @option("redmine_login", description="Your redmine user login", autocomplete=complete_user)
     @option("member", description="Discord member collaborating with ticket", optional=True)
     async def add(self, ctx:discord.ApplicationContext, redmine_login:str, member:discord.Member=None):
         """add a Discord user to the Redmine ticketing integration"""
@@ -287,12 +289,40 @@ class SCNCog(commands.Cog):
         else:
             await ctx.respond("Not a thread.")  # error
 
+    @scn.command(name="sync-roles", description="Synchronize Discord roles with Redmine teams")
+    @option("dry_run", description="Report the changes without applying them", default=False)
+    async def sync_roles(self, ctx: discord.ApplicationContext, dry_run: bool = False):
+        await ctx.defer()
+        plan = await self.bot.sync_roles(dry_run)
+        await ctx.respond(self.formatter.format_role_sync(plan, dry_run))
+
     @scn.command()
     async def reindex(self, ctx: discord.ApplicationContext):
         """reindex the all cached information"""
-        self.redmine.reindex()
+        await ctx.defer()
+        await asyncio.to_thread(self.redmine.reindex)
         # self.bot.reindex() FIXME, once roles are working
-        await ctx.respond("Rebuilt redmine indices.")
+        await ctx.respond(f"Rebuilt redmine indices, {self.redmine.warmup_report}")
+
+    @scn.command(description="Redmine calls per command and background task")
+    @option("reset", description="Reset the counters after reporting", default=False)
+    async def stats(self, ctx: discord.ApplicationContext, reset: bool = False):
+        await ctx.respond(self.formatter.format_stats(accounting.ACCOUNTING.summary(), accounting.ACCOUNTING.since))
+        if reset:
+            accounting.ACCOUNTING.reset()
+
+    @scn.command(description="Turn profiling of commands and background tasks on or off")
+    @option("state", description="on, off or status", choices=["on", "off", "status"], default="status")
+    @option("memory", description="Include memory allocations, with tracemalloc", default=False)
+    async def profile(self, ctx: discord.ApplicationContext, state: str = "status", memory: bool = False):
+        if state != "status" and not self.is_admin(ctx.user):
+            await ctx.respond("Only admins can change profiling.")
+            return
+        if state == "on":
+            profiling.PROFILER.enable(memory)
+        elif state == "off":
+            profiling.PROFILER.disable()
+        await ctx.respond(profiling.PROFILER.status())
 
     # REMOVE - handled by discord roles
     # @scn.command(description="join the specified team")
@@ -334,6 +364,7 @@ class SCNCog(commands.Cog):
                 return role
 
     @scn.command(description="list teams and members")
+    @option("teamname", description="Team to list", optional=True, autocomplete=complete_team)
     async def teams(self, ctx: discord.ApplicationContext, teamname: str = None):
         # list teams, with members
         if teamname:
@@ -388,6 +419,7 @@ class SCNCog(commands.Cog):
     @scn.command(
         description="block specific a email address and reject all related tickets"
     )
+    @option("username", description="Redmine login or email address", autocomplete=complete_user)
     async def block(self, ctx: discord.ApplicationContext, username: str):
         log.debug(f"blocking {username}")
         # user = self.redmine.lookup_user(username)
@@ -406,6 +438,7 @@ class SCNCog(commands.Cog):
             await ctx.respond(f"Unknown user: {username}")
 
     @scn.command(description="unblock specific a email address")
+    @option("username", description="Redmine login or email address", autocomplete=complete_user)
     async def unblock(self, ctx: discord.ApplicationContext, username: str):
         log.debug(f"Unblocking {username}")
         user = self.redmine.user_mgr.find(username)
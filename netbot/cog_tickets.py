@@ -18,8 +18,8 @@ from discord.ext import tasks
 
 import dateparser
 
-from redmine.model import Message, Ticket
-from redmine import synctime
+from redmine.model import Message, Ticket, TRACE_FIELD_NAME
+from redmine import synctime, accounting, profiling, tracing
 from redmine.redmine import Client
 from netbot.netbot import NetBot, TEAM_MAPPING, CHANNEL_MAPPING, default_ticket
 from . import config
@@ -57,9 +57,7 @@ def get_program_options() -> list[OptionChoice]:
 
 def get_trackers(ctx: discord.AutocompleteContext):
     """Returns a list of trackers that begin with the characters entered so far."""
-    trackers = ctx.bot.redmine.ticket_mgr.get_trackers() # this is expected to be cached
-    # .lower() is used to make the autocomplete case-insensitive
-    return [tracker for tracker in trackers.keys() if tracker.lower().startswith(ctx.value.lower())]
+    return ctx.bot.redmine.ticket_mgr.complete_tracker(ctx.value) # indexed when the trackers are cached
 
 
 def get_priorities(ctx: discord.AutocompleteContext):
@@ -499,7 +497,7 @@ class TicketsCog(commands.Cog):
             await ctx.respond(f"Zero results for: `{term}`")
 
     @ticket.command(description="Get ticket details")
-    @option("ticket_id", description="ticket ID", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ticket ID", autocomplete=default_ticket)
     async def details(self, ctx: discord.ApplicationContext, ticket_id:int):
         """Update status on a ticket, using: unassign, resolve, progress"""
         #log.debug(f"found user mapping for {ctx.user.name}: {user}")
@@ -522,7 +520,7 @@ class TicketsCog(commands.Cog):
 
 
     @ticket.command(description="Collaborate on a ticket")
-    @option("ticket_id", description="ticket ID", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ticket ID", autocomplete=default_ticket)
     @option("member", description="Discord member collaborating with ticket", optional=True)
     async def collaborate(self, ctx: discord.ApplicationContext, ticket_id:int, member:discord.Member=None):
         """Add yourself as a collaborator on a ticket"""
@@ -547,7 +545,7 @@ class TicketsCog(commands.Cog):
 
 
     @ticket.command(description="Unassign a ticket")
-    @option("ticket_id", description="ticket ID", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ticket ID", autocomplete=default_ticket)
     async def unassign(self, ctx: discord.ApplicationContext, ticket_id:int):
         """Update status on a ticket, using: unassign, resolve, progress"""
         # lookup the user
@@ -565,7 +563,7 @@ class TicketsCog(commands.Cog):
 
 
     @ticket.command(description="Resolve a ticket")
-    @option("ticket_id", description="ticket ID", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ticket ID", autocomplete=default_ticket)
     async def resolve(self, ctx: discord.ApplicationContext, ticket_id:int):
         """Update status on a ticket, using: unassign, resolve, progress"""
         # lookup the user
@@ -586,7 +584,7 @@ class TicketsCog(commands.Cog):
 
 
     @ticket.command(description="Mark a ticket in-progress")
-    @option("ticket_id", description="ticket ID", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ticket ID", autocomplete=default_ticket)
     @option("member", description="Discord member taking ownership", optional=True)
     async def progress(self, ctx: discord.ApplicationContext, ticket_id:int, member:discord.Member=None):
         """Update status on a ticket, using: progress"""
@@ -613,7 +611,7 @@ class TicketsCog(commands.Cog):
 
 
     @ticket.command(description="Assign a ticket")
-    @option("ticket_id", description="ticket ID", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ticket ID", autocomplete=default_ticket)
     @option("member", description="Discord member taking ownership", optional=True)
     async def assign(self, ctx: discord.ApplicationContext, ticket_id:int, member:discord.Member=None):
         # lookup the user
@@ -694,7 +692,7 @@ class TicketsCog(commands.Cog):
             ticket_link = self.bot.formatter.redmine_link(ticket)
             alert_msg = f"New ticket created: {ticket_link}"
             if role:
-                await thread.send(self.bot.formatter.format_roles_alert([role.id], alert_msg))
+                await self.bot.send_queue.send(thread, self.bot.formatter.format_roles_alert([role.id], alert_msg))
             else:
                 log.warning(f"unable to load role by team name: {team.name}")
             await ctx.respond(alert_msg, embed=self.bot.formatter.ticket_embed(ctx, ticket))
@@ -723,7 +721,7 @@ class TicketsCog(commands.Cog):
                 return
             if message == "":
                 message = f"Ticket {ticket.id} is about will expire soon."
-            await thread.send(self.bot.formatter.format_ticket_alert(ticket, discord_ids, message))
+            await self.bot.send_queue.send(thread, self.bot.formatter.format_ticket_alert(ticket, discord_ids, message))
             await ctx.respond("Alert sent.")
         else:
             await ctx.respond(f"ERROR: Unkown ticket ID: {ticket_id}") ## TODO format error message
@@ -747,7 +745,7 @@ class TicketsCog(commands.Cog):
                 else:
                     log.info(f"Ticket {ticket_id} synced with unknown thread ID {synced.channel_id}. Recovering.")
                     # delete the sync record
-                    self.redmine.ticket_mgr.remove_sync_record(synced)
+                    self.bot.remove_sync_record(synced)
                     # fall thru to create thread and sync
 
             # create the thread...
@@ -767,7 +765,7 @@ class TicketsCog(commands.Cog):
 
 
     @ticket.command(name="tracker", description="Update the tracker of a ticket")
-    @option("ticket_id", description="ID of ticket to update", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ID of ticket to update", autocomplete=default_ticket)
     @option("tracker", description="Tracker to assign to ticket", autocomplete=get_trackers)
     async def tracker(self, ctx: discord.ApplicationContext, ticket_id:int, tracker:str):
         user = self.redmine.user_mgr.find_discord_user(ctx.user.name)
@@ -790,7 +788,7 @@ class TicketsCog(commands.Cog):
 
 
     @ticket.command(name="status", description="Update the status of a ticket")
-    @option("ticket_id", description="ID of ticket to update", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ID of ticket to update", autocomplete=default_ticket)
     @option("status", description="Status to assign to ticket", autocomplete=get_statuses)
     async def status(self, ctx: discord.ApplicationContext, ticket_id:int, status:str):
         user = self.redmine.user_mgr.find_discord_user(ctx.user.name)
@@ -813,7 +811,7 @@ class TicketsCog(commands.Cog):
 
 
     @ticket.command(name="priority", description="Update the priority of a ticket")
-    @option("ticket_id", description="ID of ticket to update", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ID of ticket to update", autocomplete=default_ticket)
     @option("priority", description="Priority to assign to ticket", autocomplete=get_priorities)
     async def priority(self, ctx: discord.ApplicationContext, ticket_id:int, priority:str):
         user = self.redmine.user_mgr.find_discord_user(ctx.user.name)
@@ -840,7 +838,7 @@ class TicketsCog(commands.Cog):
 
 
     @ticket.command(name="subject", description="Update the subject of a ticket")
-    @option("ticket_id", description="ID of ticket to update", autocomplete=discord.utils.basic_autocomplete(default_ticket))
+    @option("ticket_id", description="ID of ticket to update", autocomplete=default_ticket)
     @option("subject", description="Updated subject")
     async def subject(self, ctx: discord.ApplicationContext, ticket_id:int, subject:str):
         user = self.redmine.user_mgr.find_discord_user(ctx.user.name)
@@ -1092,14 +1090,17 @@ class TicketsCog(commands.Cog):
         log.debug("notify_new_tickets. this should be called every minute.")
 
         # check for new tickets
-        for ticket in self.get_new_tickets():
-            if ticket.tracker.name in self.AUTOTHREAD_TRACKERS:
-                log.debug(f"auto-threading ticket {ticket.id} based on tracker: {ticket.tracker}")
-                await self.sync_ticket(ticket)
+        with accounting.operation("task:poll_new_tickets"), profiling.profile("task:poll_new_tickets"):
+            for ticket in self.get_new_tickets():
+                if ticket.tracker.name in self.AUTOTHREAD_TRACKERS:
+                    log.debug(f"auto-threading ticket {ticket.id} based on tracker: {ticket.tracker}")
+                    # continue the trace of the email that created the ticket
+                    with tracing.resume(ticket.get_custom_field(TRACE_FIELD_NAME), "autothread", ticket=ticket.id):
+                        await self.sync_ticket(ticket)
 
-            if ticket.tracker.name in self.AUTONOTIFY_TRACKERS:
-                # no need to await the notification
-                await self.notify_ticket(ticket)
+                if ticket.tracker.name in self.AUTONOTIFY_TRACKERS:
+                    # no need to await the notification
+                    await self.notify_ticket(ticket)
 
 
     def get_new_tickets(self):
@@ -1120,13 +1121,15 @@ class TicketsCog(commands.Cog):
             # find parent channel for thread
             parent = self.bot.channel_for_ticket(ticket)
             # create thread
-            thread = await self.create_ticket_thread(ticket, parent)
+            with tracing.span("create_thread"):
+                thread = await self.create_ticket_thread(ticket, parent)
             if thread:
                 # create sync record
                 sync_rec = synctime.SyncRecord(ticket.id, thread.id)
-                self.redmine.ticket_mgr.update_sync_record(sync_rec)
+                self.bot.save_sync_record(sync_rec, publish=True)
                 # sync
-                complete = await self.bot.sync_thread(thread)
+                with tracing.span("first_sync"):
+                    complete = await self.bot.sync_thread(thread)
                 return complete
             else:
                 log.error(f"No update. Cannot find channel for {ticket}")
@@ -1150,7 +1153,7 @@ class TicketsCog(commands.Cog):
             thread = await parent_channel.create_thread(name=thread_name, type=discord.ChannelType.public_thread)
 
             # ticket-614: Creating new thread should post the ticket details to the new thread
-            await thread.send(self.bot.formatter.format_ticket_details(ticket))
+            await self.bot.send_queue.send(thread, self.bot.formatter.format_ticket_details(ticket))
 
             return thread
         else:
@@ -42,6 +42,26 @@ def get_emoji(key:str) -> str:
     return EMOJI.get(key, "")
 
 
+def pack_messages(parts: list[str], max_len: int = MAX_MESSAGE_LEN, sep: str = "\n\n") -> list[str]:
+    """
+    pack parts, in order, into as few messages as fit in max_len.
+    parts are never split: one over max_len is truncated, in a message of its own.
+    """
+    messages = []
+    current = ""
+    for part in parts:
+        part = part[:max_len]
+        if current and len(current) + len(sep) + len(part) <= max_len:
+            current += sep + part
+        else:
+            if current:
+                messages.append(current)
+            current = part
+    if current:
+        messages.append(current)
+    return messages
+
+
 COLOR = {
     'Resolved': discord.Color.dark_green(),
     'Reject': discord.Color.dark_orange(),
@@ -248,6 +268,11 @@ class DiscordFormatter():
         return f"> **{note.user}** *{age} ago*\n> {note.notes}"[:MAX_MESSAGE_LEN]
 
 
+    def format_discord_notes(self, notes) -> list[str]:
+        """Format notes for Discord, packed into as few messages as possible"""
+        return pack_messages([self.format_discord_note(note) for note in notes])
+
+
     def format_ticket(self, ticket:Ticket) -> str:
         link = self.redmine_link(ticket)
         status = f"{get_emoji(ticket.status.name)} {ticket.status.name}"
@@ -606,6 +631,43 @@ class DiscordFormatter():
     #     await ctx.channel.send(msg)
 
 
+    def format_role_sync(self, plan, dry_run:bool = False, max_len=MAX_MESSAGE_LEN) -> str:
+        """Format a role sync plan as a report, listing changes by team"""
+        title = "Role sync dry-run" if dry_run else "Role sync"
+        msg = f"**{title}**: {len(plan.adds)} added, {len(plan.removes)} removed"
+        if plan.failed:
+            msg += f", {len(plan.failed)} failed"
+        msg += "\n"
+
+        for change in plan.adds:
+            msg += f"+ {change.user.name} → {change.team.name}\n"
+        for change in plan.removes:
+            msg += f"- {change.user.name} ← {change.team.name}\n"
+
+        if len(msg) > max_len:
+            log.warning(f"message over {max_len} chars. truncing.")
+            msg = msg[:max_len]
+
+        return msg.strip()
+
+
+    def format_stats(self, operations, since, max_len=MAX_MESSAGE_LEN) -> str:
+        """Format redmine call accounting as a table, one line per operation"""
+        msg = f"**Redmine calls** since {synctime.age_str(since)} ago\n```\n"
+        msg += f"{'operation':<28} {'runs':>5} {'calls':>6} {'/run':>5} {'err':>4} {'p50':>6} {'p95':>6} {'KB':>7}\n"
+        footer = "```"
+        for stats in operations:
+            per_run = stats.calls / stats.runs if stats.runs else 0.0
+            kbytes = (stats.sent + stats.received) / 1024
+            line = (f"{stats.name[:28]:<28} {stats.runs:>5} {stats.calls:>6} {per_run:>5.1f} {stats.errors:>4} "
+                    f"{stats.latency.quantile(0.5):>6} {stats.latency.quantile(0.95):>6} {kbytes:>7.1f}\n")
+            if len(msg) + len(line) + len(footer) > max_len:
+                log.warning(f"message over {max_len} chars. truncing.")
+                break
+            msg += line
+        return msg + footer
+
+
     def format_team(self, ctx: discord.ApplicationContext, team: discord.Role, inc_users:bool = True) -> str:
         # single line format: teamname: member1, member2
         #skip_teams = ["blocked", "users", "@everyone", ctx.me.name]
@@ -5,6 +5,7 @@ import os
 import sys
 import re
 import logging
+import itertools
 import asyncio
 import discord
 from dotenv import load_dotenv
@@ -13,11 +14,18 @@ from discord.ext import commands, tasks
 import datetime as dt
 from zoneinfo import ZoneInfo
 
-from redmine.model import TicketNote, Ticket, NamedId, Team, TeamSet
-from redmine import synctime
+from redmine.model import TicketNote, Ticket, NamedId, Team, TeamSet, TRACE_FIELD_NAME
+from redmine import synctime, accounting, metrics, profiling, tracing
 from redmine.redmine import Client
+from redmine.session import RedmineException
+from redmine.prefix import MAX_RESULTS
+from redmine.snapshot import Snapshot
 
 from .formatting import DiscordFormatter
+from .rolesync import RoleSync, RoleSyncPlan
+from .scheduler import SyncScheduler, TICK_SECONDS
+from .syncstore import SyncStore, RECONCILE_BATCH
+from .sendqueue import SendQueue
 from . import config
 
 log = logging.getLogger(__name__)
@@ -53,14 +61,53 @@ FALLBACK_TEAM = "intake-team"
 
 PROG_CACHE = None
 
-# utility method to get a list of (one) ticket from the title of the channel, or empty list
-def default_ticket(ctx: discord.AutocompleteContext) -> list[int]:
+MAX_CHOICE_LEN = 100 # discord limit on autocomplete choice names
+MERGE_NOTES_ENV = "NETBOT_MERGE_NOTES" # merge consecutive discord messages by the same author into one redmine note
+
+SYNC_SWEEP_SECONDS = metrics.histogram("netbot_sync_sweep_seconds", "Duration of a sync_due_threads tick",
+                                       buckets=metrics.STAGE_BUCKETS)
+THREADS_SYNCED = metrics.counter("netbot_threads_synced_total",
+                                 "Threads visited by the sync sweep, by result: synced, skipped, locked or error",
+                                 ("result",))
+THREADS_ARCHIVED = metrics.counter("netbot_threads_archived_total",
+                                   "Threads archived and unarchived, by action: archive or unarchive", ("action",))
+THREADS_DUE = metrics.gauge("netbot_threads_due", "Threads due to sync, waiting for the request budget")
+NOTES_SYNCED = metrics.counter("netbot_notes_synced_total",
+                               "Notes copied by sync, by direction: to_discord or to_redmine", ("direction",))
+NOTE_WRITES_SAVED = metrics.counter("netbot_note_writes_saved_total",
+                                    "Redmine writes saved by merging discord messages from the same author")
+
+
+def ticket_choice(ticket_id: int, subject: str) -> discord.OptionChoice:
+    return discord.OptionChoice(f"#{ticket_id} {subject}"[:MAX_CHOICE_LEN], value=ticket_id)
+
+
+# autocomplete the ticket from the title of the channel, then recent tickets matching the value so far.
+# answered from the cache only, no redmine calls.
+def default_ticket(ctx: discord.AutocompleteContext) -> list[discord.OptionChoice]:
+    choices = []
+    value = str(ctx.value or "")
+
     # examine the thread
     ticket_id = NetBot.parse_thread_title(ctx.interaction.channel.name)
-    if ticket_id:
-        return [ticket_id]
-    else:
-        return []
+    if ticket_id and str(ticket_id).startswith(value.lstrip("#")):
+        choices.append(discord.OptionChoice(f"#{ticket_id}", value=ticket_id))
+
+    for recent_id, subject in ctx.bot.redmine.ticket_mgr.complete_ticket(value.lstrip("#")):
+        if recent_id != ticket_id:
+            choices.append(ticket_choice(recent_id, subject))
+
+    return choices[:MAX_RESULTS]
+
+
+def complete_user(ctx: discord.AutocompleteContext) -> list[str]:
+    """logins of cached users matching the value so far"""
+    return ctx.bot.redmine.user_mgr.cache.complete_user(ctx.value)
+
+
+def complete_team(ctx: discord.AutocompleteContext) -> list[str]:
+    """names of cached teams matching the value so far"""
+    return ctx.bot.redmine.user_mgr.cache.complete_team(ctx.value)
 
 
 class NetbotException(Exception):
@@ -77,6 +124,12 @@ class NetBot(commands.Bot):
         self.run_sync = True # ticket sync on by default
         self.lock = asyncio.Lock()
         self.ticket_locks = {}
+        self.scheduler = SyncScheduler.fromenv()
+        self.sync_store = SyncStore.fromenv()
+        self.send_queue = SendQueue()
+        self.merge_notes = os.getenv(MERGE_NOTES_ENV, "").lower() in profiling.TRUE_VALUES
+        self.updates_checked = synctime.now()
+        self.sync_writes: dict[int, dt.datetime] = {} # ticket id -> when this bot last wrote its sync record
 
         self.roles: dict[str,Role] = {}
         self.teams = TeamSet()
@@ -84,6 +137,7 @@ class NetBot(commands.Bot):
         self.formatter = DiscordFormatter(client.url)
 
         self.redmine = client
+        self.role_sync = RoleSync(client.user_mgr)
         config.programs = client.ticket_mgr.get_programs()
 
         #guilds = os.getenv('DISCORD_GUILDS').split(', ')
@@ -121,59 +175,81 @@ class NetBot(commands.Bot):
     #     log.debug(f"Loaded teams: {self.teams}")
 
 
-    def sync_team(self, role:discord.Role, team:Team):
-        team_ids = set()
-        for member in role.members:
-            user = self.redmine.user_mgr.find_discord_user(member.name)
-            if user:
-                log.debug(f"adding {user.name} to {team.name}")
-                self.redmine.user_mgr.join_team(user, team.name)
-                team_ids.add(user.id)
-
-        # noting: "in_team_ids" is the set of valid redmine IDs that should be in the associated team
-        for user in team.users:
-            if user.id not in team_ids:
-                # user missing from ids, must have been removed
-                log.debug(f"removing {user.name} from {team.name}")
-                self.redmine.user_mgr.leave_team(user, team.name)
-
-
-    def sync_roles(self):
+    async def sync_roles(self, dry_run: bool = False) -> RoleSyncPlan:
+        """Synchronize all guild roles with the matching redmine teams"""
         # Noting: "guild" maps to discord server, and the API is designed to run on many "Discord servers" concurrently
-        for guild in self.guilds:
-            for role in guild.roles:
-                team = self.redmine.user_mgr.get_team_by_name(role.name)
-                if not team:
-                    log.warning(f"No team for {role.name}. Create it, please!") # FIXME create the team!
-                    # create_team -> POST to /groups.json?name=teamname
-                else:
-                    self.sync_team(role, team)
-    # TODO: On team sync, update loacl team cache
+        plan = self.role_sync.plan(self.guilds)
+        return await self.role_sync.apply(plan, dry_run)
 
 
     def get_all_teams(self, include_users: bool = True) -> dict[str, Team]:
         return self.teams
 
 
-    def reindex(self):
+    async def reindex(self):
         log.debug("NetBot.reindex")
-        self.sync_roles()
+        await self.sync_roles()
+
+
+    async def revalidate(self):
+        """reload the redmine caches, replacing any snapshot values"""
+        start = synctime.now()
+        try:
+            with accounting.operation("task:revalidate"):
+                await asyncio.to_thread(self.redmine.reindex)
+                log.info(f"revalidated redmine caches, took {synctime.age_str(start)}")
+                await self.reindex()
+        except Exception:
+            log.exception("Error revalidating redmine caches")
 
 
     async def on_ready(self):
         #log.info(f"Logged in as {self.user} (ID: {self.user.id})")
         #log.debug(f"bot: {self}, guilds: {self.guilds}")
 
-        # reindex: cache roles, etc.
-        self.reindex()
+        if self.redmine.warm_start:
+            # started from a snapshot: revalidate the redmine caches in the
+            # background, then reindex against the fresh caches.
+            self.revalidate_task = asyncio.create_task(self.revalidate())
+        else:
+            # reindex: cache roles, etc.
+            await self.reindex()
+
+        if self.sync_store:
+            with accounting.operation("startup"):
+                await asyncio.to_thread(self.reconcile_sync_store)
 
         # start the tasks running
-        self.sync_all_threads.start()
+        self.sync_due_threads.start()
+        self.sync_updated_tickets.start()
         self.run_daily_tasks.start()
+        if os.getenv(accounting.METRICS_FILE_ENV):
+            self.write_metrics.start()
 
         log.debug(f"Initialized with {self.redmine}")
 
 
+    async def on_member_update(self, before:discord.Member, after:discord.Member):
+        """Incrementally sync team membership when a member's roles change"""
+        if before.roles != after.roles:
+            with accounting.operation("event:member_update"):
+                plan = self.role_sync.plan_member(before, after)
+                await self.role_sync.apply(plan)
+
+
+    async def invoke_application_command(self, ctx: discord.ApplicationContext) -> None:
+        """invoke a slash command, accounting its redmine calls to the command"""
+        name = f"/{ctx.command.qualified_name}"
+        with accounting.operation(name), profiling.profile(name):
+            await super().invoke_application_command(ctx)
+
+
+    @tasks.loop(minutes=1.0)
+    async def write_metrics(self):
+        """write the redmine call accounting to the metrics file"""
+        await asyncio.to_thread(accounting.write_metrics)
+
+
     async def on_message(self, message:discord.Message):
         if message.author.id != self.user.id:
             # not the bot user
@@ -181,6 +257,8 @@ class NetBot(commands.Bot):
                 # IS a thread, check the name
                 ticket_id = NetBot.parse_thread_title(message.channel.name)
                 if ticket_id:
+                    # sync the new message at the next tick
+                    self.scheduler.touch(message.channel.id)
                     user = self.redmine.user_mgr.find(message.author.name)
                     if user:
                         log.debug(f"known user commenting on ticket #{ticket_id}: redmine={user.login}, discord={message.author.name}")
@@ -220,22 +298,42 @@ class NetBot(commands.Bot):
         return notes
 
 
-    def append_redmine_note(self, ticket, message: discord.Message) -> None:
+    def format_redmine_note(self, message: discord.Message, user) -> str:
         """Format a discord message for redmine"""
         # redmine link format: "Link Text":http://whatever
-
-        # check user mapping exists
-        user = self.redmine.user_mgr.find(message.author.name)
         if user:
-            # format the note
-            formatted = f'"Discord":{message.jump_url}: {message.content}'
-            self.redmine.ticket_mgr.append_message(ticket.id, user.login, formatted)
+            return f'"Discord":{message.jump_url}: {message.content}'
         else:
             # no user mapping
-            log.debug(f"SYNC unknown Discord user: {message.author.name}")
-            formatted = f'"Discord":{message.jump_url} user *{message.author.name}* said: {message.content}'
-            # force user_login to None to use default user based on token (the admin)
-            self.redmine.ticket_mgr.append_message(ticket.id, user_login=None, note=formatted)
+            return f'"Discord":{message.jump_url} user *{message.author.name}* said: {message.content}'
+
+
+    def append_redmine_notes(self, ticket, messages: list[discord.Message]) -> int:
+        """
+        Append discord messages to a ticket, one note per message. In merge mode,
+        consecutive messages by the same author are merged into one note, each
+        with its own jump link. Returns the number of redmine writes.
+        """
+        if self.merge_notes:
+            runs = [list(run) for _, run in itertools.groupby(messages, key=lambda message: message.author.name)]
+        else:
+            runs = [[message] for message in messages]
+
+        for run in runs:
+            # check user mapping exists
+            author = run[0].author.name
+            user = self.redmine.user_mgr.find(author)
+            if not user:
+                log.debug(f"SYNC unknown Discord user: {author}")
+            formatted = "\n\n".join(self.format_redmine_note(message, user) for message in run)
+            # with no user mapping, force user_login to None to use default user based on token (the admin)
+            self.redmine.ticket_mgr.append_message(ticket.id, user.login if user else None, formatted)
+
+        saved = len(messages) - len(runs)
+        if saved:
+            NOTE_WRITES_SAVED.inc(saved)
+            log.debug(f"merged {len(messages)} discord messages into {len(runs)} notes on #{ticket.id}")
+        return len(runs)
 
 
     async def synchronize_ticket(self, ticket:Ticket, thread:discord.Thread) -> bool:
@@ -263,32 +361,44 @@ class NetBot(commands.Bot):
         try:
             # start of the process, will become "last update"
             sync_start = synctime.now()
-            sync_rec = ticket.validate_sync_record(expected_channel=thread.id)
+            sync_rec = self.get_sync_record(ticket, thread)
 
             if sync_rec:
                 log.debug(f"sync record: {sync_rec}")
 
                 # get the new notes from the redmine ticket
                 redmine_notes = self.gather_redmine_notes(ticket, sync_rec)
-                for note in redmine_notes:
-                    # Write the note to the discord thread
-                    dirty_flag = True
-                    await thread.send(self.formatter.format_discord_note(note))
+                # continue the trace of the email that updated the ticket, if any
+                trace_id = ticket.get_custom_field(TRACE_FIELD_NAME) if redmine_notes else None
+                with tracing.resume(trace_id, "sync", ticket=ticket.id, notes=len(redmine_notes)):
+                    if redmine_notes:
+                        # Write the notes to the discord thread, packed into as few messages as fit
+                        dirty_flag = True
+                        await self.send_queue.send(thread, *self.formatter.format_discord_notes(redmine_notes))
+                        NOTES_SYNCED.inc(len(redmine_notes), direction="to_discord")
                 log.debug(f"synced {len(redmine_notes)} notes from #{ticket.id} --> {thread}")
 
                 # get the new notes from discord
                 discord_notes = await self.gather_discord_notes(thread, sync_rec)
-                for message in discord_notes:
+                if discord_notes:
                     dirty_flag = True
-                    self.append_redmine_note(ticket, message)
+                    self.append_redmine_notes(ticket, discord_notes)
+                    NOTES_SYNCED.inc(len(discord_notes), direction="to_redmine")
 
                 log.debug(f"synced {len(discord_notes)} notes from {thread} -> #{ticket.id}")
 
+                # schedule the next sync from the latest activity on either side.
+                # for a closed ticket, this was the final sync.
+                closed = bool(ticket.status and ticket.status.is_closed)
+                self.scheduler.observe(thread.id, ticket.updated_on, *(message.created_at for message in discord_notes),
+                                       closed=closed)
+
                 # update the SYNC timestamp
                 # only update if something has changed
-                if dirty_flag:
+                relocated = ticket.channel_id != sync_rec.channel_id
+                if dirty_flag or relocated:
                     sync_rec.last_sync = sync_start
-                    self.redmine.ticket_mgr.update_sync_record(sync_rec)
+                    self.save_sync_record(sync_rec, publish=relocated)
 
                 log.info(f"DONE sync {ticket.id} <-> {thread.name}, took {synctime.age_str(sync_start)}")
                 return True # processed as expected
@@ -301,6 +411,46 @@ class NetBot(commands.Bot):
             log.debug(f"UNLOCK thread - id: {ticket.id}, thread: {thread}")
 
 
+    def get_sync_record(self, ticket: Ticket, thread: discord.Thread) -> synctime.SyncRecord | None:
+        """the sync record for the ticket and thread, from the local store if there is one"""
+        if self.sync_store:
+            return self.sync_store.validate(ticket, expected_channel=thread.id)
+        return ticket.validate_sync_record(expected_channel=thread.id)
+
+
+    def save_sync_record(self, sync_rec: synctime.SyncRecord, publish: bool = False) -> None:
+        """
+        save a sync record. with a local store, it's only written to redmine
+        when published: for a new or relocated thread.
+        """
+        if self.sync_store:
+            self.sync_store.put(sync_rec)
+            if not publish:
+                return
+        self.redmine.ticket_mgr.update_sync_record(sync_rec)
+        # the write changes the ticket's updated_on, but isn't new activity
+        self.sync_writes[sync_rec.ticket_id] = synctime.now()
+
+
+    def remove_sync_record(self, sync_rec: synctime.SyncRecord) -> None:
+        if self.sync_store:
+            self.sync_store.remove(sync_rec.ticket_id)
+        self.redmine.ticket_mgr.remove_sync_record(sync_rec)
+
+
+    def reconcile_sync_store(self) -> int:
+        """merge the sync records in redmine for every ticket thread into the local store"""
+        ticket_ids = sorted({NetBot.parse_thread_title(thread.name) for guild in self.guilds
+                             for thread in guild.threads} - {None})
+        reconciled = 0
+        for start in range(0, len(ticket_ids), RECONCILE_BATCH):
+            batch = ticket_ids[start:start + RECONCILE_BATCH]
+            tickets = self.redmine.ticket_mgr.get_tickets(batch, limit=RECONCILE_BATCH)
+            reconciled += len(self.sync_store.reconcile(*tickets))
+        log.info(f"reconciled {reconciled} sync records for {len(ticket_ids)} threads, {len(self.sync_store)} stored")
+        return reconciled
+
+
     def get_channel_by_name(self, channel_name: str) -> discord.TextChannel:
         for channel in self.get_all_channels():
             if isinstance(channel, discord.TextChannel) and channel_name == channel.name:
@@ -361,40 +511,126 @@ class NetBot(commands.Bot):
         return None
 
 
-    @tasks.loop(minutes=5.0) # to 5.0 minutes. set to 1 min for testing
-    async def sync_all_threads(self):
+    async def sweep_thread(self, thread:discord.Thread) -> None:
+        """sync a thread, counting the result"""
+        try:
+            # try syncing each thread. if there's no ticket found, there's no thread to sync.
+            ticket = await self.sync_thread(thread)
+            if ticket:
+                # successful sync
+                log.debug(f"SYNC complete for ticket #{ticket.id} to {thread.name}")
+                THREADS_SYNCED.inc(result="synced")
+            else:
+                THREADS_SYNCED.inc(result="skipped")
+        except NetbotException as ex:
+            # ticket is locked.
+            # skip gracefully
+            log.debug(str(ex))
+            THREADS_SYNCED.inc(result="locked")
+        except Exception:
+            log.exception(f"Error syncing {thread}")
+            THREADS_SYNCED.inc(result="error")
+
+
+    @tasks.loop(seconds=TICK_SECONDS)
+    async def sync_due_threads(self):
         """
-        Configured to run every minute using the tasks.loop annotation.
-        Get all Threads and sync each one.
+        Sync the ticket threads that are due, most overdue first, within the
+        redmine request budget. Active threads are due every few seconds, idle
+        threads every few hours.
         """
         if not self.run_sync:
             log.debug("SYNC disabled, skipping")
             return
 
-        log.info(f"sync_all_threads: starting for {self.guilds}")
+        threads = {thread.id: thread for guild in self.guilds for thread in guild.threads
+                   if NetBot.parse_thread_title(thread.name)}
+        self.scheduler.track(threads)
+
+        with (accounting.operation("task:sync_due_threads") as op, profiling.profile("task:sync_due_threads"),
+              SYNC_SWEEP_SECONDS.time()):
+            while (thread_id := self.scheduler.next_due()) is not None:
+                calls = op.calls
+                await self.sweep_thread(threads[thread_id])
+                self.scheduler.spend(op.calls - calls)
+            # set here, as the scheduler is only used from the event loop, not the metrics thread
+            THREADS_DUE.set(self.scheduler.overdue())
+
+            await self.archive_closed_threads()
+
+
+    async def archive_closed_threads(self):
+        """archive the threads of closed tickets, once they've been idle for NETBOT_ARCHIVE_AFTER days"""
+        for thread_id in self.scheduler.to_archive():
+            thread = self.get_channel(thread_id)
+            try:
+                if thread and not thread.archived:
+                    await thread.edit(archived=True)
+                    THREADS_ARCHIVED.inc(action="archive")
+                    log.info(f"archived {thread.name}, ticket is closed")
+                # archived threads leave the working set
+                self.scheduler.forget(thread_id)
+            except discord.DiscordException as ex:
+                # try again after another grace period
+                log.warning(f"unable to archive {thread}: {ex}")
+                self.scheduler.observe(thread_id, synctime.now(), closed=True)
+
+
+    @tasks.loop(minutes=1.0)
+    async def sync_updated_tickets(self):
+        """
+        Make the threads of recently updated open tickets due now, so redmine
+        changes sync promptly. Reopened tickets have their threads unarchived.
+        """
+        if not self.run_sync:
+            log.debug("SYNC disabled, skipping")
+            return
 
-        # get all threads
-        for guild in self.guilds:
-            for thread in guild.threads:
-                try:
-                    # try syncing each thread. if there's no ticket found, there's no thread to sync.
-                    ticket = await self.sync_thread(thread)
-                    if ticket:
-                        # successful sync
-                        log.debug(f"SYNC complete for ticket #{ticket.id} to {thread.name}")
-                except NetbotException as ex:
-                    # ticket is locked.
-                    # skip gracefully
-                    log.debug(str(ex))
-                except Exception as ex:
-                    log.exception(f"Error syncing {thread}: {ex}")
+        start = synctime.now()
+        try:
+            with accounting.operation("task:sync_updated_tickets"):
+                tickets = self.redmine.ticket_mgr.updated_since(self.updates_checked)
+        except RedmineException as ex:
+            # checked again from the same time, on the next run
+            log.warning(f"unable to check for updated tickets: {ex}")
+            return
+        self.updates_checked = start
+
+        for ticket in tickets:
+            channel_id = ticket.channel_id
+            written = self.sync_writes.get(ticket.id)
+            if written and ticket.updated_on <= written and self.scheduler.is_open(channel_id):
+                # the only change since then is this bot's own sync record. updated_on is to the
+                # second, so a reopened ticket isn't skipped: its thread is closed or not scheduled.
+                continue
+            if channel_id and not self.scheduler.touch(channel_id):
+                # not in the working set: unarchive it, and it'll be tracked at the next tick
+                await self.unarchive_thread(channel_id)
+
+        # the next check is for tickets updated since start, to the second: earlier writes can't hide them
+        since = start.replace(microsecond=0)
+        self.sync_writes = {ticket_id: written for ticket_id, written in self.sync_writes.items() if written >= since}
+
+
+    async def unarchive_thread(self, thread_id: int) -> discord.Thread | None:
+        """unarchive a thread, for a reopened ticket"""
+        try:
+            thread = await self.fetch_channel(thread_id)
+            if isinstance(thread, discord.Thread) and thread.archived:
+                await thread.edit(archived=False)
+                THREADS_ARCHIVED.inc(action="unarchive")
+                log.info(f"unarchived {thread.name}, ticket was reopened")
+                return thread
+        except discord.DiscordException as ex:
+            log.warning(f"unable to unarchive thread {thread_id}: {ex}")
+        return None
 
 
     def channel_for_ticket(self, ticket: Ticket) -> discord.TextChannel:
         # first, check the syncdata.
         sync = ticket.validate_sync_record()
         if sync and sync.channel_id > 0:
-            thread = self.bot.get_channel(sync.channel_id)
+            thread = self.get_channel(sync.channel_id)
             if thread:
                 return thread
 
@@ -524,8 +760,9 @@ class NetBot(commands.Bot):
             log.debug("SYNC disabled, skipping daily_tasks")
             return
 
-        await self.recycle_tickets()
-        await self.remind_dusty_tickets()
+        with accounting.operation("task:run_daily_tasks"), profiling.profile("task:run_daily_tasks"):
+            await self.recycle_tickets()
+            await self.remind_dusty_tickets()
 
 
     def find_ticket_thread(self, ticket_id:int) -> discord.Thread|None:
@@ -622,7 +859,10 @@ def main():
     log.info(f"loading .env for {__name__}")
     load_dotenv()
 
-    client = Client.fromenv()
+    # optional prometheus endpoint, on METRICS_PORT
+    metrics.MetricsServer.fromenv()
+
+    client = Client.fromenv(snapshot=Snapshot.fromenv())
     bot = NetBot(client)
 
     for arg in sys.argv:
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Diff-based synchronization of Discord roles with Redmine teams"""
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+
+import discord
+import requests
+
+from redmine.model import NamedId, Team
+from redmine.session import RedmineException
+from redmine.users import UserManager
+
+
+log = logging.getLogger(__name__)
+
+
+ROLE_SYNC_CONCURRENCY = 4 # max number of concurrent redmine calls when applying changes
+
+
+@dataclass
+class TeamChange():
+    """a single membership change: add or remove a user from a team"""
+    team: Team
+    user: NamedId
+
+    def __str__(self) -> str:
+        return f"{self.user.name} -> {self.team.name}"
+
+
+@dataclass
+class RoleSyncPlan():
+    """The minimal set of changes needed to align Redmine teams with Discord roles"""
+    adds: list[TeamChange] = field(default_factory=list)
+    removes: list[TeamChange] = field(default_factory=list)
+    missing: list[str] = field(default_factory=list) # role names without a matching team
+    failed: list[TeamChange] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.adds) + len(self.removes)
+
+    def __str__(self) -> str:
+        return f"role sync: +{len(self.adds)} -{len(self.removes)}, missing={len(self.missing)}, failed={len(self.failed)}"
+
+
+class RoleSync():
+    """
+    Synchronize Discord role membership with Redmine team membership.
+
+    Both sides are snapshot once: the Discord side from the guild roles,
+    the Redmine side from the team cache in the UserManager. The difference
+    is applied with a bounded number of concurrent Redmine calls, and the
+    cached teams are updated in place as each change is applied.
+    """
+    def __init__(self, user_mgr: UserManager, concurrency: int = ROLE_SYNC_CONCURRENCY):
+        self.user_mgr = user_mgr
+        self.concurrency = concurrency
+
+
+    def member_user(self, member: discord.Member) -> NamedId | None:
+        """map a discord member to a redmine user, using only the cache"""
+        user = self.user_mgr.cache.find_discord_user(member.name)
+        if user:
+            return NamedId(id=user.id, name=user.name)
+        return None
+
+
+    def discord_snapshot(self, guilds: list[discord.Guild]) -> dict[str, dict[int, NamedId]]:
+        """map of role name -> {redmine user id: user} for all mapped members, over all guilds"""
+        snapshot: dict[str, dict[int, NamedId]] = {}
+        for guild in guilds:
+            for role in guild.roles:
+                members = snapshot.setdefault(role.name, {})
+                for member in role.members:
+                    user = self.member_user(member)
+                    if user:
+                        members[user.id] = user
+        return snapshot
+
+
+    def team_members(self, team: Team) -> set[int]:
+        if team.users:
+            return {named.id for named in team.users}
+        return set()
+
+
+    def plan(self, guilds: list[discord.Guild]) -> RoleSyncPlan:
+        """Compute the add/remove set for all roles in all guilds, with no redmine calls"""
+        plan = RoleSyncPlan()
+
+        for role_name, members in self.discord_snapshot(guilds).items():
+            team = self.user_mgr.cache.get_team_by_name(role_name)
+            if team is None:
+                plan.missing.append(role_name)
+                continue
+
+            current = self.team_members(team)
+            for user_id, user in members.items():
+                if user_id not in current:
+                    plan.adds.append(TeamChange(team, user))
+
+            # noting: anyone in the team and not in the role must have been removed
+            for named in team.users or []:
+                if named.id not in members:
+                    plan.removes.append(TeamChange(team, named))
+
+        return plan
+
+
+    def plan_member(self, before: discord.Member, after: discord.Member) -> RoleSyncPlan:
+        """Compute the changes for a single member, based on a role update"""
+        plan = RoleSyncPlan()
+
+        user = self.member_user(after)
+        if user is None:
+            log.debug(f"role change for unmapped discord user: {after.name}, skipping")
+            return plan
+
+        before_roles = {role.name for role in before.roles}
+        after_roles = {role.name for role in after.roles}
+
+        for role_name in after_roles - before_roles:
+            team = self.user_mgr.cache.get_team_by_name(role_name)
+            if team is None:
+                plan.missing.append(role_name)
+            elif user.id not in self.team_members(team):
+                plan.adds.append(TeamChange(team, user))
+
+        for role_name in before_roles - after_roles:
+            team = self.user_mgr.cache.get_team_by_name(role_name)
+            if team is None:
+                plan.missing.append(role_name)
+            elif user.id in self.team_members(team):
+                plan.removes.append(TeamChange(team, user))
+
+        return plan
+
+
+    async def apply(self, plan: RoleSyncPlan, dry_run: bool = False) -> RoleSyncPlan:
+        """Apply the plan to redmine. With dry_run, nothing is changed."""
+        for role_name in plan.missing:
+            log.debug(f"No team for {role_name}. Create it, please!")
+
+        if dry_run or len(plan) == 0:
+            log.info(f"{plan}, dry_run={dry_run}")
+            return plan
+
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def add(change: TeamChange):
+            async with limit:
+                try:
+                    log.debug(f"adding {change}")
+                    await asyncio.to_thread(self.user_mgr.add_team_member, change.team, change.user.id)
+                    change.team.add_user(change.user)
+                except (RedmineException, requests.RequestException) as ex:
+                    log.warning(f"Unable to add {change}: {ex}")
+                    plan.failed.append(change)
+
+        async def remove(change: TeamChange):
+            async with limit:
+                try:
+                    log.debug(f"removing {change}")
+                    await asyncio.to_thread(self.user_mgr.remove_team_member, change.team, change.user.id)
+                    change.team.users = [named for named in change.team.users if named.id != change.user.id]
+                except (RedmineException, requests.RequestException) as ex:
+                    log.warning(f"Unable to remove {change}: {ex}")
+                    plan.failed.append(change)
+
+        await asyncio.gather(
+            *[add(change) for change in plan.adds],
+            *[remove(change) for change in plan.removes])
+
+        log.info(str(plan))
+        return plan
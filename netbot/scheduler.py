@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Adaptive sync scheduling: hot threads sync within seconds, idle threads back off to hours"""
+
+import os
+import time
+import logging
+import datetime as dt
+from dataclasses import dataclass
+
+from redmine import synctime
+
+
+log = logging.getLogger(__name__)
+
+
+SYNC_MIN_INTERVAL_ENV = "NETBOT_SYNC_MIN_INTERVAL" # seconds between syncs of the most active threads
+SYNC_MAX_INTERVAL_ENV = "NETBOT_SYNC_MAX_INTERVAL" # seconds between syncs of idle threads
+SYNC_BUDGET_ENV = "NETBOT_SYNC_BUDGET" # redmine requests per minute, for scheduled syncs
+ARCHIVE_AFTER_ENV = "NETBOT_ARCHIVE_AFTER" # days after the last activity to archive a closed ticket's thread, 0 to never
+
+DEFAULT_MIN_INTERVAL = 20
+DEFAULT_MAX_INTERVAL = 4 * 60 * 60
+DEFAULT_BUDGET = 60
+DEFAULT_ARCHIVE_AFTER = 7 # days
+IDLE_FRACTION = 0.1 # sync interval, as a fraction of the time since the last activity
+TICK_SECONDS = 10 # how often the scheduler checks for due threads
+
+
+@dataclass
+class Schedule():
+    """when a thread was last active, last synced and is next due"""
+    thread_id: int
+    activity: dt.datetime
+    due: dt.datetime
+    last_sync: dt.datetime | None = None
+    closed: bool = False # the ticket is closed and has had its final sync
+
+
+class SyncScheduler():
+    """
+    Schedule thread syncs by activity.
+
+    Each thread is synced at an interval proportional to how long it has been
+    idle, from the ticket's updated_on and the times of discord messages, between
+    min_interval and max_interval. New discord messages make a thread due right
+    away. The redmine requests made by scheduled syncs are capped at budget per
+    minute; threads that are due when the budget is spent wait for the next tick,
+    most overdue first. Threads for closed tickets are not scheduled after their
+    final sync, until they're reopened or there's new activity.
+    """
+    def __init__(self, min_interval: float = DEFAULT_MIN_INTERVAL, max_interval: float = DEFAULT_MAX_INTERVAL,
+                 budget: float = DEFAULT_BUDGET, archive_after: float = DEFAULT_ARCHIVE_AFTER):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.archive_after = dt.timedelta(days=archive_after) if archive_after > 0 else None
+        self.tokens = float(budget)
+        self.refilled = time.monotonic()
+        self.schedules: dict[int, Schedule] = {}
+
+
+    @classmethod
+    def fromenv(cls) -> "SyncScheduler":
+        return cls(
+            min_interval=float(os.getenv(SYNC_MIN_INTERVAL_ENV, DEFAULT_MIN_INTERVAL)),
+            max_interval=float(os.getenv(SYNC_MAX_INTERVAL_ENV, DEFAULT_MAX_INTERVAL)),
+            budget=float(os.getenv(SYNC_BUDGET_ENV, DEFAULT_BUDGET)),
+            archive_after=float(os.getenv(ARCHIVE_AFTER_ENV, DEFAULT_ARCHIVE_AFTER)),
+        )
+
+
+    def interval(self, activity: dt.datetime, now: dt.datetime) -> dt.timedelta:
+        """the time between syncs of a thread last active at activity"""
+        idle = (now - activity).total_seconds()
+        return dt.timedelta(seconds=min(max(idle * IDLE_FRACTION, self.min_interval), self.max_interval))
+
+
+    def track(self, thread_ids, now: dt.datetime | None = None) -> None:
+        """schedule new threads, due now, and forget threads that are gone"""
+        now = now or synctime.now()
+        current = set(thread_ids)
+        for thread_id in current - self.schedules.keys():
+            self.schedules[thread_id] = Schedule(thread_id, activity=synctime.epoch_datetime(), due=now)
+        for thread_id in self.schedules.keys() - current:
+            del self.schedules[thread_id]
+
+
+    def observe(self, thread_id: int, *activity: dt.datetime | None, closed: bool = False,
+                now: dt.datetime | None = None) -> None:
+        """
+        a thread was synced: reschedule it from the latest activity in redmine and discord.
+        for a closed ticket, that was the final sync.
+        """
+        now = now or synctime.now()
+        schedule = self.schedules.get(thread_id)
+        if schedule is None:
+            schedule = self.schedules[thread_id] = Schedule(thread_id, synctime.epoch_datetime(), now)
+        schedule.activity = max([schedule.activity] + [when for when in activity if when])
+        schedule.last_sync = now
+        schedule.closed = closed
+        schedule.due = now + self.interval(schedule.activity, now)
+        log.debug(f"thread {thread_id} next sync in {(schedule.due - now).total_seconds():.0f}s")
+
+
+    def touch(self, thread_id: int, now: dt.datetime | None = None) -> bool:
+        """new activity in a thread, or its ticket was reopened: make it due now"""
+        schedule = self.schedules.get(thread_id)
+        if schedule:
+            now = now or synctime.now()
+            schedule.activity = now
+            schedule.closed = False
+            schedule.due = min(schedule.due, now)
+            return True
+        return False
+
+
+    def is_closed(self, thread_id: int) -> bool:
+        schedule = self.schedules.get(thread_id)
+        return schedule is not None and schedule.closed
+
+
+    def is_open(self, thread_id: int) -> bool:
+        """the thread is scheduled, for an open ticket"""
+        schedule = self.schedules.get(thread_id)
+        return schedule is not None and not schedule.closed
+
+
+    def to_archive(self, now: dt.datetime | None = None) -> list[int]:
+        """threads for closed tickets, with no activity for archive_after"""
+        if self.archive_after is None:
+            return []
+        now = now or synctime.now()
+        return [schedule.thread_id for schedule in self.schedules.values()
+                if schedule.closed and now - schedule.activity >= self.archive_after]
+
+
+    def forget(self, thread_id: int) -> None:
+        self.schedules.pop(thread_id, None)
+
+
+    def refill(self) -> None:
+        """add the budget for the time since the last refill, up to a minute's worth"""
+        current = time.monotonic()
+        self.tokens = min(self.budget, self.tokens + self.budget * (current - self.refilled) / 60.0)
+        self.refilled = current
+
+
+    def spend(self, calls: int) -> None:
+        """charge the redmine requests made by a sync against the budget"""
+        self.tokens -= max(calls, 1)
+
+
+    def next_due(self, now: dt.datetime | None = None) -> int | None:
+        """
+        the most overdue thread, if there's budget left to sync it.
+        it's rescheduled for min_interval from now, in case the sync fails.
+        """
+        self.refill()
+        if self.tokens < 1:
+            return None
+        now = now or synctime.now()
+        due = [schedule for schedule in self.schedules.values() if schedule.due <= now and not schedule.closed]
+        if not due:
+            return None
+        schedule = min(due, key=lambda s: s.due)
+        schedule.due = now + dt.timedelta(seconds=self.min_interval)
+        return schedule.thread_id
+
+
+    def overdue(self, now: dt.datetime | None = None) -> int:
+        """the number of threads waiting to sync"""
+        now = now or synctime.now()
+        return sum(1 for schedule in self.schedules.values() if schedule.due <= now and not schedule.closed)
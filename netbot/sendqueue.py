@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Ordered, rate-limit aware message sends to discord channels"""
+
+import asyncio
+import logging
+import weakref
+
+import discord
+
+from redmine import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+SEND_RETRIES = 3 # retries of a send that's still rate limited after py-cord's own retries
+SEND_BACKOFF = 1.0 # seconds, doubled for each retry when discord doesn't say how long to wait
+
+MESSAGES_SENT = metrics.counter("netbot_messages_sent_total", "Messages sent to discord by the send queue")
+SENDS_RATE_LIMITED = metrics.counter("netbot_sends_rate_limited_total",
+                                     "Sends to discord retried after a 429 response")
+
+
+def retry_after(ex: discord.HTTPException, attempt: int, backoff: float) -> float:
+    """seconds to wait before retrying a rate limited send, from the response if it says"""
+    headers = getattr(ex.response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return backoff * 2 ** attempt
+
+
+class SendQueue():
+    """
+    Send messages to discord channels, one at a time per channel.
+
+    Discord rate limits message sends per channel, and py-cord already waits
+    on each channel's bucket. Queueing sends per channel keeps messages in
+    order when several tasks post to the same thread, and keeps one channel's
+    burst from holding up the others. A send that's still rate limited after
+    py-cord's own retries is retried here, after Retry-After or a backoff.
+    """
+    def __init__(self, retries: int = SEND_RETRIES, backoff: float = SEND_BACKOFF):
+        self.retries = retries
+        self.backoff = backoff
+        # a channel's lock is dropped once no send holds it or waits on it
+        self.locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+
+    async def send(self, channel: discord.abc.Messageable, *contents: str) -> list[discord.Message]:
+        """send each message to the channel, in order, after any already queued for it"""
+        lock = self.locks.setdefault(channel.id, asyncio.Lock())
+        sent = []
+        async with lock:
+            for content in contents:
+                sent.append(await self.send_one(channel, content))
+        return sent
+
+
+    async def send_one(self, channel: discord.abc.Messageable, content: str) -> discord.Message:
+        attempt = 0
+        while True:
+            try:
+                message = await channel.send(content)
+                MESSAGES_SENT.inc()
+                return message
+            except discord.HTTPException as ex:
+                if ex.status != 429 or attempt >= self.retries:
+                    raise
+                delay = retry_after(ex, attempt, self.backoff)
+                attempt += 1
+                SENDS_RATE_LIMITED.inc()
+                log.warning(f"send to {channel} rate limited, retry {attempt} in {delay:.1f}s")
+                await asyncio.sleep(delay)
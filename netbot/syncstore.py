@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Local, durable sync state for ticket threads, so a sync doesn't have to write to redmine"""
+
+import os
+import sqlite3
+import logging
+import threading
+
+from redmine import synctime
+from redmine.synctime import SyncRecord
+
+
+log = logging.getLogger(__name__)
+
+
+SYNC_DB_ENV = "NETBOT_SYNC_DB"
+RECONCILE_BATCH = 100 # tickets per redmine query, the most redmine returns in a page
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync (
+    ticket_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    last_sync TEXT NOT NULL
+)
+"""
+
+
+class SyncStore():
+    """
+    The channel and last sync time for each ticket, in a local sqlite database.
+
+    The syncdata custom field in redmine remains the shared record of which
+    thread a ticket is synced with, and is written when a thread is created or
+    relocated. The last sync time is only kept here. Records are reconciled
+    with the custom field whenever the ticket is read: a different channel in
+    redmine wins, otherwise the later sync time does.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(SCHEMA)
+
+
+    @classmethod
+    def fromenv(cls) -> "SyncStore | None":
+        """a store at the NETBOT_SYNC_DB path, or None if not configured"""
+        path = os.getenv(SYNC_DB_ENV)
+        if path:
+            return cls(path)
+        return None
+
+
+    def close(self) -> None:
+        self.db.close()
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM sync").fetchone()[0]
+
+
+    def get(self, ticket_id: int) -> SyncRecord | None:
+        with self.lock:
+            row = self.db.execute("SELECT channel_id, last_sync FROM sync WHERE ticket_id = ?", (ticket_id,)).fetchone()
+        if row:
+            return SyncRecord(ticket_id, row[0], synctime.parse_str(row[1]))
+        return None
+
+
+    def put(self, *records: SyncRecord) -> None:
+        """save records, in a single transaction"""
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO sync (ticket_id, channel_id, last_sync) VALUES (?, ?, ?) "
+                "ON CONFLICT(ticket_id) DO UPDATE SET channel_id = excluded.channel_id, last_sync = excluded.last_sync",
+                [(record.ticket_id, record.channel_id, record.last_sync.isoformat()) for record in records])
+
+
+    def remove(self, ticket_id: int) -> None:
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM sync WHERE ticket_id = ?", (ticket_id,))
+
+
+    def merge(self, local: SyncRecord | None, remote: SyncRecord | None) -> SyncRecord | None:
+        """the current record, from the local record and the one in redmine"""
+        if remote is None or remote.channel_id == 0:
+            # no channel in redmine, or a legacy record: the local record, if any
+            return local or remote
+        if local is None or local.channel_id != remote.channel_id:
+            # new to this store, or relocated
+            return remote
+        if remote.last_sync > local.last_sync:
+            return remote
+        return local
+
+
+    def reconcile(self, *tickets) -> list[SyncRecord]:
+        """merge the records of tickets read from redmine into the store, saving any that changed"""
+        merged = []
+        changed = []
+        for ticket in tickets:
+            local = self.get(ticket.id)
+            record = self.merge(local, ticket.get_sync_record())
+            if record:
+                merged.append(record)
+                if local is None or (local.channel_id, local.last_sync) != (record.channel_id, record.last_sync):
+                    changed.append(record)
+        if changed:
+            self.put(*changed)
+        return merged
+
+
+    def validate(self, ticket, expected_channel: int = 0) -> SyncRecord | None:
+        """
+        as Ticket.validate_sync_record, using the reconciled record:
+        a new record if there's none, None if it's for a different channel.
+        """
+        records = self.reconcile(ticket)
+        if not records:
+            return SyncRecord(ticket.id, expected_channel, synctime.epoch_datetime())
+        record = records[0]
+        if record.channel_id == 0:
+            record.channel_id = expected_channel
+            return record
+        if record.channel_id != expected_channel:
+            log.debug(f"channel mismatch: rec={record.channel_id} =/= {expected_channel}")
+            return None
+        return record
@@ -148,4 +148,9 @@ class RedactionQueue:
     def has_pending_jobs(self) -> bool:
         """Check if there are any pending jobs"""
         state = self._load_state()
-        return any(j["status"] == "pending" for j in state["queue"])
\ No newline at end of file
+        return any(j["status"] == "pending" for j in state["queue"])
+
+    def pending_count(self) -> int:
+        """Number of pending jobs"""
+        state = self._load_state()
+        return sum(1 for j in state["queue"] if j["status"] == "pending")
\ No newline at end of file
@@ -106,7 +106,7 @@ class RedactorClient:
 
                 elif response.status_code == 503:
                     # Server busy, retry
-                    log.warning(f"LLM API busy, retrying in {self.re}s...")
+                    log.warning(f"LLM API busy, retrying in {self.retry_delay}s...")
                     if attempt < self.retries:
                         time.sleep(self.retry_delay)
                         continue
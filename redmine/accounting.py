@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Redmine call accounting: count, size and latency of redmine requests, per operation"""
+
+import os
+import re
+import json
+import time
+import bisect
+import logging
+import threading
+import contextvars
+import collections
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from redmine import synctime
+
+
+log = logging.getLogger(__name__)
+
+
+METRICS_FILE_ENV = "NETBOT_METRICS_FILE"
+UNTAGGED = "untagged" # operation name for calls made outside any tagged operation
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0) # seconds, upper bounds
+CALLS_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64) # redmine calls per operation run, upper bounds
+
+ID_REGEX = re.compile(r"/\d+(?=[/.]|$)")
+
+
+def endpoint_template(resource: str) -> str:
+    """the endpoint, without the query and with ids replaced: /issues/{id}.json"""
+    return ID_REGEX.sub("/{id}", resource.split("?", 1)[0])
+
+
+def body_size(data) -> int:
+    """size in bytes of a request body: str, bytes, a file or a requests files tuple"""
+    if isinstance(data, str):
+        return len(data.encode())
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if isinstance(data, dict):
+        return sum(body_size(value[1]) for value in data.values() if isinstance(value, tuple))
+    if hasattr(data, "fileno"):
+        return os.fstat(data.fileno()).st_size
+    return 0
+
+
+class Histogram():
+    """fixed-bucket histogram, as used by prometheus"""
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last is +Inf
+        self.count = 0
+        self.total = 0.0
+
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+    def quantile(self, q: float) -> float:
+        """upper bound of the bucket containing the q-quantile"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+    def as_dict(self) -> dict:
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "buckets": dict(zip(bounds, self.counts)),
+        }
+
+
+@dataclass
+class OperationStats():
+    """aggregated redmine calls for one operation: a command, background task or message"""
+    name: str
+    runs: int = 0
+    calls: int = 0
+    errors: int = 0 # status 0 (no response) or >= 400
+    sent: int = 0 # bytes
+    received: int = 0 # bytes
+    latency: Histogram = field(default_factory=lambda: Histogram(LATENCY_BUCKETS))
+    calls_per_run: Histogram = field(default_factory=lambda: Histogram(CALLS_BUCKETS))
+    endpoints: collections.Counter[str] = field(default_factory=collections.Counter) # "GET /issues/{id}.json" -> count
+    statuses: collections.Counter[int] = field(default_factory=collections.Counter)
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "runs": self.runs,
+            "calls": self.calls,
+            "errors": self.errors,
+            "sent": self.sent,
+            "received": self.received,
+            "latency": self.latency.as_dict(),
+            "calls_per_run": self.calls_per_run.as_dict(),
+            "endpoints": dict(self.endpoints.most_common()),
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+        }
+
+
+@dataclass
+class Operation():
+    """a single run of a tagged operation, carried in a context variable"""
+    name: str
+    calls: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+
+CURRENT: contextvars.ContextVar[Operation | None] = contextvars.ContextVar("redmine_operation", default=None)
+
+
+def current_operation() -> str:
+    op = CURRENT.get()
+    return op.name if op else UNTAGGED
+
+
+class Accounting():
+    """
+    Aggregate redmine calls by operation.
+
+    Operations are tagged with a context variable, so the tag follows the
+    code through awaits and asyncio.to_thread. RedmineSession records every
+    request against the current operation.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations: dict[str, OperationStats] = {}
+        self.since = synctime.now()
+
+
+    def stats(self, name: str) -> OperationStats:
+        """the stats for an operation, created on first use. call with the lock held."""
+        stats = self.operations.get(name)
+        if stats is None:
+            stats = self.operations[name] = OperationStats(name)
+        return stats
+
+
+    @contextmanager
+    def operation(self, name: str):
+        """tag all redmine calls in the block with the operation name"""
+        op = Operation(name)
+        token = CURRENT.set(op)
+        try:
+            yield op
+        finally:
+            CURRENT.reset(token)
+            with self.lock:
+                stats = self.stats(name)
+                stats.runs += 1
+                stats.calls_per_run.observe(op.calls)
+            log.debug(f"{name}: {op.calls} redmine calls in {time.perf_counter() - op.started:.3f}s")
+
+
+    def record(self, method: str, resource: str, status: int, sent: int, received: int, latency: float) -> None:
+        """record a single redmine request against the current operation"""
+        op = CURRENT.get()
+        with self.lock:
+            if op:
+                op.calls += 1
+            stats = self.stats(op.name if op else UNTAGGED)
+            stats.calls += 1
+            if status == 0 or status >= 400:
+                stats.errors += 1
+            stats.sent += sent
+            stats.received += received
+            stats.latency.observe(latency)
+            stats.endpoints[f"{method} {endpoint_template(resource)}"] += 1
+            stats.statuses[status] += 1
+
+
+    def summary(self) -> list[OperationStats]:
+        """all operations, most calls first"""
+        with self.lock:
+            return sorted(self.operations.values(), key=lambda stats: stats.calls, reverse=True)
+
+
+    def reset(self) -> None:
+        with self.lock:
+            self.operations = {}
+            self.since = synctime.now()
+
+
+    def as_dict(self) -> dict:
+        return {
+            "since": synctime.zulu(self.since),
+            "written": synctime.zulu(synctime.now()),
+            "operations": [stats.as_dict() for stats in self.summary()],
+        }
+
+
+    def write(self, path: str) -> None:
+        """write the stats as JSON, replacing the file atomically"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding="utf-8") as file:
+            json.dump(self.as_dict(), file, indent=2)
+        os.replace(tmp_path, path)
+        log.debug(f"wrote redmine call accounting to {path}")
+
+
+# process-wide accounting, shared by all redmine sessions
+ACCOUNTING = Accounting()
+
+
+def operation(name: str):
+    """tag all redmine calls in the block with the operation name"""
+    return ACCOUNTING.operation(name)
+
+
+def write_metrics(path: str | None = None) -> None:
+    """write the process-wide accounting to the metrics file, if one is configured"""
+    path = path or os.getenv(METRICS_FILE_ENV)
+    if path:
+        try:
+            ACCOUNTING.write(path)
+        except OSError as ex:
+            log.warning(f"unable to write metrics file {path}: {ex}")
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""Prometheus-compatible metrics, served as text on a local /metrics endpoint"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections.abc import Callable
+
+from redmine.accounting import Accounting, Histogram, ACCOUNTING, LATENCY_BUCKETS
+
+
+log = logging.getLogger(__name__)
+
+
+METRICS_PORT_ENV = "METRICS_PORT"
+METRICS_HOST_ENV = "METRICS_HOST" # the interface to serve on, 0.0.0.0 for all of them
+DEFAULT_METRICS_HOST = "127.0.0.1"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def label_str(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    """a metric family: a name, help text and a value per set of label values"""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values: dict[tuple, object] = {}
+
+
+    def key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f"{self.name}{label_str(self.labels, key)} {format_value(value)}"
+                    for key, value in self.values.items()]
+
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class Counter(Metric):
+    """a value that only goes up"""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """a value that goes up and down, or is read from a function at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self.functions: dict[tuple, Callable[[], float]] = {}
+
+
+    def set(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        """
+        read the value from function on each scrape. if it raises OSError, ValueError
+        or LookupError (from state it reads, say), the last value is kept.
+        """
+        self.functions[self.key(labels)] = function
+
+
+    def samples(self) -> list[str]:
+        for key, function in self.functions.items():
+            try:
+                value = function()
+            except (OSError, ValueError, LookupError) as ex:
+                log.warning(f"unable to read gauge {self.name}: {ex}")
+                continue
+            with self.lock:
+                self.values[key] = value
+        return super().samples()
+
+
+class HistogramMetric(Metric):
+    """a distribution of observations, in fixed buckets"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+
+    @contextmanager
+    def time(self, **labels):
+        """observe the duration of the block, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return histogram_samples(self.name, self.labels, list(self.values.items()))
+
+
+def histogram_samples(name: str, label_names: tuple, histograms: list[tuple[tuple, Histogram]]) -> list[str]:
+    """the _bucket, _sum and _count samples for labelled histograms"""
+    lines = []
+    for key, histogram in histograms:
+        cumulative = 0
+        bounds = list(histogram.buckets) + [float("inf")]
+        for bound, count in zip(bounds, histogram.counts):
+            cumulative += count
+            le = f'le="{format_value(bound) if bound == float("inf") else bound}"'
+            lines.append(f"{name}_bucket{label_str(label_names, key, le)} {cumulative}")
+        lines.append(f"{name}_sum{label_str(label_names, key)} {format_value(histogram.total)}")
+        lines.append(f"{name}_count{label_str(label_names, key)} {histogram.count}")
+    return lines
+
+
+def accounting_metrics(accounting: Accounting) -> list[str]:
+    """redmine request metrics, read from the call accounting"""
+    operations = accounting.summary()
+    labels = ("operation",)
+    lines = [
+        "# HELP redmine_request_seconds Latency of redmine requests, by operation",
+        "# TYPE redmine_request_seconds histogram",
+    ]
+    lines += histogram_samples("redmine_request_seconds", labels,
+                               [((stats.name,), stats.latency) for stats in operations])
+    lines += [
+        "# HELP redmine_requests_total Redmine requests, by operation and status (0 for no response)",
+        "# TYPE redmine_requests_total counter",
+    ]
+    for stats in operations:
+        for status, count in sorted(stats.statuses.items()):
+            lines.append(f"redmine_requests_total{label_str(('operation', 'status'), (stats.name, status))} {count}")
+    lines += [
+        "# HELP redmine_request_errors_total Failed redmine requests, by operation",
+        "# TYPE redmine_request_errors_total counter",
+    ]
+    lines += [f"redmine_request_errors_total{label_str(labels, (stats.name,))} {stats.errors}" for stats in operations]
+    lines += [
+        "# HELP redmine_request_bytes_total Bytes sent and received in redmine requests, by operation",
+        "# TYPE redmine_request_bytes_total counter",
+    ]
+    for stats in operations:
+        lines.append(f"redmine_request_bytes_total{label_str(('operation', 'direction'), (stats.name, 'sent'))} {stats.sent}")
+        lines.append(f"redmine_request_bytes_total{label_str(('operation', 'direction'), (stats.name, 'received'))} {stats.received}")
+    lines += [
+        "# HELP redmine_operation_runs_total Runs of each tagged operation",
+        "# TYPE redmine_operation_runs_total counter",
+    ]
+    lines += [f"redmine_operation_runs_total{label_str(labels, (stats.name,))} {stats.runs}" for stats in operations]
+    return lines
+
+
+class Registry():
+    """the metrics for a process, rendered in the prometheus text format"""
+    def __init__(self, accounting: Accounting | None = None):
+        self.metrics: dict[str, Metric] = {}
+        self.accounting = accounting
+
+
+    def register(self, metric: Metric) -> Metric:
+        existing = self.metrics.get(metric.name)
+        if existing:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+
+    def gauge(self, name: str, documentation: str, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> HistogramMetric:
+        return self.register(HistogramMetric(name, documentation, labels, buckets))
+
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        if self.accounting:
+            lines.extend(accounting_metrics(self.accounting))
+        return "\n".join(lines) + "\n"
+
+
+# process-wide registry, including the redmine call accounting
+REGISTRY = Registry(ACCOUNTING)
+
+
+def counter(name: str, documentation: str, labels: tuple = ()) -> Counter:
+    return REGISTRY.counter(name, documentation, labels)
+
+
+def gauge(name: str, documentation: str, labels: tuple = ()) -> Gauge:
+    return REGISTRY.gauge(name, documentation, labels)
+
+
+def histogram(name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> HistogramMetric:
+    return REGISTRY.histogram(name, documentation, labels, buckets)
+
+
+# cache hit ratios, shared by netbot and the threader
+CACHE_REQUESTS = counter("cache_requests_total", "Cache lookups, by cache and result (hit or miss)", ("cache", "result"))
+
+
+class MetricsServer():
+    """serve a registry on http://host:port/metrics, from a background thread"""
+    def __init__(self, registry: Registry = REGISTRY, port: int = 0, host: str = DEFAULT_METRICS_HOST):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.httpd: ThreadingHTTPServer | None = None
+        self.thread: threading.Thread | None = None
+
+
+    @classmethod
+    def fromenv(cls) -> "MetricsServer | None":
+        """a started server on METRICS_HOST and METRICS_PORT, or None if the port isn't set"""
+        port = os.getenv(METRICS_PORT_ENV)
+        if not port:
+            return None
+        server = cls(port=int(port), host=os.getenv(METRICS_HOST_ENV, DEFAULT_METRICS_HOST))
+        server.start()
+        return server
+
+
+    def start(self) -> str:
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            """GET /metrics"""
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log.debug(fmt % args)
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        url = f"http://{self.host}:{self.port}/metrics"
+        log.info(f"serving metrics at {url}")
+        return url
+
+
+    def stop(self) -> None:
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
@@ -2,7 +2,10 @@
 contains all the dataclass and models for redmine
 """
 
+import io
+import hashlib
 import logging
+import tempfile
 import dataclasses
 from dataclasses import dataclass
 import datetime as dt
@@ -14,16 +17,69 @@ from redmine import synctime
 log = logging.getLogger(__name__)
 
 
+SPOOL_THRESHOLD = 1024 * 1024 # bytes, larger attachments are spooled to a temporary file
+
 # Parsing compound forwarded emails messages is more complex than expected, so
 # Message will represent everything needed for creating and updating tickets,
 # including attachments.
 class Attachment():
-    """email attachment"""
-    def __init__(self, name:str, content_type:str, payload):
+    """email attachment, spooled to a temporary file when it's larger than spool_threshold"""
+    def __init__(self, name:str, content_type:str, payload:bytes|None = None,
+                 spool_threshold:int = SPOOL_THRESHOLD):
         self.name = name
         self.content_type = content_type
-        self.payload = payload
+        self.spool_threshold = spool_threshold
+        self.buffer = io.BytesIO()
+        self.file = None # the temporary file, once spooled
+        self.size = 0
+        self.sha256 = hashlib.sha256()
         self.token = None
+        self.skip = None # why the attachment isn't uploaded, if it isn't
+        if payload:
+            self.write(payload)
+
+    def write(self, data:bytes) -> int:
+        """append decoded content, moving it all to a temporary file once it's over the threshold"""
+        if self.file is None and self.size + len(data) > self.spool_threshold:
+            # the attachment owns the file, it's removed by close()
+            self.file = tempfile.TemporaryFile(prefix="attachment-") # noqa: SIM115
+            self.file.write(self.buffer.getbuffer())
+            self.buffer = None
+        written = (self.file or self.buffer).write(data)
+        self.size += written
+        self.sha256.update(data)
+        return written
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 of the content, as hex"""
+        return self.sha256.hexdigest()
+
+    @property
+    def spooled(self) -> bool:
+        return self.file is not None
+
+    def content(self):
+        """the content to upload: bytes, or the temporary file positioned at the start to stream it from"""
+        if self.file:
+            self.file.seek(0)
+            return self.file
+        return self.buffer.getvalue()
+
+    @property
+    def payload(self) -> bytes:
+        content = self.content()
+        return content if isinstance(content, bytes) else content.read()
+
+    def close(self):
+        """discard the content, removing the temporary file if there is one"""
+        if self.file:
+            self.file.close()
+        self.buffer = None
+
+    @property
+    def closed(self) -> bool:
+        return self.buffer is None and (self.file is None or self.file.closed)
 
     def set_token(self, token):
         self.token = token
@@ -37,6 +93,8 @@ class Message():
     subject:str
     attachments: list[Attachment]
     note: str
+    message_id: str | None
+    references: list[str]
 
     def __init__(self, from_addr:str, subject:str, to:str = None, cc:str = None):
         self.from_address = from_addr
@@ -45,6 +103,14 @@ class Message():
         self.cc = cc
         self.attachments = []
         self.note = ""
+        self.message_id = None
+        self.references = []
+
+    def set_thread(self, message_id:str|None, in_reply_to:str|None, references:str|None):
+        """the Message-ID of the email, and the ids of the emails it replies to, most recent first"""
+        self.message_id = str(message_id).strip() if message_id else None
+        ids = re.findall(r'<[^<>\s]+>', str(in_reply_to or "")) + re.findall(r'<[^<>\s]+>', str(references or ""))[::-1]
+        self.references = list(dict.fromkeys(ids))
 
     # Note: note containts the text of the message, the body of the email
     def set_note(self, note:str):
@@ -53,6 +119,11 @@ class Message():
     def add_attachment(self, attachment:Attachment):
         self.attachments.append(attachment)
 
+    def close_attachments(self):
+        """discard the content of the attachments, once they're uploaded"""
+        for attachment in self.attachments:
+            attachment.close()
+
     def subject_cleaned(self) -> str:
         # strip any re: and forwarded from a subject line
         # from: https://stackoverflow.com/questions/9153629/regex-code-for-removing-fwd-re-etc-from-email-subject
@@ -369,6 +440,7 @@ class ParentTicket:
 SYNC_FIELD_NAME = "syncdata"
 TO_CC_FIELD_NAME = "To/CC"
 REDACTOR_FIELD_NAME = "unredacted"
+TRACE_FIELD_NAME = "trace-id"
 
 
 @dataclass
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""In-memory prefix index, for fast autocomplete"""
+
+import re
+import bisect
+import logging
+import threading
+from collections.abc import Iterable
+
+
+log = logging.getLogger(__name__)
+
+
+MAX_RESULTS = 25 # discord autocomplete returns at most 25 choices
+TERM_SPLIT_REGEX = re.compile(r"[\s@._\-#:/|,()\[\]]+")
+
+
+class PrefixIndex():
+    """
+    Case-insensitive prefix index of string values.
+
+    Each value is indexed by one or more texts, under the full text and under
+    every word in the text, so "smi" matches both "smith" and "john.smith@example.com".
+    Terms are kept in a sorted list and searched with bisect, so a lookup is
+    O(log n) plus the number of results. Changes and searches hold the lock,
+    so a search from another thread never sees the list part way through an insert.
+    """
+    def __init__(self):
+        self.entries: list[tuple[str, str]] = [] # sorted (term, value)
+        self.lock = threading.RLock() # held across a remove and add to replace a value
+
+
+    @staticmethod
+    def terms(text: str) -> set[str]:
+        """the full text and all the words in it, lowercase"""
+        if not text:
+            return set()
+        text = str(text).lower().strip()
+        terms = {term for term in TERM_SPLIT_REGEX.split(text) if term}
+        terms.add(text)
+        return terms
+
+
+    @classmethod
+    def build(cls, items: Iterable[tuple[str, Iterable[str]]]) -> "PrefixIndex":
+        """build an index from (value, texts) pairs, sorting once"""
+        index = cls()
+        entries = set()
+        for value, texts in items:
+            for text in texts:
+                for term in cls.terms(text):
+                    entries.add((term, value))
+        index.entries = sorted(entries)
+        return index
+
+
+    def add(self, value: str, *texts: str) -> None:
+        entries = {(term, value) for text in texts for term in self.terms(text)}
+        with self.lock:
+            for entry in entries:
+                i = bisect.bisect_left(self.entries, entry)
+                if i == len(self.entries) or self.entries[i] != entry:
+                    self.entries.insert(i, entry)
+
+
+    def remove(self, value: str, *texts: str) -> None:
+        entries = {(term, value) for text in texts for term in self.terms(text)}
+        with self.lock:
+            for entry in entries:
+                i = bisect.bisect_left(self.entries, entry)
+                if i < len(self.entries) and self.entries[i] == entry:
+                    del self.entries[i]
+
+
+    def search(self, prefix: str, limit: int = MAX_RESULTS) -> list[str]:
+        """values with a term starting with the prefix, falling back to a substring match"""
+        prefix = str(prefix or "").lower().strip()
+        with self.lock:
+            return self.matches(prefix, limit)
+
+
+    def matches(self, prefix: str, limit: int) -> list[str]:
+        results: dict[str, None] = {} # insertion-ordered set
+
+        i = bisect.bisect_left(self.entries, (prefix,))
+        while i < len(self.entries) and len(results) < limit:
+            term, value = self.entries[i]
+            if not term.startswith(prefix):
+                break
+            results[value] = None
+            i += 1
+
+        if not results:
+            # nothing starts with it, try a looser match
+            for term, value in self.entries:
+                if prefix in term:
+                    results[value] = None
+                    if len(results) >= limit:
+                        break
+
+        return list(results)
+
+
+    def __len__(self) -> int:
+        return len(self.entries)
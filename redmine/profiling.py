@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Opt-in profiling of commands and background tasks, with cProfile and tracemalloc"""
+
+import io
+import os
+import re
+import pstats
+import random
+import logging
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+from redmine import synctime
+
+
+log = logging.getLogger(__name__)
+
+
+PROFILE_ENV = "NETBOT_PROFILE" # "on" to profile from startup
+PROFILE_DIR_ENV = "NETBOT_PROFILE_DIR"
+PROFILE_SAMPLE_ENV = "NETBOT_PROFILE_SAMPLE" # fraction of runs to profile
+PROFILE_MEMORY_ENV = "NETBOT_PROFILE_MEMORY" # "on" to include tracemalloc
+
+DEFAULT_PROFILE_DIR = "profiles"
+PROFILE_TOP_N = 30 # functions and allocation sites in each dump
+MAX_PROFILE_FILES = 200 # oldest dumps are removed beyond this
+TRACEMALLOC_FRAMES = 10
+
+TRUE_VALUES = ("1", "on", "true", "yes")
+
+
+def safe_name(name: str) -> str:
+    """an operation name as a file name: /ticket query -> ticket-query"""
+    return re.sub(r"[^\w.-]+", "-", name).strip("-") or "operation"
+
+
+class Profiler():
+    """
+    Profile tagged operations, when enabled.
+
+    When disabled, profile() costs a single flag check. When enabled, a
+    sample of runs are profiled with cProfile, and optionally tracemalloc,
+    and the top functions and allocation sites are written to a file per run.
+    cProfile can only profile one run at a time, so overlapping runs are
+    skipped rather than nested.
+    """
+    def __init__(self, directory: str = DEFAULT_PROFILE_DIR, sample: float = 1.0,
+                 memory: bool = False, top_n: int = PROFILE_TOP_N, max_files: int = MAX_PROFILE_FILES):
+        self.directory = directory
+        self.sample = sample
+        self.memory = memory
+        self.top_n = top_n
+        self.max_files = max_files
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.active: str | None = None # the operation being profiled
+        self.profiled = 0
+        self.skipped = 0
+        self.last_file: str | None = None
+
+
+    @classmethod
+    def fromenv(cls) -> "Profiler":
+        profiler = cls(
+            directory=os.getenv(PROFILE_DIR_ENV, DEFAULT_PROFILE_DIR),
+            sample=float(os.getenv(PROFILE_SAMPLE_ENV, "1.0")),
+            memory=os.getenv(PROFILE_MEMORY_ENV, "").lower() in TRUE_VALUES,
+        )
+        if os.getenv(PROFILE_ENV, "").lower() in TRUE_VALUES:
+            profiler.enable()
+        return profiler
+
+
+    def enable(self, memory: bool | None = None) -> None:
+        if memory is not None:
+            self.memory = memory
+        os.makedirs(self.directory, exist_ok=True)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.enabled = True
+        log.info(f"profiling enabled: dir={self.directory}, sample={self.sample}, memory={self.memory}")
+
+
+    def disable(self) -> None:
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        log.info(f"profiling disabled, profiled {self.profiled} runs")
+
+
+    def status(self) -> str:
+        if not self.enabled:
+            return "Profiling is off"
+        memory = ", with memory" if self.memory else ""
+        last = f", last: {self.last_file}" if self.last_file else ""
+        return (f"Profiling is on{memory}, sampling {self.sample:.0%} of runs to {self.directory}: "
+                f"{self.profiled} profiled, {self.skipped} skipped{last}")
+
+
+    def acquire(self, name: str) -> bool:
+        """claim the profiler for a run, if it's free and the run is sampled"""
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return False
+        with self.lock:
+            if self.active:
+                self.skipped += 1
+                log.debug(f"profiling {self.active}, skipping {name}")
+                return False
+            self.active = name
+            return True
+
+
+    @contextmanager
+    def profile(self, name: str):
+        """profile the block, if profiling is enabled"""
+        if not self.enabled or not self.acquire(name):
+            yield
+            return
+
+        memory = self.memory and tracemalloc.is_tracing()
+        before = tracemalloc.take_snapshot() if memory else None
+        profile = cProfile.Profile()
+        start = synctime.now()
+        try:
+            profile.enable()
+            try:
+                yield
+            finally:
+                # failed runs are dumped too
+                profile.disable()
+                after = tracemalloc.take_snapshot() if memory else None
+                self.dump(name, start, profile, before, after)
+        finally:
+            with self.lock:
+                self.active = None
+                self.profiled += 1
+
+
+    def report(self, name: str, start, profile: cProfile.Profile, before=None, after=None) -> str:
+        """top functions by cumulative time, and top allocation sites"""
+        buffer = io.StringIO()
+        buffer.write(f"{name} at {synctime.zulu(start)}, took {synctime.age(start).total_seconds():.3f}s\n\n")
+        stats = pstats.Stats(profile, stream=buffer)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top_n)
+        if before and after:
+            buffer.write(f"Top {self.top_n} allocation sites:\n")
+            for stat in after.compare_to(before, "lineno")[:self.top_n]:
+                buffer.write(f"{stat}\n")
+        return buffer.getvalue()
+
+
+    def dump(self, name: str, start, profile: cProfile.Profile, before=None, after=None) -> str | None:
+        path = os.path.join(self.directory, f"{safe_name(name)}-{start.strftime('%Y%m%dT%H%M%S.%f')}.txt")
+        try:
+            with open(path, 'w', encoding="utf-8") as file:
+                file.write(self.report(name, start, profile, before, after))
+            self.last_file = path
+            log.info(f"wrote profile for {name} to {path}")
+            self.prune()
+            return path
+        except OSError as ex:
+            log.warning(f"unable to write profile {path}: {ex}")
+            return None
+
+
+    def prune(self) -> None:
+        """remove the oldest dumps, beyond max_files"""
+        files = sorted((os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                        if name.endswith(".txt")), key=os.path.getmtime)
+        for path in files[:max(len(files) - self.max_files, 0)]:
+            os.remove(path)
+
+
+# process-wide profiler, off unless NETBOT_PROFILE is set or it's turned on with /scn profile
+PROFILER = Profiler.fromenv()
+
+
+def profile(name: str):
+    """profile the block, if profiling is enabled"""
+    return PROFILER.profile(name)
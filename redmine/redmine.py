@@ -2,10 +2,13 @@ import os
 import re
 import logging
 
+from redmine import accounting
 from redmine.session import RedmineSession
 from redmine.model import Message, Ticket, User, NamedId
 from redmine.users import UserManager
 from redmine.tickets import TicketManager, SCN_PROJECT_ID
+from redmine.snapshot import Snapshot
+from redmine.warmup import Warmup, WarmupReport
 
 
 log = logging.getLogger(__name__)
@@ -27,26 +30,49 @@ class RedmineException(Exception):
         self.request_id = request_id
 
 
+def warm_up(user_mgr:UserManager, ticket_mgr:TicketManager) -> WarmupReport:
+    """load all the user and ticket caches concurrently"""
+    warmup = Warmup()
+    warmup.add("tickets", ticket_mgr.reindex_tasks())
+    warmup.add("users", user_mgr.reindex_tasks())
+    return warmup.run()
+
+
 class Client():
     """redmine client"""
-    def __init__(self, session:RedmineSession, user_mgr:UserManager, ticket_mgr:TicketManager):
+    def __init__(self, session:RedmineSession, user_mgr:UserManager, ticket_mgr:TicketManager,
+                 snapshot:Snapshot|None = None, warm_start:bool = False):
         self.url = session.url
         self.session = session
         self.user_mgr = user_mgr
         self.ticket_mgr = ticket_mgr
+        self.snapshot = snapshot
+        self.warm_start = warm_start # caches loaded from snapshot, not yet revalidated
+        self.warmup_report: WarmupReport | None = None # timing of the last full load
 
         self.validate_sanity() 
 
     @classmethod
-    def from_session(cls, session:RedmineSession, default_project:int):
-        user_mgr = UserManager(session)
-        ticket_mgr = TicketManager(session, default_project=default_project)
+    def from_session(cls, session:RedmineSession, default_project:int, snapshot:Snapshot|None = None):
+        user_mgr = UserManager(session, reindex=False)
+        ticket_mgr = TicketManager(session, default_project=default_project, reindex=False)
 
-        return cls(session, user_mgr, ticket_mgr)
+        # warm start from the snapshot, if there is a valid one.
+        warm_start = snapshot is not None and snapshot.restore(user_mgr, ticket_mgr)
+        report = None
+        if not warm_start:
+            with accounting.operation("startup"):
+                report = warm_up(user_mgr, ticket_mgr)
+            if snapshot:
+                snapshot.save(user_mgr, ticket_mgr)
+
+        client = cls(session, user_mgr, ticket_mgr, snapshot, warm_start)
+        client.warmup_report = report
+        return client
 
 
     @classmethod
-    def fromenv(cls):
+    def fromenv(cls, snapshot:Snapshot|None = None):
         url = os.getenv('REDMINE_URL')
         if url is None:
             raise RedmineException("Unable to load REDMINE_URL")
@@ -57,12 +83,15 @@ class Client():
 
         default_project = int(os.getenv("DEFAULT_PROJECT_ID", default=str(SCN_PROJECT_ID)))
 
-        return cls.from_session(RedmineSession(url, token), default_project)
+        return cls.from_session(RedmineSession(url, token), default_project, snapshot)
 
 
     def reindex(self):
-        self.ticket_mgr.reindex()
-        self.user_mgr.reindex()
+        self.warmup_report = warm_up(self.user_mgr, self.ticket_mgr)
+        self.warm_start = False
+
+        if self.snapshot:
+            self.snapshot.save(self.user_mgr, self.ticket_mgr)
 
 
     def sanity_check(self) -> dict[str, bool]:
@@ -112,8 +141,9 @@ class Client():
         log.info(f"Creating ticket with project={project_id} and tracker={tracker.id}")
         ticket = self.ticket_mgr.create(user, message, project_id=project_id, tracker_id=tracker.id)
 
-        # check user status, reject the ticket if blocked
-        if self.user_mgr.is_blocked(user):
+        # check user status, reject the ticket if blocked. the threader has already
+        # dropped mail from blocked senders, so this is checked against the cached team
+        if self.user_mgr.blocked.is_blocked(user):
             log.debug(f"Rejecting ticket #{ticket.id} based on blocked user {user.login}")
             ticket = self.ticket_mgr.reject_ticket(ticket.id)
 
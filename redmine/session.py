@@ -2,6 +2,7 @@
 """redmine client"""
 
 import os
+import time
 import logging
 
 from urllib3.exceptions import ConnectTimeoutError
@@ -10,6 +11,8 @@ from requests.exceptions import ConnectTimeout
 
 import dotenv
 
+from redmine.accounting import Accounting, ACCOUNTING, body_size
+
 log = logging.getLogger(__name__)
 
 
@@ -28,12 +31,14 @@ class RedmineSession():
     url: str
     token: str
     session: requests.Session
+    accounting: Accounting
 
     """redmine session"""
-    def __init__(self, url: str, token: str):
+    def __init__(self, url: str, token: str, accounting: Accounting = ACCOUNTING):
         self.url = url
         self.token = token
         self.session = requests.Session()
+        self.accounting = accounting
 
 
     @classmethod
@@ -67,12 +72,27 @@ class RedmineSession():
         return headers
 
 
+    def request(self, method: str, resource: str, **kwargs) -> requests.Response:
+        """send a request to redmine, accounted to the current operation"""
+        status = 0
+        received = 0
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, f"{self.url}{resource}", timeout=TIMEOUT, **kwargs)
+            status = r.status_code
+            received = len(r.content)
+            return r
+        finally:
+            sent = body_size(kwargs.get("data")) + body_size(kwargs.get("files"))
+            self.accounting.record(method, resource, status, sent, received, time.perf_counter() - start)
+
+
     def get(self, query:str, impersonate_id:str|None=None):
         """run a query against a redmine instance"""
         headers = self.get_headers(impersonate_id)
         try:
             log.debug(f"GET url={self.url}{query}, headers={headers}")
-            r = self.session.get(f"{self.url}{query}", headers=headers, timeout=TIMEOUT)
+            r = self.request("GET", query, headers=headers)
 
             if r.ok:
                 return r.json()
@@ -88,10 +108,9 @@ class RedmineSession():
 
 
     def put(self, resource: str, data:str, impersonate_id:str|None=None) -> None:
-        r = self.session.put(f"{self.url}{resource}",
-                             data=data,
-                             timeout=TIMEOUT,
-                             headers=self.get_headers(impersonate_id))
+        r = self.request("PUT", resource,
+                         data=data,
+                         headers=self.get_headers(impersonate_id))
         if r.ok:
             log.debug(f"PUT {resource}: {data}")
         else:
@@ -102,11 +121,10 @@ class RedmineSession():
     def post(self, resource: str, data:str, user_login: str|None = None, files: list|None = None) -> dict|None:
         log.debug(f"POST {resource} : {data}")
 
-        r = self.session.post(f"{self.url}{resource}",
-                              data=data,
-                              files=files,
-                              timeout=TIMEOUT,
-                              headers=self.get_headers(user_login))
+        r = self.request("POST", resource,
+                         data=data,
+                         files=files,
+                         headers=self.get_headers(user_login))
 
         if r.status_code == 204:
             return None
@@ -117,10 +135,7 @@ class RedmineSession():
 
 
     def delete(self, resource: str) -> None:
-        r = self.session.delete(
-            url=f"{self.url}{resource}",
-            timeout=TIMEOUT,
-            headers=self.get_headers())
+        r = self.request("DELETE", resource, headers=self.get_headers())
 
         if not r.ok:
             raise RedmineException(f"DELETE failed, status=[{r.status_code}] {r.reason}", r.headers['X-Request-Id'])
@@ -139,10 +154,9 @@ class RedmineSession():
             'X-Redmine-Switch-User': user_login, # Make sure the comment is noted by the correct user
         }
 
-        r = self.session.post(
-            url=f"{self.url}/uploads.json?filename={filename}",
-            timeout=TIMEOUT,
-            files={ 'upload_file': (filename, data, content_type) },
+        # data is bytes, or a file that's streamed as the request body
+        r = self.request("POST", f"/uploads.json?filename={filename}",
+            data=data,
             headers=headers)
 
         # 201 response: {"upload":{"token":"7167.ed1ccdb093229ca1bd0b043618d88743"}}
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Versioned on-disk snapshot of the redmine caches, for fast warm starts"""
+
+import os
+import json
+import logging
+import dataclasses
+
+from redmine.model import NamedId, Team, TicketStatus, User
+from redmine.users import UserManager
+from redmine.tickets import TicketManager
+from redmine import synctime
+
+
+log = logging.getLogger(__name__)
+
+
+SNAPSHOT_VERSION = 1 # increment when the format changes, older snapshots are ignored
+SNAPSHOT_ENV = "NETBOT_SNAPSHOT"
+
+
+class Snapshot():
+    """
+    Save and restore the user and ticket manager caches:
+    users, teams, roles, priorities, statuses, trackers, custom fields and programs.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+
+    @classmethod
+    def fromenv(cls):
+        """build a snapshot from the NETBOT_SNAPSHOT path, or None if not configured"""
+        path = os.getenv(SNAPSHOT_ENV)
+        if path:
+            return cls(path)
+        return None
+
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+
+    def save(self, user_mgr: UserManager, ticket_mgr: TicketManager) -> None:
+        cache = user_mgr.cache
+        data = {
+            'version': SNAPSHOT_VERSION,
+            'created_on': synctime.zulu(synctime.now()),
+            'users': [user.asdict() for user in cache.user_ids.values() if isinstance(user, User)],
+            'teams': [dataclasses.asdict(team) for team in cache.teams.values()],
+            'roles': cache.roles,
+            'priorities': [dataclasses.asdict(named) for named in ticket_mgr.priorities.values()],
+            'statuses': [dataclasses.asdict(status) for status in ticket_mgr.statuses.values()],
+            'trackers': [dataclasses.asdict(named) for named in ticket_mgr.trackers.values()],
+            'custom_fields': [dataclasses.asdict(named) for named in ticket_mgr.custom_fields.values()],
+            'programs': ticket_mgr.programs,
+            'default_program': ticket_mgr.default_program,
+        }
+
+        # write-and-rename, so a crash mid-write never leaves a partial snapshot
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding="utf-8") as file:
+            json.dump(data, file, default=str)
+        os.replace(tmp_path, self.path)
+        log.info(f"saved snapshot of {len(data['users'])} users and {len(data['teams'])} teams to {self.path}")
+
+
+    def load(self) -> dict | None:
+        """load the raw snapshot, or None if it's missing, corrupt or the wrong version"""
+        try:
+            with open(self.path, 'r', encoding="utf-8") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            log.info(f"No snapshot found: {self.path}")
+            return None
+        except (OSError, json.JSONDecodeError) as ex:
+            log.warning(f"Unable to read snapshot {self.path}: {ex}")
+            return None
+
+        if data.get('version') != SNAPSHOT_VERSION:
+            log.info(f"Ignoring snapshot version {data.get('version')}, expected {SNAPSHOT_VERSION}")
+            return None
+
+        return data
+
+
+    def restore(self, user_mgr: UserManager, ticket_mgr: TicketManager) -> bool:
+        """restore the managers' caches from the snapshot. returns False if not restored."""
+        data = self.load()
+        if data is None:
+            return False
+
+        try:
+            users = [User(**user) for user in data['users']]
+            teams = {team['name']: Team(**team) for team in data['teams']}
+            priorities = {named['name']: NamedId(**named) for named in data['priorities']}
+            statuses = {status['name']: TicketStatus(**status) for status in data['statuses']}
+            trackers = {named['name']: NamedId(**named) for named in data['trackers']}
+            custom_fields = {named['name']: NamedId(**named) for named in data['custom_fields']}
+        except (KeyError, TypeError) as ex:
+            log.warning(f"Invalid snapshot {self.path}: {ex}")
+            return False
+
+        user_mgr.cache.cache_users(users)
+        user_mgr.cache.cache_teams(teams)
+        user_mgr.cache.roles = data['roles']
+
+        ticket_mgr.priorities = priorities
+        ticket_mgr.statuses = statuses
+        ticket_mgr.cache_trackers(trackers)
+        ticket_mgr.custom_fields = custom_fields
+        ticket_mgr.programs = data['programs']
+        ticket_mgr.default_program = data['default_program']
+
+        log.info(f"restored {len(users)} users and {len(teams)} teams from snapshot created {data['created_on']}")
+        return True
@@ -6,10 +6,14 @@ import logging
 import re
 import json
 import urllib.parse
+from collections import OrderedDict
+from collections.abc import Callable
 
-from redmine.model import TO_CC_FIELD_NAME, TimeEntry, TimeEntryResults, User, Message, NamedId, Team, Ticket, TicketNote, TicketsResult, TicketStatus, SYNC_FIELD_NAME
+from redmine.model import TO_CC_FIELD_NAME, TimeEntry, TimeEntryResults, User, Message, NamedId, Team, Ticket, TicketNote, TicketsResult, TicketStatus, SYNC_FIELD_NAME, TRACE_FIELD_NAME
 from redmine.session import RedmineSession, RedmineException
-from redmine import synctime
+from redmine.prefix import PrefixIndex, MAX_RESULTS
+from redmine.uploads import UploadCache, is_junk, JUNK, ATTACHED
+from redmine import synctime, tracing
 
 
 log = logging.getLogger(__name__)
@@ -28,10 +32,48 @@ TICKET_DUSTY_AGE = 7 # days
 TICKET_MAX_AGE = 7 * 3 # 3 weeks; 21 days
 #TICKET_EXPIRE_NOTIFY = TICKET_MAX_AGE - 1 # 20 days, one day shorter than MAX_AGE
 
+MAX_RECENT_TICKETS = 500 # tickets kept for autocomplete
+
+
+class RecentTickets():
+    """bounded, prefix-indexed set of recently seen ticket ids and subjects"""
+    def __init__(self, max_size:int = MAX_RECENT_TICKETS):
+        self.max_size = max_size
+        self.tickets: OrderedDict[int, str] = OrderedDict() # id -> subject, oldest first
+        self.index = PrefixIndex()
+
+
+    def add(self, ticket:Ticket) -> None:
+        if ticket is None:
+            return
+        subject = self.tickets.pop(ticket.id, None)
+        if subject is not None and subject != ticket.subject:
+            self.index.remove(str(ticket.id), subject)
+        self.tickets[ticket.id] = ticket.subject
+        self.index.add(str(ticket.id), str(ticket.id), ticket.subject)
+
+        while len(self.tickets) > self.max_size:
+            ticket_id, subject = self.tickets.popitem(last=False)
+            self.index.remove(str(ticket_id), str(ticket_id), subject)
+
+
+    def add_all(self, tickets:list[Ticket]) -> None:
+        for ticket in tickets or []:
+            self.add(ticket)
+
+
+    def search(self, prefix:str, limit:int = MAX_RESULTS) -> list[tuple[int, str]]:
+        """(id, subject) of recent tickets with an id or subject word matching the prefix"""
+        return [(int(ticket_id), self.tickets[int(ticket_id)]) for ticket_id in self.index.search(prefix, limit)]
+
+
+    def __len__(self) -> int:
+        return len(self.tickets)
+
 
 class TicketManager():
     """manage redmine tickets"""
-    def __init__(self, session: RedmineSession, default_project:int):
+    def __init__(self, session: RedmineSession, default_project:int, reindex: bool = True):
         self.session: RedmineSession = session
         self.priorities = {}
         self.trackers = {}
@@ -40,15 +82,62 @@ class TicketManager():
         self.programs = {} # grants and tracked SCN projects
         self.default_project:int = default_project
         self.default_program:int = -1
+        self.tracker_index = PrefixIndex()
+        self.recent = RecentTickets()
+        self.uploads = UploadCache()
 
-        self.reindex()
+        if reindex:
+            self.reindex()
 
 
     def reindex(self):
+        for task in self.reindex_tasks().values():
+            task()
+
+
+    def reindex_tasks(self) -> dict[str, Callable[[], None]]:
+        """the independent loads that make up a reindex, by name"""
+        return {
+            'priorities': self.reindex_priorities,
+            'statuses': self.reindex_statuses,
+            'trackers': self.reindex_trackers,
+            'custom_fields': self.reindex_custom_fields,
+            'programs': self.reindex_programs,
+        }
+
+
+    def reindex_priorities(self):
         self.priorities = self.load_priorities()
+
+
+    def reindex_statuses(self):
         self.statuses = self.load_statuses()
-        self.trackers = self.load_trackers()
+
+
+    def reindex_trackers(self):
+        self.cache_trackers(self.load_trackers())
+
+
+    def cache_trackers(self, trackers:dict[str,NamedId]):
+        self.tracker_index = PrefixIndex.build((name, [name]) for name in trackers)
+        self.trackers = trackers
+
+
+    def complete_tracker(self, prefix:str, limit:int = MAX_RESULTS) -> list[str]:
+        """names of trackers matching the prefix, for autocomplete"""
+        return self.tracker_index.search(prefix, limit)
+
+
+    def complete_ticket(self, prefix:str, limit:int = MAX_RESULTS) -> list[tuple[int, str]]:
+        """(id, subject) of recently seen tickets matching the prefix, for autocomplete"""
+        return self.recent.search(prefix, limit)
+
+
+    def reindex_custom_fields(self):
         self.custom_fields = self.load_custom_fields()
+
+
+    def reindex_programs(self):
         self.programs = self.load_programs()
 
 
@@ -79,6 +168,15 @@ class TicketManager():
         return self.custom_fields.get(name, None)
 
 
+    def trace_field(self) -> dict | None:
+        """the trace-id custom field, for a ticket changed while tracing an email"""
+        trace_id = tracing.trace_id()
+        field = self.get_custom_field(TRACE_FIELD_NAME) if trace_id else None
+        if field:
+            return {'id': field.id, 'value': trace_id}
+        return None
+
+
     def load_programs(self) -> dict[str,int]:
         programs: dict[str,int] = {}
 
@@ -204,24 +302,27 @@ class TicketManager():
             }
         }
 
+        # carry the trace to netbot
+        trace_field = self.trace_field()
+        if trace_field:
+            data['issue']['custom_fields'].append(trace_field)
+
         if params:
             data['issue'].update(params)
             log.debug(f"added params to new ticket, ticket={data['issue']}")
 
-        if message.attachments and len(message.attachments) > 0:
-            data['issue']['uploads'] = []
-            for a in message.attachments:
-                data['issue']['uploads'].append({
-                    "token": a.token,
-                    "filename": a.name,
-                    "content_type": a.content_type,
-                })
+        uploads = self.upload_list(message.attachments)
+        if uploads:
+            data['issue']['uploads'] = uploads
 
         response = self.session.post(ISSUES_RESOURCE, json.dumps(data), user.login)
 
         # check status
         if response:
-            return Ticket(**response['issue'])
+            ticket = Ticket(**response['issue'])
+            self.recent.add(ticket)
+            self.uploads.attached(ticket.id, message.attachments)
+            return ticket
         else:
             raise RedmineException(
                 f"create_ticket failed, status=[{response.status_code}] {response.reason}",
@@ -248,18 +349,18 @@ class TicketManager():
             }
         }
 
+        trace_field = self.trace_field()
+        if trace_field:
+            data['issue']['custom_fields'] = [trace_field]
+
         # add the attachments
-        if attachments and len(attachments) > 0:
-            data['issue']['uploads'] = []
-            for a in attachments:
-                data['issue']['uploads'].append({
-                    "token": a.token,
-                    "filename": a.name,
-                    "content_type": a.content_type,
-                })
+        uploads = self.upload_list(attachments)
+        if uploads:
+            data['issue']['uploads'] = uploads
 
         self.session.put(f"{ISSUE_RESOURCE}{ticket_id}.json", json.dumps(data), user_login)
         # no return, excepion thrown in case of failure
+        self.uploads.attached(ticket_id, attachments or [])
 
 
     def upload_file(self, user:User, data, filename:str, content_type) -> str:
@@ -267,13 +368,39 @@ class TicketManager():
         return self.session.upload_file(user.login, data, filename, content_type)
 
 
-    def upload_attachments(self, user:User, attachments):
-        """Upload a list of attachments"""
-        # uploads all the attachments,
-        # sets the upload token for each
+    def upload_attachments(self, user:User, attachments, ticket_id:int|None = None):
+        """
+        Upload a list of attachments, setting the upload token of each.
+        Content is uploaded once: tracking pixels, content already attached to
+        ticket_id and repeats of the same content aren't uploaded again.
+        """
+        tokens = {} # digest -> token, for content repeated in the list
         for a in attachments:
-            token = self.upload_file(user, a.payload, a.name, a.content_type)
+            if is_junk(a):
+                a.skip = JUNK
+            elif self.uploads.is_attached(a.digest, ticket_id):
+                a.skip = ATTACHED
+            if a.skip:
+                log.info(f"Skipping attachment {a.name}, {a.skip}")
+                continue
+            token = tokens.get(a.digest) or self.uploads.claim(a.digest)
+            if token is None:
+                token = self.upload_file(user, a.content(), a.name, a.content_type)
             a.set_token(token)
+            tokens[a.digest] = token
+
+
+    def upload_list(self, attachments) -> list[dict]:
+        """the uploads to attach to a ticket, one for each token"""
+        uploads = {}
+        for a in attachments or []:
+            if a.token and a.token not in uploads:
+                uploads[a.token] = {
+                    "token": a.token,
+                    "filename": a.name,
+                    "content_type": a.content_type,
+                }
+        return list(uploads.values())
 
 
     def get_by(self, user) -> list[Ticket]:
@@ -310,6 +437,7 @@ class TicketManager():
                 if children and len(children) > 0:
                     ticket.children = children
 
+            self.recent.add(ticket)
             return ticket
         else:
             log.debug(f"Unknown ticket number: {ticket_id}, params:{params}")
@@ -332,6 +460,7 @@ class TicketManager():
         if response:
             result = TicketsResult(**response)
             if result.total_count > 0:
+                self.recent.add_all(result.issues)
                 return result.issues
             else:
                 return []
@@ -486,6 +615,29 @@ class TicketManager():
             return None
 
 
+    def updated_since(self, timestamp:dt.datetime) -> list[Ticket]:
+        """
+        get open tickets updated since provided timestamp, a page at a time.
+        sorted by id, so a ticket updated while paging can't shift another into a page already read.
+        raises RedmineException if a page can't be read, rather than return some of them.
+        """
+        timestr = synctime.zulu(timestamp)
+        query = f"/issues.json?updated_on=%3E%3D{timestr}&sort=id&limit=100"
+        tickets: dict[int, Ticket] = {}
+        offset = 0
+        while True:
+            response = self.session.get(f"{query}&offset={offset}")
+            if response is None:
+                raise RedmineException(f"unable to read tickets updated since {timestr}, offset {offset}", __name__)
+            result = TicketsResult(**response)
+            # a ticket newly updated while paging shifts the rest along, and is seen twice
+            tickets.update((ticket.id, ticket) for ticket in result.issues)
+            offset += result.limit
+            if not result.issues or offset >= result.total_count:
+                break
+        return list(tickets.values())
+
+
     def find_tickets(self) -> list[Ticket]:
         """default ticket query"""
         # "kanban" query: all ticket open or closed recently
@@ -505,6 +657,7 @@ class TicketManager():
 
         response = TicketsResult(**jresp)
         if response.total_count > 0:
+            self.recent.add_all(response.issues)
             return response.issues
         else:
             log.info("No open ticket for me.")
@@ -519,6 +672,7 @@ class TicketManager():
 
         result = TicketsResult(**response)
         if result.total_count > 0:
+            self.recent.add_all(result.issues)
             return result.issues
         else:
             log.info(f"No open ticket for {team}: {result}")
@@ -532,6 +686,7 @@ class TicketManager():
 
         result = TicketsResult(**response)
         if result.total_count > 0:
+            self.recent.add_all(result.issues)
             return result.issues
         else:
             log.debug(f"Zero results for {kwargs}")
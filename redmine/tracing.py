@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Lightweight tracing of an email, from IMAP fetch to Discord thread, as spans exported to JSONL"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+import contextvars
+import collections
+import datetime as dt
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from redmine import synctime
+
+
+log = logging.getLogger(__name__)
+
+
+TRACE_FILE_ENV = "NETBOT_TRACE_FILE" # JSONL file to append finished spans to
+MAX_SPANS = 1000 # recent spans kept in memory
+MAX_RESUMED = 1000 # trace ids remembered as already resumed
+
+
+def process_name() -> str:
+    """the running program: threader_daemon, netbot..."""
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python"
+
+
+@dataclass
+class Span():
+    """a timed stage of a trace"""
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    process: str
+    start: dt.datetime
+    duration: float = 0.0 # seconds
+    attributes: dict = field(default_factory=dict)
+    error: str | None = None
+
+
+    def as_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "process": self.process,
+            "start": self.start.isoformat(), # with microseconds, unlike zulu()
+            "duration": round(self.duration, 6),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Span":
+        return cls(**dict(data, start=synctime.parse_str(data["start"])))
+
+
+CURRENT: contextvars.ContextVar[Span | None] = contextvars.ContextVar("span", default=None)
+
+
+def new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class Tracer():
+    """
+    Record spans for traced work, when enabled.
+
+    A trace starts when an email is fetched, and its id is carried to netbot in
+    the ticket's trace-id custom field, so the spans written by the threader and
+    netbot can be joined into one timeline. When disabled, trace() and span()
+    cost a flag check.
+    """
+    def __init__(self, path: str | None = None, process: str | None = None, max_spans: int = MAX_SPANS):
+        self.path = path
+        self.process = process or process_name()
+        self.enabled = bool(path)
+        self.spans: collections.deque[Span] = collections.deque(maxlen=max_spans)
+        self.resumed: collections.OrderedDict[str, bool] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def fromenv(cls) -> "Tracer":
+        return cls(path=os.getenv(TRACE_FILE_ENV))
+
+
+    @contextmanager
+    def run(self, name: str, trace_id: str, parent_id: str | None, attributes: dict):
+        span = Span(trace_id, new_id(), parent_id, name, self.process, synctime.now(), attributes=attributes)
+        token = CURRENT.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as ex:
+            span.error = f"{type(ex).__name__}: {ex}"
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            CURRENT.reset(token)
+            self.finish(span)
+
+
+    @contextmanager
+    def trace(self, name: str, **attributes):
+        """start a new trace, with the block as its root span"""
+        if not self.enabled:
+            yield None
+            return
+        with self.run(name, new_id(), None, attributes) as span:
+            yield span
+
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """time the block as a child of the current span, if there is one"""
+        parent = CURRENT.get() if self.enabled else None
+        if parent is None:
+            yield None
+            return
+        with self.run(name, parent.trace_id, parent.span_id, attributes) as span:
+            yield span
+
+
+    @contextmanager
+    def resume(self, trace_id: str | None, name: str, **attributes):
+        """
+        continue a trace started by another process, once.
+        later calls for the same trace id are not traced, unless nested in it.
+        """
+        parent = CURRENT.get()
+        if not self.enabled or not trace_id:
+            yield None
+        elif parent and parent.trace_id == trace_id:
+            with self.run(name, trace_id, parent.span_id, attributes) as span:
+                yield span
+        elif not self.claim(trace_id):
+            yield None
+        else:
+            with self.run(name, trace_id, None, attributes) as span:
+                yield span
+
+
+    def claim(self, trace_id: str) -> bool:
+        """true the first time a trace id is resumed"""
+        with self.lock:
+            if trace_id in self.resumed:
+                return False
+            self.resumed[trace_id] = True
+            if len(self.resumed) > MAX_RESUMED:
+                self.resumed.popitem(last=False)
+            return True
+
+
+    def trace_id(self) -> str | None:
+        """the id of the current trace, if any"""
+        span = CURRENT.get()
+        return span.trace_id if span else None
+
+
+    def annotate(self, **attributes) -> None:
+        """add attributes to the current span"""
+        span = CURRENT.get()
+        if span:
+            span.attributes.update(attributes)
+
+
+    def finish(self, span: Span) -> None:
+        with self.lock:
+            self.spans.append(span)
+            if self.path:
+                try:
+                    # one line per span, so the threader and netbot can append to the same file
+                    with open(self.path, 'a', encoding="utf-8") as file:
+                        file.write(json.dumps(span.as_dict()) + "\n")
+                except OSError as ex:
+                    log.warning(f"unable to write span to {self.path}: {ex}")
+
+
+# process-wide tracer, enabled by NETBOT_TRACE_FILE
+TRACER = Tracer.fromenv()
+
+
+def trace(name: str, **attributes):
+    return TRACER.trace(name, **attributes)
+
+
+def span(name: str, **attributes):
+    return TRACER.span(name, **attributes)
+
+
+def resume(trace_id: str | None, name: str, **attributes):
+    return TRACER.resume(trace_id, name, **attributes)
+
+
+def trace_id() -> str | None:
+    return TRACER.trace_id()
+
+
+def annotate(**attributes) -> None:
+    TRACER.annotate(**attributes)
+
+
+def load(paths: list[str]) -> list[Span]:
+    """the spans in JSONL files"""
+    spans = []
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            spans.extend(Span.from_dict(json.loads(line)) for line in file if line.strip())
+    return spans
+
+
+def timelines(spans: list[Span]) -> dict[str, list[tuple[float, Span]]]:
+    """spans by trace id, in start order, with each span's offset from the start of its trace"""
+    traces: dict[str, list[Span]] = collections.defaultdict(list)
+    for span_ in spans:
+        traces[span_.trace_id].append(span_)
+    result = {}
+    for trace_id_, trace_spans in traces.items():
+        trace_spans.sort(key=lambda s: s.start)
+        first = trace_spans[0].start
+        result[trace_id_] = [((s.start - first).total_seconds(), s) for s in trace_spans]
+    return result
+
+
+def format_timeline(trace_id_: str, timeline: list[tuple[float, Span]]) -> str:
+    lines = [f"trace {trace_id_}"]
+    for offset, span_ in timeline:
+        attributes = " ".join(f"{key}={value}" for key, value in span_.attributes.items())
+        error = f" ERROR {span_.error}" if span_.error else ""
+        lines.append(f"  +{offset:9.3f}s {span_.duration:9.3f}s  {span_.process:16} {span_.name:14} {attributes}{error}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the per-stage timeline of each traced email")
+    parser.add_argument("files", nargs="+", help="JSONL trace files, from the threader and netbot")
+    parser.add_argument("--trace", help="only show this trace id")
+    args = parser.parse_args()
+
+    for trace_id_, timeline in timelines(load(args.files)).items():
+        if args.trace and trace_id_ != args.trace:
+            continue
+        print(format_timeline(trace_id_, timeline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Content-addressed attachment uploads: the same bytes are uploaded to a ticket once"""
+
+import time
+import struct
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from redmine.model import Attachment
+
+
+log = logging.getLogger(__name__)
+
+
+UPLOAD_TTL = 23 * 60 * 60 # seconds, redmine prunes uploads that aren't attached after a day
+MAX_UPLOADS = 10_000 # digests remembered
+JUNK_IMAGE_PIXELS = 4 # images this small are tracking pixels or spacers, and aren't uploaded
+
+# why an attachment isn't uploaded
+JUNK = "junk"
+ATTACHED = "attached"
+
+
+@dataclass
+class Upload():
+    """what's known of some content: an upload token that isn't attached yet, and the tickets it's attached to"""
+    token: str | None = None
+    expires: float = 0.0 # when the token is pruned by redmine
+    tickets: set[int] = field(default_factory=set)
+
+
+def image_size(head: bytes) -> tuple[int, int] | None:
+    """(width, height) of a PNG or GIF image, from its first 24 bytes"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and len(head) >= 24:
+        return struct.unpack(">II", head[16:24])
+    if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+        return struct.unpack("<HH", head[6:10])
+    return None
+
+
+def is_junk(attachment: Attachment) -> bool:
+    """a tracking pixel or spacer image"""
+    if not (attachment.content_type or "").startswith("image/"):
+        return False
+    content = attachment.content()
+    head = content[:24] if isinstance(content, bytes) else content.read(24)
+    size = image_size(head)
+    return size is not None and size[0] * size[1] <= JUNK_IMAGE_PIXELS
+
+
+class UploadCache():
+    """
+    Upload tokens and attached tickets, by the SHA-256 of the content.
+
+    A redmine upload token can only be attached once, so tokens aren't shared
+    between emails that are processed at once. An email that fails after its
+    uploads releases its tokens, and the email is processed again without
+    uploading them again. Content already attached to a ticket isn't uploaded
+    to that ticket again, which covers the logos and signature images in every
+    reply. Released tokens expire when redmine prunes unattached uploads.
+    """
+    def __init__(self, ttl: float = UPLOAD_TTL, max_size: int = MAX_UPLOADS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.uploads: OrderedDict[str, Upload] = OrderedDict() # digest -> upload, least recently used first
+
+
+    def entry(self, digest: str) -> Upload:
+        """the entry for a digest, as the most recently used. call with the lock held."""
+        upload = self.uploads.pop(digest, None) or Upload()
+        self.uploads[digest] = upload
+        while len(self.uploads) > self.max_size:
+            self.uploads.popitem(last=False)
+        return upload
+
+
+    def claim(self, digest: str) -> str | None:
+        """a released token for the content, if there's one that's still valid. it's no longer available to others."""
+        with self.lock:
+            upload = self.uploads.get(digest)
+            if upload is None or upload.token is None:
+                return None
+            token, upload.token = upload.token, None
+            return token if upload.expires > time.monotonic() else None
+
+
+    def is_attached(self, digest: str, ticket_id: int | None) -> bool:
+        with self.lock:
+            upload = self.uploads.get(digest)
+            return upload is not None and ticket_id in upload.tickets
+
+
+    def attached(self, ticket_id: int, attachments: list[Attachment]) -> None:
+        """the attachments were attached to a ticket, using up their tokens"""
+        with self.lock:
+            for attachment in attachments:
+                if attachment.token:
+                    self.entry(attachment.digest).tickets.add(ticket_id)
+                    attachment.set_token(None)
+
+
+    def release(self, attachments: list[Attachment]) -> None:
+        """the attachments weren't attached: their tokens can be claimed by the next email with the same content"""
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            for attachment in attachments:
+                if attachment.token:
+                    upload = self.entry(attachment.digest)
+                    upload.token = attachment.token
+                    upload.expires = expires
+
+
+    def __len__(self) -> int:
+        return len(self.uploads)
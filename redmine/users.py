@@ -2,14 +2,20 @@
 """redmine client"""
 
 import datetime as dt
+import time
 import logging
 import json
+import threading
 
 import urllib
+from collections.abc import Callable
 
 
 from redmine.model import Team, User, UserResult, NamedId, DISCORD_ID_FIELD
 from redmine.session import RedmineSession, RedmineException
+from redmine.prefix import PrefixIndex, MAX_RESULTS
+from redmine import metrics
+from redmine.metrics import CACHE_REQUESTS
 
 
 log = logging.getLogger(__name__)
@@ -19,6 +25,11 @@ USER_RESOURCE = "/users.json"
 TEAM_RESOURCE = "/groups.json"
 ROLES_RESOURCE = "/roles.json"
 BLOCKED_TEAM_NAME = "blocked"
+BLOCKED_REFRESH = 5 * 60 # seconds between reloads of the blocked team
+BLOCKED_RETRY = 10 # seconds before trying again, after a failed load
+
+BLOCKED_RELOAD_FAILURES = metrics.counter("redmine_blocked_reload_failures_total",
+    "Failed reloads of the blocked team, when the last known members are used")
 
 
 class UserCache():
@@ -30,6 +41,8 @@ class UserCache():
         self.discord_ids: dict[str, int]  = {}
         self.teams: dict[str, Team] = {}
         self.roles: dict[str, int] = {} # role name, id
+        self.user_index = PrefixIndex() # logins, emails, names and discord names -> login
+        self.team_index = PrefixIndex() # team names
 
 
     def clear(self):
@@ -39,12 +52,26 @@ class UserCache():
         self.user_emails.clear()
         self.discord_ids.clear()
         self.roles.clear()
+        self.teams = {}
+        self.user_index = PrefixIndex()
+        self.team_index = PrefixIndex()
 
 
     def cache_user(self, user: User) -> None:
         """add the user to the cache"""
         #log.debug(f"caching: {user.id} {user.login} {user.discord_id}")
 
+        index = self.user_index # not another index swapped in by cache_users part way through
+        with index.lock:
+            previous = self.user_ids.get(user.id)
+            if isinstance(previous, User):
+                index.remove(previous.login, *self.user_terms(previous))
+            index.add(user.login, *self.user_terms(user))
+            self.index_user(user)
+
+
+    def index_user(self, user: User) -> None:
+        """add the user to the lookup indicies"""
         self.user_ids[user.id] = user
         self.users[user.login] = user.id
         self.user_emails[user.mail] = user.id
@@ -52,10 +79,42 @@ class UserCache():
             self.discord_ids[user.discord_id.name] = user.id
 
 
+    def cache_users(self, users: list[User]) -> None:
+        """replace all the cached users. new indices are built, then swapped in,
+        so a concurrent reader never sees a partially loaded cache."""
+        fresh = UserCache()
+        for user in users:
+            fresh.index_user(user) # several internal indicies
+        # sort once, rather than an insert per user
+        fresh.user_index = PrefixIndex.build((user.login, self.user_terms(user)) for user in users)
+
+        self.users = fresh.users
+        self.user_ids = fresh.user_ids
+        self.user_emails = fresh.user_emails
+        self.discord_ids = fresh.discord_ids
+        self.user_index = fresh.user_index
+
+
+    @staticmethod
+    def user_terms(user: User) -> list[str]:
+        """the text a user can be found by in the autocomplete index"""
+        terms = [user.login, user.mail, f"{user.firstname} {user.lastname}"]
+        if user.discord_id:
+            terms.append(user.discord_id.name)
+        return terms
+
+
+    def cache_teams(self, teams: dict[str, Team]) -> None:
+        """replace all the cached teams"""
+        self.team_index = PrefixIndex.build((name, [name]) for name in teams)
+        self.teams = teams
+
+
     def cache_team(self, team: Team) -> None:
         """add the team to the cache"""
         self.teams[team.name] = team
         self.user_ids[team.id] = team # hack to make teams visible by ID
+        self.team_index.add(team.name, team.name)
 
 
     def get(self, user_id:int):
@@ -133,17 +192,105 @@ class UserCache():
         return self.roles.get(role_name)
 
 
+    def complete_user(self, prefix:str, limit:int = MAX_RESULTS) -> list[str]:
+        """logins of cached users matching the prefix, for autocomplete"""
+        return self.user_index.search(prefix, limit)
+
+
+    def complete_team(self, prefix:str, limit:int = MAX_RESULTS) -> list[str]:
+        """names of cached teams matching the prefix, for autocomplete"""
+        return self.team_index.search(prefix, limit)
+
+
+class BlockedSenders():
+    """
+    The ids and email addresses of the members of the blocked team, so a sender
+    can be checked without asking redmine. The team is reloaded when it's older
+    than refresh seconds; blocking or unblocking through the UserManager updates
+    it right away. If a load fails, the last known members are kept, and it's
+    tried again after retry seconds.
+    """
+    def __init__(self, user_mgr: "UserManager", refresh: float = BLOCKED_REFRESH, retry: float = BLOCKED_RETRY):
+        self.user_mgr = user_mgr
+        self.refresh = refresh
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.team_id: int | None = None # found on the first load
+        self.user_ids: frozenset[int] = frozenset()
+        self.addresses: frozenset[str] = frozenset()
+        self.loaded = None # monotonic time of the last load
+        self.failed = None # monotonic time of the last failed load, if it's failed since
+
+
+    def load(self) -> None:
+        """reload the members of the blocked team, with their email addresses"""
+        if self.team_id is None:
+            response = self.user_mgr.session.get(f"{TEAM_RESOURCE}?limit=100")
+            if response is None:
+                raise RedmineException("unable to list the teams", __name__)
+            self.team_id = next((team["id"] for team in response["groups"] if team["name"] == BLOCKED_TEAM_NAME), None)
+        members = self.user_mgr.get_team_members(self.team_id) if self.team_id else []
+        if members is None:
+            self.team_id = None # it may have been removed, look for it again
+            raise RedmineException(f"unable to list the members of the {BLOCKED_TEAM_NAME} team", __name__)
+        self.user_ids = frozenset(user.id for user in members)
+        self.addresses = frozenset(user.mail.lower() for user in members if user.mail)
+        self.loaded = time.monotonic()
+        log.debug(f"loaded {len(self.user_ids)} blocked users")
+
+
+    def current(self) -> None:
+        """reload the team, if it's stale"""
+        with self.lock:
+            now = time.monotonic()
+            if self.loaded is not None and now - self.loaded < self.refresh:
+                return
+            if self.failed is not None and now - self.failed < self.retry:
+                return
+            try:
+                self.load()
+                self.failed = None
+            except RedmineException as ex:
+                BLOCKED_RELOAD_FAILURES.inc()
+                log.warning(f"unable to load the {BLOCKED_TEAM_NAME} team, using the last known: {ex}")
+                self.failed = now
+
+
+    def is_blocked(self, user: User) -> bool:
+        self.current()
+        return user is not None and user.id in self.user_ids
+
+
+    def is_blocked_address(self, addr: str) -> bool:
+        self.current()
+        return bool(addr) and addr.lower() in self.addresses
+
+
+    def update(self, user: User, blocked: bool) -> None:
+        """a user was blocked or unblocked"""
+        with self.lock:
+            mail = (user.mail or "").lower()
+            if blocked:
+                self.user_ids = self.user_ids | {user.id}
+                self.addresses = (self.addresses | {mail}) if mail else self.addresses
+            else:
+                self.user_ids = self.user_ids - {user.id}
+                self.addresses = self.addresses - {mail}
+
+
 class UserManager():
     """manage redmine users"""
     session: RedmineSession
     cache: UserCache
 
 
-    def __init__(self, session: RedmineSession):
+    def __init__(self, session: RedmineSession, reindex: bool = True):
         self.session = session
         self.cache = UserCache()
+        self.blocked = BlockedSenders(self)
 
-        self.reindex()
+        if reindex:
+            self.reindex()
 
     def get_all(self) -> list[User]:
         jresp = self.session.get(f"{USER_RESOURCE}?status=1,2&limit=100")
@@ -168,6 +315,24 @@ class UserManager():
         log.warning("No users from get_all_users")
         return []
 
+    def get_team_members(self, team_id: int) -> list[User] | None:
+        """the users in a team, with their email addresses. None if redmine can't be reached."""
+        query = f"{USER_RESOURCE}?group_id={team_id}&status=1,2&limit=100"
+        response = self.session.get(query)
+        if response is None:
+            return None
+        result = UserResult(**response)
+        users = result.users
+        offset = result.limit
+        while offset < result.total_count:
+            response = self.session.get(f"{query}&offset={offset}")
+            if response is None:
+                return None
+            result = UserResult(**response)
+            users.extend(result.users)
+            offset += result.limit
+        return users
+
     def get_registered(self) -> list[User]:
         resp = self.session.get(f"{USER_RESOURCE}?status=2") # NOTE: 2 is the "registered" status
         if resp:
@@ -286,6 +451,7 @@ class UserManager():
 
         # check cache first
         user = self.cache.find(name)
+        CACHE_REQUESTS.inc(cache="users", result="hit" if user else "miss")
         if not user:
             # not found in cache, try a name search
             user = self.get_by_name(name)
@@ -446,10 +612,12 @@ class UserManager():
             self.create_team(BLOCKED_TEAM_NAME)
 
         self.join_team(user, BLOCKED_TEAM_NAME)
+        self.blocked.update(user, True)
 
 
     def unblock(self, user) -> None:
         self.leave_team(user, BLOCKED_TEAM_NAME)
+        self.blocked.update(user, False)
 
 
     def join_team(self, user: User, teamname:str) -> None:
@@ -464,12 +632,7 @@ class UserManager():
         if self.is_user_in(user, team):
             return # already done
 
-        # POST to /group/ID/users.json
-        data = {
-            "user_id": user.id
-        }
-
-        self.session.post(f"/groups/{team.id}/users.json", data=json.dumps(data))
+        self.add_team_member(team, user.id)
 
 
     def leave_team(self, user: User, teamname:str):
@@ -479,8 +642,25 @@ class UserManager():
             log.warning(f"Unknown team name: {teamname}")
             return
 
+        self.remove_team_member(team, user.id)
+
+
+    def add_team_member(self, team: Team, user_id: int) -> None:
+        """Add a user to a known team, without refetching the team.
+        The caller is responsible for checking membership first: redmine
+        responds with 422 if the user is already in the team."""
+        # POST to /group/ID/users.json
+        data = {
+            "user_id": user_id
+        }
+
+        self.session.post(f"/groups/{team.id}/users.json", data=json.dumps(data))
+
+
+    def remove_team_member(self, team: Team, user_id: int) -> None:
+        """Remove a user from a known team, without refetching the team"""
         # DELETE to /groups/{team-id}/users/{user_id}.json
-        self.session.delete(f"/groups/{team.id}/users/{user.id}.json") # encapsulation
+        self.session.delete(f"/groups/{team.id}/users/{user_id}.json") # encapsulation
         # raises an exception if there's a problem
 
 
@@ -491,10 +671,7 @@ class UserManager():
         # it seems that redmine has a HARD CODED limit of 100 responses per request.
         all_users = self.get_all()
         if all_users:
-            self.cache.clear()
-
-            for user in all_users:
-                self.cache.cache_user(user) # several internal indicies
+            self.cache.cache_users(all_users)
 
             log.debug(f"indexed {len(all_users)} users")
             log.debug(f"discord users: {self.cache.discord_ids}")
@@ -505,7 +682,7 @@ class UserManager():
     def reindex_teams(self):
         all_teams = self.get_all_teams()
         if all_teams and len(all_teams) > 0:
-            self.cache.teams = all_teams # replace all the cached teams
+            self.cache.cache_teams(all_teams) # replace all the cached teams
             log.debug(f"TEAMs {self.cache.teams}")
         else:
             log.warning("No teams to index")
@@ -513,12 +690,20 @@ class UserManager():
 
     def reindex(self):
         start = dt.datetime.now()
-        self.reindex_users()
-        self.reindex_teams()
-        self.reindex_roles()
+        for task in self.reindex_tasks().values():
+            task()
         log.info(f"reindex took {dt.datetime.now() - start}")
 
 
+    def reindex_tasks(self) -> dict[str, Callable[[], None]]:
+        """the independent loads that make up a reindex, by name"""
+        return {
+            'users': self.reindex_users,
+            'teams': self.reindex_teams,
+            'roles': self.reindex_roles,
+        }
+
+
     def assure_project_roles(self, user: User, project_id: int, role_names: list[str]):
         # get the user info, with memberships
         user = self.get(user.id, include="memberships")
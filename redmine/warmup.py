@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Concurrent warm-up of the redmine caches, with per-load timing"""
+
+import time
+import logging
+import contextvars
+import concurrent.futures
+from dataclasses import dataclass, field
+from collections.abc import Callable
+
+from redmine.session import RedmineException
+
+
+log = logging.getLogger(__name__)
+
+
+WARMUP_TIMEOUT = 60.0 # seconds, for all loads to complete
+WARMUP_WORKERS = 8
+
+
+@dataclass
+class LoadTiming():
+    """timing and outcome of a single load"""
+    phase: str
+    name: str
+    start: float = 0.0 # seconds since the warm-up started
+    seconds: float = 0.0
+    error: str | None = None
+
+    @property
+    def end(self) -> float:
+        return self.start + self.seconds
+
+    def __str__(self) -> str:
+        status = f" FAILED: {self.error}" if self.error else ""
+        return f"{self.phase}.{self.name}: {self.seconds:.3f}s{status}"
+
+
+@dataclass
+class WarmupReport():
+    """startup timing, by phase and by load"""
+    total: float = 0.0
+    loads: list[LoadTiming] = field(default_factory=list)
+
+    def phases(self) -> dict[str, float]:
+        """wall-clock seconds for each phase, from its first load starting to its last finishing"""
+        spans: dict[str, tuple[float, float]] = {}
+        for load in self.loads:
+            first, last = spans.get(load.phase, (load.start, load.end))
+            spans[load.phase] = (min(first, load.start), max(last, load.end))
+        return {phase: last - first for phase, (first, last) in spans.items()}
+
+    def failed(self) -> list[LoadTiming]:
+        return [load for load in self.loads if load.error]
+
+    def slowest(self) -> LoadTiming | None:
+        if self.loads:
+            return max(self.loads, key=lambda load: load.seconds)
+        return None
+
+    def __str__(self) -> str:
+        phases = ", ".join(f"{phase}={seconds:.3f}s" for phase, seconds in self.phases().items())
+        return f"warm-up took {self.total:.3f}s: {phases}, slowest={self.slowest()}"
+
+
+class Warmup():
+    """
+    Run independent cache loads concurrently, with an overall timeout.
+
+    Loads are registered by phase and name, then run together in a thread
+    pool. Cold start is bounded by the slowest load, rather than the sum.
+    """
+    def __init__(self, timeout: float = WARMUP_TIMEOUT, max_workers: int = WARMUP_WORKERS):
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.tasks: list[tuple[str, str, Callable[[], None]]] = []
+
+
+    def add(self, phase: str, tasks: dict[str, Callable[[], None]]) -> None:
+        """register the named loads for a phase"""
+        for name, task in tasks.items():
+            self.tasks.append((phase, name, task))
+
+
+    def run(self) -> WarmupReport:
+        """run all the loads. raises RedmineException if any load fails or times out."""
+        report = WarmupReport()
+        started = time.perf_counter()
+
+        def timed(timing: LoadTiming, task: Callable[[], None]):
+            timing.start = time.perf_counter() - started
+            try:
+                task()
+            except Exception as ex:
+                timing.error = str(ex) or ex.__class__.__name__
+                log.exception(f"warm-up load {timing.phase}.{timing.name} failed")
+            finally:
+                timing.seconds = time.perf_counter() - started - timing.start
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="warmup")
+        try:
+            futures = {}
+            for phase, name, task in self.tasks:
+                timing = LoadTiming(phase, name)
+                report.loads.append(timing)
+                # run in a copy of the context, so redmine calls are accounted to the caller's operation
+                futures[executor.submit(contextvars.copy_context().run, timed, timing, task)] = timing
+
+            _, pending = concurrent.futures.wait(futures, timeout=self.timeout)
+            for future in pending:
+                timing = futures[future]
+                timing.error = f"timed out after {self.timeout}s"
+                timing.seconds = self.timeout - timing.start
+        finally:
+            # don't block on loads that timed out
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        report.total = time.perf_counter() - started
+        log.info(str(report))
+        for load in report.loads:
+            log.debug(f"- {load}")
+
+        failed = report.failed()
+        if failed:
+            raise RedmineException(f"warm-up failed: {', '.join(str(load) for load in failed)}", __name__)
+
+        return report
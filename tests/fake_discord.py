@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+fake_discord: An in-process fake of the py-cord surfaces used by NetBot,
+for load-testing the sync loop and the daily tasks offline.
+
+Provides guilds with channels, threads, roles and members. Threads support
+history, send and edit, and channels support send and create_thread. Every
+call is counted, and can be slowed with latency or throttled with Discord
+style per-channel rate limits (429 responses).
+
+    with LocalRedmine(data) as server:
+        fake = FakeDiscord.from_data(data, messages=3, latency=0.05, rate_limit=5)
+        bot = fake.bot(Client.from_session(server.session(), default_project=1))
+        await bot.sweep()
+        print(fake.stats)
+"""
+
+import time
+import types
+import random
+import asyncio
+import logging
+import itertools
+import collections
+import datetime as dt
+
+import discord
+
+from redmine import synctime
+from redmine.model import SYNC_FIELD_NAME
+from redmine.redmine import Client
+from netbot.netbot import NetBot, CHANNEL_MAPPING
+from tests.local_redmine import RedmineData, WORDS
+
+
+log = logging.getLogger(__name__)
+
+
+BOT_ID = 1_000_000 # discord id of the bot user
+UNLIMITED_BUDGET = 1_000_000.0 # redmine requests per minute, for a sweep of every thread
+FIRST_ID = 2_000_000 # first snowflake assigned to fake objects
+PAGE_SIZE = 100 # messages per history request, the discord maximum
+MAX_MESSAGE_LEN = 2000 # discord limit on message content
+MAX_THREAD_NAME = 100 # discord limit on channel and thread names
+MAX_RETRIES = 5 # py-cord retries a rate-limited request this many times before raising
+
+
+class FakeMember():
+    """a guild member, or the bot user"""
+    def __init__(self, member_id: int, name: str, bot: bool = False):
+        self.id = member_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.roles: list[FakeRole] = []
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+    def __repr__(self) -> str:
+        return f"<FakeMember id={self.id} name={self.name}>"
+
+
+class FakeRole():
+    """a guild role, with its members"""
+    def __init__(self, role_id: int, name: str):
+        self.id = role_id
+        self.name = name
+        self.members: list[FakeMember] = []
+
+    @property
+    def mention(self) -> str:
+        return f"<@&{self.id}>"
+
+    def __repr__(self) -> str:
+        return f"<FakeRole id={self.id} name={self.name}>"
+
+
+class FakeMessage():
+    """a message posted to a channel or thread"""
+    def __init__(self, message_id: int, channel, author: FakeMember, content: str, created_at: dt.datetime):
+        self.id = message_id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.created_at = created_at
+        self.attachments = []
+
+    @property
+    def jump_url(self) -> str:
+        return f"https://discord.com/channels/{self.guild.id}/{self.channel.id}/{self.id}"
+
+    async def reply(self, content: str) -> "FakeMessage":
+        return await self.channel.send(content)
+
+    def __repr__(self) -> str:
+        return f"<FakeMessage id={self.id} author={self.author.name}>"
+
+
+class FakeMessageable():
+    """send and history, shared by channels and threads"""
+    fake: "FakeDiscord"
+    messages: list[FakeMessage]
+
+    async def send(self, content: str | None = None, **_kwargs) -> FakeMessage:
+        await self.fake.request("POST /channels/{id}/messages", bucket=f"channel:{self.id}")
+        content = content or ""
+        if len(content) > MAX_MESSAGE_LEN:
+            raise self.fake.http_error(400, f"content must be {MAX_MESSAGE_LEN} or fewer in length")
+        return self.fake.post(self, self.fake.bot_user, content)
+
+
+    async def history(self, *, limit: int | None = 100, before: dt.datetime | None = None,
+                      after: dt.datetime | None = None, oldest_first: bool | None = None, **_kwargs):
+        """async iterator over the messages, one request per page of PAGE_SIZE"""
+        messages = [message for message in self.messages
+                    if (after is None or message.created_at > after)
+                    and (before is None or message.created_at < before)]
+        if oldest_first is None:
+            oldest_first = after is not None
+        if not oldest_first:
+            messages.reverse()
+        if limit is not None:
+            messages = messages[:limit]
+
+        for start in range(0, max(len(messages), 1), PAGE_SIZE):
+            await self.fake.request("GET /channels/{id}/messages", bucket=f"history:{self.id}")
+            for message in messages[start:start + PAGE_SIZE]:
+                yield message
+
+
+class FakeTextChannel(FakeMessageable, discord.TextChannel):
+    """
+    A text channel. Subclasses discord.TextChannel so isinstance checks
+    in netbot behave as they do with a live guild.
+    """
+    def __init__(self, fake: "FakeDiscord", guild: "FakeGuild", channel_id: int, name: str):
+        self.fake = fake
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.messages = []
+
+    async def create_thread(self, *, name: str, message=None, **_kwargs) -> "FakeThread":
+        await self.fake.request("POST /channels/{id}/threads", bucket=f"threads:{self.guild.id}")
+        if len(name) > MAX_THREAD_NAME:
+            raise self.fake.http_error(400, f"name must be {MAX_THREAD_NAME} or fewer in length")
+        return self.guild.add_thread(self, name)
+
+    def __repr__(self) -> str:
+        return f"<FakeTextChannel id={self.id} name={self.name}>"
+
+
+class FakeThread(FakeMessageable, discord.Thread):
+    """A thread in a text channel. Subclasses discord.Thread for isinstance checks."""
+    def __init__(self, fake: "FakeDiscord", guild: "FakeGuild", parent: FakeTextChannel, thread_id: int, name: str):
+        self.fake = fake
+        self.guild = guild
+        self.parent_id = parent.id
+        self.id = thread_id
+        self.name = name
+        self.archived = False
+        self.locked = False
+        self.messages = []
+
+    async def edit(self, *, name: str | None = None, archived: bool | None = None,
+                   locked: bool | None = None, **_kwargs) -> "FakeThread":
+        await self.fake.request("PATCH /channels/{id}", bucket=f"edit:{self.id}")
+        if name is not None:
+            if len(name) > MAX_THREAD_NAME:
+                raise self.fake.http_error(400, f"name must be {MAX_THREAD_NAME} or fewer in length")
+            self.name = name
+        if archived is not None:
+            self.set_archived(archived)
+        if locked is not None:
+            self.locked = locked
+        return self
+
+    def set_archived(self, archived: bool) -> None:
+        """archived threads leave the guild's active threads, as with the gateway cache"""
+        if archived != self.archived:
+            self.archived = archived
+            if archived:
+                self.guild.threads.remove(self)
+            else:
+                self.guild.threads.append(self)
+
+    def __repr__(self) -> str:
+        return f"<FakeThread id={self.id} name={self.name}>"
+
+
+class FakeGuild():
+    """a guild: channels, threads, roles and members"""
+    def __init__(self, fake: "FakeDiscord", guild_id: int, name: str):
+        self.fake = fake
+        self.id = guild_id
+        self.name = name
+        self.channels: list[FakeTextChannel] = []
+        self.threads: list[FakeThread] = []
+        self.roles: list[FakeRole] = []
+        self.members: list[FakeMember] = []
+        self._channels: dict[int, FakeTextChannel | FakeThread] = {}
+        self._members: dict[int, FakeMember] = {}
+
+
+    @property
+    def text_channels(self) -> list[FakeTextChannel]:
+        return self.channels
+
+
+    def add_channel(self, name: str) -> FakeTextChannel:
+        channel = FakeTextChannel(self.fake, self, self.fake.new_id(), name)
+        self.channels.append(channel)
+        self._channels[channel.id] = channel
+        return channel
+
+
+    def add_thread(self, parent: FakeTextChannel, name: str, thread_id: int | None = None) -> FakeThread:
+        thread = FakeThread(self.fake, self, parent, thread_id or self.fake.new_id(), name)
+        self.threads.append(thread)
+        self._channels[thread.id] = thread
+        return thread
+
+
+    def add_role(self, name: str) -> FakeRole:
+        role = FakeRole(self.fake.new_id(), name)
+        self.roles.append(role)
+        return role
+
+
+    def add_member(self, member_id: int, name: str) -> FakeMember:
+        member = FakeMember(member_id, name)
+        self.members.append(member)
+        self._members[member.id] = member
+        return member
+
+
+    def assign(self, member: FakeMember, role: FakeRole) -> None:
+        role.members.append(member)
+        member.roles.append(role)
+
+
+    def get_channel(self, channel_id: int) -> FakeTextChannel | FakeThread | None:
+        """from the cache: archived threads aren't found"""
+        channel = self._channels.get(channel_id)
+        return None if isinstance(channel, FakeThread) and channel.archived else channel
+
+
+    def get_thread(self, thread_id: int) -> FakeThread | None:
+        channel = self.get_channel(thread_id)
+        return channel if isinstance(channel, FakeThread) else None
+
+
+    def get_member(self, member_id: int) -> FakeMember | None:
+        return self._members.get(member_id)
+
+
+    def get_member_named(self, name: str) -> FakeMember | None:
+        for member in self.members:
+            if member.name == name:
+                return member
+        return None
+
+
+    def get_role(self, role_id: int) -> FakeRole | None:
+        for role in self.roles:
+            if role.id == role_id:
+                return role
+        return None
+
+
+    def __repr__(self) -> str:
+        return f"<FakeGuild id={self.id} name={self.name} threads={len(self.threads)}>"
+
+
+class FakeBot(NetBot):
+    """NetBot connected to a FakeDiscord, rather than the discord gateway"""
+    def __init__(self, client: Client, fake: "FakeDiscord"):
+        self.fake = fake
+        super().__init__(client)
+
+    @property
+    def guilds(self) -> list[FakeGuild]:
+        return self.fake.guilds
+
+    @property
+    def user(self) -> FakeMember:
+        return self.fake.bot_user
+
+    def get_channel(self, channel_id: int, /):
+        return self.fake.get_channel(channel_id)
+
+    async def fetch_channel(self, channel_id: int, /):
+        return await self.fake.fetch_channel(channel_id)
+
+    async def sweep(self):
+        """
+        sync every thread, whether it's due or not, with the scheduled sync tick and no
+        request budget. closed tickets that had their final sync are still skipped.
+        """
+        self.scheduler.budget = self.scheduler.tokens = UNLIMITED_BUDGET
+        now = synctime.now()
+        for schedule in self.scheduler.schedules.values():
+            schedule.due = min(schedule.due, now)
+        await self.sync_due_threads()
+
+
+class FakeDiscord():
+    """
+    The fake discord service: guilds, plus the request accounting, latency
+    and rate limits applied to every API call.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: int = 0,
+                 rate_period: float = 5.0, retry_429: bool = True, seed: int = 0):
+        self.latency = latency # seconds added to each request
+        self.jitter = jitter # max random seconds added on top of latency
+        self.rate_limit = rate_limit # max requests per bucket per rate_period, 0 for no limit
+        self.rate_period = rate_period
+        self.retry_429 = retry_429 # wait and retry when rate limited, as py-cord does. Otherwise raise.
+        self.random = random.Random(seed)
+        self.guilds: list[FakeGuild] = []
+        self.bot_user = FakeMember(BOT_ID, "netbot", bot=True)
+        self.stats: collections.Counter[str] = collections.Counter() # "POST /channels/{id}/messages" -> count
+        self.throttled = 0.0 # total seconds spent waiting on rate limits
+        self._ids = itertools.count(FIRST_ID)
+        self._buckets: dict[str, collections.deque[float]] = {}
+
+
+    def new_id(self) -> int:
+        return next(self._ids)
+
+
+    def add_guild(self, name: str) -> FakeGuild:
+        guild = FakeGuild(self, self.new_id(), name)
+        self.guilds.append(guild)
+        return guild
+
+
+    def bot(self, client: Client) -> FakeBot:
+        """a netbot connected to this fake discord"""
+        return FakeBot(client, self)
+
+
+    def get_channel(self, channel_id: int) -> FakeTextChannel | FakeThread | None:
+        for guild in self.guilds:
+            channel = guild.get_channel(channel_id)
+            if channel:
+                return channel
+        return None
+
+
+    async def fetch_channel(self, channel_id: int) -> FakeTextChannel | FakeThread:
+        """from the API: including archived threads"""
+        await self.request("GET /channels/{id}", bucket=f"channel:{channel_id}")
+        for guild in self.guilds:
+            channel = guild._channels.get(channel_id)
+            if channel:
+                return channel
+        raise self.http_error(404, "Unknown Channel")
+
+
+    def post(self, channel: FakeMessageable, author: FakeMember, content: str,
+             created_at: dt.datetime | None = None) -> FakeMessage:
+        """add a message to a channel or thread, with no request accounting"""
+        if isinstance(channel, FakeThread) and channel.archived and not channel.locked:
+            channel.set_archived(False) # posting in an archived thread unarchives it
+        message = FakeMessage(self.new_id(), channel, author, content, created_at or synctime.now())
+        channel.messages.append(message)
+        return message
+
+
+    def sent(self) -> list[FakeMessage]:
+        """all the messages posted by the bot"""
+        return [message for guild in self.guilds for channel in guild._channels.values() # archived threads too
+                for message in channel.messages if message.author.id == BOT_ID]
+
+
+    def http_error(self, status: int, message: str) -> discord.HTTPException:
+        reasons = {400: "Bad Request", 404: "Not Found", 429: "Too Many Requests"}
+        self.stats[str(status)] += 1
+        response = types.SimpleNamespace(status=status, reason=reasons.get(status, "Error"))
+        return discord.HTTPException(response, message)
+
+
+    def retry_after(self, bucket: str) -> float:
+        """seconds until the bucket has capacity, recording this request if it does"""
+        if self.rate_limit <= 0:
+            return 0.0
+        now = time.monotonic()
+        window = self._buckets.setdefault(bucket, collections.deque())
+        while window and window[0] <= now - self.rate_period:
+            window.popleft()
+        if len(window) < self.rate_limit:
+            window.append(now)
+            return 0.0
+        return window[0] + self.rate_period - now
+
+
+    async def request(self, route: str, bucket: str) -> None:
+        """account for a single API call: rate limit, then latency"""
+        self.stats[route] += 1
+        for _ in range(MAX_RETRIES + 1):
+            retry_after = self.retry_after(bucket)
+            if retry_after <= 0:
+                break
+            self.stats["429"] += 1
+            if not self.retry_429:
+                raise self.http_error(429, f"rate limited on {bucket}, retry after {retry_after:.3f}s")
+            log.debug(f"rate limited on {bucket}, retrying in {retry_after:.3f}s")
+            self.throttled += retry_after
+            await asyncio.sleep(retry_after)
+        else:
+            raise self.http_error(429, f"rate limited on {bucket}, giving up after {MAX_RETRIES} retries")
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+    @classmethod
+    def from_data(cls, data: RedmineData, messages: int = 0, seed: int = 0, **kwargs) -> "FakeDiscord":
+        """
+        A guild matching a RedmineData: a channel for each mapped channel name,
+        a member for each user with a Discord ID, a role for each group, and a
+        thread for each synced issue, with about `messages` new messages per thread
+        from random members since the last sync.
+        """
+        rand = random.Random(seed)
+        fake = cls(seed=seed, **kwargs)
+        guild = fake.add_guild("Fake Guild")
+
+        for name in CHANNEL_MAPPING:
+            guild.add_channel(name)
+
+        members = {}
+        for user in data.users.values():
+            for field in user["custom_fields"]:
+                if field["name"] == "Discord ID" and field["value"]:
+                    discord_id, name = field["value"].split("|", 1)
+                    members[user["id"]] = guild.add_member(int(discord_id), name)
+
+        for group in data.groups.values():
+            role = guild.add_role(group["name"])
+            for user_id in group["user_ids"]:
+                if user_id in members:
+                    guild.assign(members[user_id], role)
+
+        authors = list(members.values())
+        for issue in data.issues.values():
+            token = next((field["value"] for field in issue["custom_fields"] if field["name"] == SYNC_FIELD_NAME), "")
+            if not token:
+                continue
+            sync_rec = synctime.SyncRecord.from_token(issue["id"], token)
+            channel = rand.choice(guild.channels)
+            thread = guild.add_thread(channel, f"Ticket #{issue['id']}: {issue['subject']}"[:MAX_THREAD_NAME],
+                                      thread_id=sync_rec.channel_id)
+            if authors:
+                when = sync_rec.last_sync
+                for _ in range(rand.randint(0, messages * 2)):
+                    when += dt.timedelta(seconds=rand.randint(1, 3600))
+                    content = " ".join(rand.choices(WORDS, k=rand.randint(3, 40)))
+                    fake.post(thread, rand.choice(authors), content, min(when, synctime.now()))
+
+        log.info(f"fake discord: {guild}, {len(guild.members)} members, {len(guild.roles)} roles")
+        return fake
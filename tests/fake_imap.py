@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+fake_imap: An in-process fake of the IMAPClient calls used by the threader,
+over a shared mailbox, so connections can be dropped and reopened.
+
+    mailbox = FakeMailbox()
+    mailbox.deliver("Jane Doe <jane@example.org>", "Re: antenna", "it works")
+    client = FakeImapClient(mailbox, redmine)
+    client.synchronize()
+    print(mailbox.stats)
+"""
+
+import os
+import email
+import email.policy
+import logging
+import tempfile
+import threading
+import collections
+from email.message import EmailMessage
+
+from imapclient import SEEN
+from imapclient.exceptions import IMAPClientAbortError, IMAPClientError
+from imapclient.response_types import BodyData
+
+from redmine import redmine
+from threader import imap
+from threader.threadindex import ThreadIndex, THREAD_INDEX_ENV
+
+
+log = logging.getLogger(__name__)
+
+
+class FakeMailbox():
+    """an inbox: messages and flags by uid, with a count of every command"""
+    def __init__(self):
+        self.messages: dict[int, bytes] = {}
+        self.flags: dict[int, set] = {}
+        self.stats: collections.Counter[str] = collections.Counter()
+        self.failures: collections.Counter[str] = collections.Counter() # command -> times to drop the connection
+        self.capabilities = {b"IMAP4REV1", b"IDLE"}
+        self.folders: dict[str, list[bytes]] = {"INBOX": []} # other folders, and the messages copied to them
+        self.arrived = threading.Condition() # notified on delivery, for IDLE
+        self.next_uid = 1
+
+
+    def deliver(self, from_address: str, subject: str, body: str, headers: dict | None = None,
+                attachments: list[tuple[str, bytes]] | None = None) -> int:
+        """deliver an email, with extra headers and (filename, content) attachments"""
+        message = EmailMessage()
+        message["From"] = from_address
+        message["To"] = "help@example.org"
+        message["Subject"] = subject
+        for name, value in (headers or {}).items():
+            message[name] = value
+        message.set_content(body)
+        for filename, content in attachments or []:
+            message.add_attachment(content, maintype="application", subtype="octet-stream", filename=filename)
+        with self.arrived:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages[uid] = message.as_bytes()
+            self.flags[uid] = set()
+            self.arrived.notify_all()
+        return uid
+
+
+    def fail(self, command: str, times: int = 1) -> None:
+        """drop the connection on the next times calls of command"""
+        self.failures[command] += times
+
+
+    def seen(self) -> list[int]:
+        return [uid for uid, flags in self.flags.items() if SEEN in flags]
+
+
+def bodystructure(part: EmailMessage) -> tuple:
+    """the raw BODYSTRUCTURE response for a part, before IMAPClient parses it"""
+    if part.is_multipart():
+        children = tuple(bodystructure(child) for child in part.iter_parts())
+        return children + (part.get_content_subtype().upper().encode(), None, None, None, None)
+
+    params = []
+    for name, value in part.get_params()[1:] if part.get_params() else []:
+        params += [name.upper().encode(), value.encode()]
+    payload = part.get_payload(decode=False).encode()
+    encoding = (part.get("Content-Transfer-Encoding") or "7bit").upper().encode()
+    disposition = None
+    if part.get_content_disposition():
+        filename = part.get_filename()
+        disposition = (part.get_content_disposition().upper().encode(),
+                       (b"FILENAME", filename.encode()) if filename else None)
+    fields = [part.get_content_maintype().upper().encode(), part.get_content_subtype().upper().encode(),
+              tuple(params) or None, None, None, encoding, len(payload)]
+    if part.get_content_maintype() == "text":
+        fields.append(payload.count(b"\n"))
+    return tuple(fields + [None, disposition, None, None])
+
+
+def section(message: EmailMessage, number: str) -> bytes:
+    """the content of a section, as it would be transferred"""
+    part = message
+    for index in number.split("."):
+        if part.is_multipart():
+            part = list(part.iter_parts())[int(index) - 1]
+    return part.get_payload(decode=False).encode()
+
+
+class FakeIMAP():
+    """a connection to a FakeMailbox"""
+    def __init__(self, mailbox: FakeMailbox):
+        self.mailbox = mailbox
+        self.open = True
+        self.idle_from = None # messages in the mailbox when IDLE started
+
+
+    def command(self, name: str) -> None:
+        if not self.open:
+            raise IMAPClientAbortError("connection closed")
+        self.mailbox.stats[name] += 1
+        if self.mailbox.failures[name] > 0:
+            self.mailbox.failures[name] -= 1
+            self.open = False
+            raise IMAPClientAbortError(f"socket error: EOF during {name}")
+
+
+    def login(self, _user, _passwd) -> None:
+        self.command("login")
+
+
+    def select_folder(self, _folder, readonly: bool = False) -> None:
+        self.command("select_folder")
+
+
+    def search(self, criteria="ALL") -> list[int]:
+        self.command("search")
+        if criteria == "UNSEEN":
+            return [uid for uid, flags in self.mailbox.flags.items() if SEEN not in flags]
+        return list(self.mailbox.messages)
+
+
+    def fetch(self, uids, data) -> dict:
+        """RFC822, the header, structure and size, or sections. bodies are counted in stats["bytes"]."""
+        self.command("fetch")
+        items = [data] if isinstance(data, str) else data
+        fetched = {}
+        for uid in uids:
+            if uid not in self.mailbox.messages:
+                continue
+            raw = self.mailbox.messages[uid]
+            message = email.message_from_bytes(raw, policy=email.policy.default)
+            result = {}
+            for item in items:
+                if item == "RFC822":
+                    result[b"RFC822"] = raw
+                    self.mailbox.stats["bytes"] += len(raw)
+                elif item == "RFC822.SIZE":
+                    result[b"RFC822.SIZE"] = len(raw)
+                elif item == "BODYSTRUCTURE":
+                    result[b"BODYSTRUCTURE"] = BodyData.create(bodystructure(message))
+                elif item == "BODY.PEEK[HEADER]":
+                    result[b"BODY[HEADER]"] = raw.split(b"\n\n", 1)[0] + b"\n\n"
+                elif item.startswith("BODY.PEEK["):
+                    number = item[len("BODY.PEEK["):-1]
+                    content = section(message, number)
+                    result[f"BODY[{number}]".encode()] = content
+                    self.mailbox.stats["bytes"] += len(content)
+            fetched[uid] = result
+        return fetched
+
+
+    def add_flags(self, uids, flags) -> None:
+        self.command("add_flags")
+        for uid in uids:
+            self.mailbox.flags[uid].update(flags)
+
+
+    def copy(self, uids, folder: str) -> None:
+        self.command("copy")
+        if folder not in self.mailbox.folders:
+            raise IMAPClientError(f"COPY command error: BAD [b'[TRYCREATE] No folder {folder}']")
+        self.mailbox.folders[folder].extend(self.mailbox.messages[uid] for uid in uids)
+
+
+    def has_capability(self, capability: str) -> bool:
+        self.command("capability")
+        return capability.encode().upper() in self.mailbox.capabilities
+
+
+    def idle(self) -> None:
+        self.command("idle")
+        self.idle_from = len(self.mailbox.messages)
+
+
+    def idle_check(self, timeout: float | None = None) -> list:
+        """EXISTS once a message is delivered, or nothing after timeout"""
+        with self.mailbox.arrived:
+            self.mailbox.arrived.wait_for(lambda: len(self.mailbox.messages) > self.idle_from, timeout)
+            count = len(self.mailbox.messages)
+        if count > self.idle_from:
+            self.idle_from = count
+            return [(count, b"EXISTS")]
+        return []
+
+
+    def idle_done(self) -> tuple:
+        self.idle_from = None
+        return (b"IDLE terminated", [])
+
+
+    def logout(self) -> None:
+        self.command("logout")
+        self.open = False
+
+
+    def shutdown(self) -> None:
+        self.open = False
+
+
+class FakeImapClient(imap.Client):
+    """the threader's imap client, connecting to a FakeMailbox"""
+    def __init__(self, mailbox: FakeMailbox, client: redmine.Client, batch_size: int = imap.DEFAULT_BATCH_SIZE):
+        # in memory, unless a test sets THREADER_INDEX_DB
+        super().__init__(client, ThreadIndex(os.getenv(THREAD_INDEX_ENV, ":memory:")))
+        self.mailbox = mailbox
+        self.batch_size = batch_size
+        self.redactor = None
+        # emails that fail are saved here, rather than in the working directory
+        self.errors = tempfile.TemporaryDirectory()
+        self.error_dir = self.errors.name
+
+
+    def close(self) -> None:
+        """log out, and close the index and remove the error dumps"""
+        super().close()
+        self.index.close()
+        self.errors.cleanup()
+
+
+    def open(self) -> FakeIMAP:
+        server = FakeIMAP(self.mailbox)
+        server.login(self.user, self.passwd)
+        server.select_folder("INBOX", readonly=False)
+        return server
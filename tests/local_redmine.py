@@ -0,0 +1,862 @@
+#!/usr/bin/env python3
+"""
+local_redmine: A lightweight, in-memory Redmine emulator served over HTTP,
+for benchmarks and offline integration tests.
+
+Implements the parts of the Redmine REST API used by the redmine package:
+issues, journals, search, users, groups, memberships, uploads, time entries
+and the enumerations. Latency and error rates can be injected to load-test
+RedmineSession and the sync loop.
+
+    with LocalRedmine(RedmineData.generate(users=100, tickets=1000), latency=0.05) as server:
+        client = Client.from_session(server.session(), default_project=1)
+"""
+
+import re
+import json
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+import collections
+import datetime as dt
+from collections.abc import Callable
+
+from aiohttp import web
+
+from redmine.session import RedmineSession
+from redmine import synctime
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_TOKEN = "local-redmine-token"
+ADMIN_ID = 1
+DEFAULT_LIMIT = 25
+MAX_LIMIT = 100 # redmine hard limit on page size
+DISCORD_FIELD_ID = 2
+SYNC_FIELD_ID = 4
+SYNC_CHANNEL_BASE = 5_000_000_000 # synthetic discord thread ids are this plus the ticket id
+
+STATUSES = [
+    {"id": 1, "name": "New", "is_closed": False},
+    {"id": 2, "name": "In Progress", "is_closed": False},
+    {"id": 3, "name": "Resolved", "is_closed": True},
+    {"id": 4, "name": "Standing", "is_closed": False},
+    {"id": 5, "name": "Reject", "is_closed": True},
+    {"id": 6, "name": "Backburner", "is_closed": False},
+]
+PRIORITIES = [
+    {"id": 1, "name": "Low", "is_default": False, "active": True},
+    {"id": 2, "name": "Normal", "is_default": True, "active": True},
+    {"id": 3, "name": "High", "is_default": False, "active": True},
+    {"id": 4, "name": "Urgent", "is_default": False, "active": True},
+    {"id": 5, "name": "Immediate", "is_default": False, "active": True},
+    {"id": 14, "name": "EPIC", "is_default": False, "active": True},
+]
+TRACKERS = [
+    {"id": 2, "name": "Infra-Field"},
+    {"id": 4, "name": "Software-Dev"},
+    {"id": 6, "name": "Infra-Config"},
+    {"id": 8, "name": "External-Comms-Intake"},
+    {"id": 9, "name": "Outreach-Partnerships"},
+    {"id": 10, "name": "Admin"},
+    {"id": 17, "name": "Research"},
+]
+CUSTOM_FIELDS = [
+    {"id": DISCORD_FIELD_ID, "name": "Discord ID", "customized_type": "user"},
+    {"id": SYNC_FIELD_ID, "name": "syncdata", "customized_type": "issue"},
+    {"id": 5, "name": "To/CC", "customized_type": "issue"},
+    {"id": 6, "name": "unredacted", "customized_type": "issue"},
+    {"id": 7, "name": "trace-id", "customized_type": "issue"},
+]
+ISSUE_FIELD_IDS = [field["id"] for field in CUSTOM_FIELDS if field["customized_type"] == "issue"]
+ROLES = [
+    {"id": 3, "name": "Administrator"},
+    {"id": 4, "name": "Volunteer"},
+    {"id": 5, "name": "User"},
+]
+ACTIVITIES = [
+    {"id": 15, "name": "Community Networks (General)", "is_default": True, "active": True},
+    {"id": 16, "name": "Grant: Seattle TMF 2023-4", "is_default": False, "active": True},
+]
+PROJECTS = [{"id": 1, "name": "Seattle Community Network"}]
+TEAMS = ["admin-team", "blocked", "ticket-intake", "software-dev-team", "infra-config-team",
+         "infra-field-team", "outreach-team", "research-team"]
+WORDS = ["router", "antenna", "mesh", "node", "outage", "install", "rooftop", "fiber", "wifi",
+         "signal", "volunteer", "workshop", "grant", "config", "firmware", "switch", "power",
+         "cable", "survey", "account", "email", "password", "discord", "meeting", "report"]
+
+COMPARE_REGEX = re.compile(r"^(>=|<=|><)?(.*)$")
+USER_ID = web.RequestKey("user_id", int) # the acting user, after X-Redmine-Switch-User
+
+
+def parse_time(value: str) -> dt.datetime:
+    if len(value) == 10: # date only
+        value += "T00:00:00Z"
+    return synctime.parse_str(value)
+
+
+class RedmineData():
+    """The in-memory contents of the emulated Redmine, as API-shaped dicts"""
+    def __init__(self):
+        self.users: dict[int, dict] = {}
+        self.groups: dict[int, dict] = {}
+        self.issues: dict[int, dict] = {}
+        self.time_entries: dict[int, dict] = {}
+        self.memberships: dict[int, dict] = {}
+        self.uploads: dict[str, dict] = {} # token -> filename, content_type, size
+        self.attached: set[str] = set() # upload tokens, which like redmine's can be attached once
+        self.next_id = 1000
+        self.add_user("admin", "Redmine", "Admin", "admin@example.com", user_id=ADMIN_ID, admin=True)
+
+
+    def new_id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+
+    def named(self, principal_id: int) -> dict | None:
+        """the named-id of a user or group"""
+        if principal_id in self.users:
+            user = self.users[principal_id]
+            return {"id": user["id"], "name": f"{user['firstname']} {user['lastname']}"}
+        if principal_id in self.groups:
+            return {"id": principal_id, "name": self.groups[principal_id]["name"]}
+        return None
+
+
+    def find_login(self, login: str) -> dict | None:
+        for user in self.users.values():
+            if user["login"] == login:
+                return user
+        return None
+
+
+    def find_group(self, name: str) -> dict | None:
+        for group in self.groups.values():
+            if group["name"] == name:
+                return group
+        return None
+
+
+    def add_user(self, login: str, firstname: str, lastname: str, mail: str, discord: str = "",
+                 user_id: int | None = None, admin: bool = False, status: int = 1) -> dict:
+        now = synctime.zulu(synctime.now())
+        user = {
+            "id": user_id or self.new_id(),
+            "login": login,
+            "admin": admin,
+            "firstname": firstname,
+            "lastname": lastname,
+            "mail": mail,
+            "created_on": now,
+            "updated_on": now,
+            "last_login_on": None,
+            "passwd_changed_on": now,
+            "twofa_scheme": None,
+            "status": status,
+            "custom_fields": [{"id": DISCORD_FIELD_ID, "name": "Discord ID", "value": discord}],
+        }
+        self.users[user["id"]] = user
+        return user
+
+
+    def add_group(self, name: str, user_ids: list[int] | None = None) -> dict:
+        group = {"id": self.new_id(), "name": name, "user_ids": list(user_ids or [])}
+        self.groups[group["id"]] = group
+        return group
+
+
+    def add_issue(self, fields: dict, author_id: int, created_on: dt.datetime | None = None) -> dict:
+        now = created_on or synctime.now()
+        custom_fields = {field["id"]: {"id": field["id"], "name": field["name"], "value": ""}
+                         for field in CUSTOM_FIELDS if field["id"] in ISSUE_FIELD_IDS}
+        issue = {
+            "id": self.new_id(),
+            "project": PROJECTS[0],
+            "subject": "",
+            "description": "",
+            "start_date": now.strftime("%Y-%m-%d"),
+            "due_date": None,
+            "done_ratio": 0,
+            "is_private": False,
+            "estimated_hours": None,
+            "total_estimated_hours": None,
+            "spent_hours": 0.0,
+            "total_spent_hours": 0.0,
+            "custom_fields": list(custom_fields.values()),
+            "created_on": synctime.zulu(now),
+            "updated_on": synctime.zulu(now),
+            "closed_on": None,
+            "author": self.named(author_id),
+            "status": STATUSES[0],
+            "priority": {"id": 2, "name": "Normal"},
+            "tracker": TRACKERS[3],
+            "journals": [],
+            "watchers": [],
+            "attachments": [],
+        }
+        self.issues[issue["id"]] = issue
+        self.update_issue(issue, fields, author_id, notify=False, timestamp=now)
+        return issue
+
+
+    def update_issue(self, issue: dict, fields: dict, user_id: int, notify: bool = True,
+                     timestamp: dt.datetime | None = None) -> None:
+        """apply the PUT/POST fields to an issue, journaling any notes and changes"""
+        now = timestamp or synctime.now()
+        details = []
+
+        def change(prop: str, name: str, old, new):
+            if old != new:
+                details.append({"property": prop, "name": name, "old_value": old, "new_value": new})
+
+        for key in ["subject", "description", "due_date", "start_date", "done_ratio", "is_private"]:
+            if key in fields:
+                change("attr", key, issue.get(key), fields[key])
+                issue[key] = fields[key]
+
+        if "status_id" in fields:
+            status = next(s for s in STATUSES if s["id"] == int(fields["status_id"]))
+            change("attr", "status_id", issue["status"]["id"], status["id"])
+            issue["status"] = status
+            issue["closed_on"] = synctime.zulu(now) if status["is_closed"] else None
+        if "priority_id" in fields:
+            priority = next(p for p in PRIORITIES if p["id"] == int(fields["priority_id"]))
+            change("attr", "priority_id", issue["priority"]["id"], priority["id"])
+            issue["priority"] = {"id": priority["id"], "name": priority["name"]}
+        if "tracker_id" in fields:
+            tracker = next(t for t in TRACKERS if t["id"] == int(fields["tracker_id"]))
+            change("attr", "tracker_id", issue["tracker"]["id"], tracker["id"])
+            issue["tracker"] = tracker
+        if "assigned_to_id" in fields:
+            assigned = fields["assigned_to_id"]
+            old = issue.get("assigned_to", {}).get("id") if issue.get("assigned_to") else None
+            if assigned in (None, ""):
+                issue.pop("assigned_to", None)
+            else:
+                issue["assigned_to"] = self.named(user_id if assigned == "me" else int(assigned))
+            change("attr", "assigned_to_id", old, assigned)
+        if "parent_issue_id" in fields:
+            parent = fields["parent_issue_id"]
+            issue["parent"] = {"id": int(parent)} if parent else None
+        for field in fields.get("custom_fields", []):
+            for current in issue["custom_fields"]:
+                if current["id"] == int(field["id"]):
+                    change("cf", str(current["id"]), current["value"], field["value"])
+                    current["value"] = field["value"]
+        for upload in fields.get("uploads", []):
+            if upload.get("token") in self.uploads and upload["token"] not in self.attached:
+                self.attached.add(upload["token"])
+                attachment = dict(self.uploads[upload["token"]], id=self.new_id(), filename=upload.get("filename"))
+                issue["attachments"].append(attachment)
+                details.append({"property": "attachment", "name": str(attachment["id"]),
+                                "old_value": None, "new_value": attachment["filename"]})
+
+        notes = fields.get("notes", "")
+        if notify and (notes or details):
+            issue["journals"].append({
+                "id": self.new_id(),
+                "user": self.named(user_id),
+                "notes": notes,
+                "created_on": synctime.zulu(now),
+                "updated_on": synctime.zulu(now),
+                "private_notes": False,
+                "details": details,
+            })
+        issue["updated_on"] = synctime.zulu(now)
+
+
+    def sync_issues(self, fraction: float, seed: int = 0) -> list[int]:
+        """
+        Mark a fraction of the issues as synced to a discord thread, part way
+        through their history. Returns the ids of the synced issues.
+        """
+        rand = random.Random(seed)
+        synced = []
+        for issue in self.issues.values():
+            if rand.random() < fraction:
+                created = synctime.parse_str(issue["created_on"])
+                updated = synctime.parse_str(issue["updated_on"])
+                last_sync = created + (updated - created) / 2
+                for field in issue["custom_fields"]:
+                    if field["id"] == SYNC_FIELD_ID:
+                        field["value"] = f"{SYNC_CHANNEL_BASE + issue['id']}|{last_sync}"
+                synced.append(issue["id"])
+        return synced
+
+
+    @classmethod
+    def generate(cls, users: int = 50, tickets: int = 200, journals: int = 5, seed: int = 0) -> "RedmineData":
+        """A seeded, synthetic dataset. The same arguments always give the same data."""
+        rand = random.Random(seed)
+        data = cls()
+        start = synctime.now() - dt.timedelta(days=90)
+
+        user_ids = []
+        for i in range(users):
+            login = f"user{i:05d}"
+            discord = f"{900000 + i}|discord{i:05d}" if rand.random() < 0.7 else ""
+            user = data.add_user(login, "User", f"Number{i}", f"{login}@example.org", discord)
+            user_ids.append(user["id"])
+
+        for name in TEAMS:
+            members = rand.sample(user_ids, k=min(len(user_ids), rand.randint(0, 12)))
+            data.add_group(name, members)
+
+        team_ids = list(data.groups.keys())
+        for i in range(tickets):
+            created = start + dt.timedelta(minutes=rand.randint(0, 90 * 24 * 60))
+            fields = {
+                "subject": " ".join(rand.choices(WORDS, k=rand.randint(3, 8))).capitalize(),
+                "description": " ".join(rand.choices(WORDS, k=rand.randint(20, 120))),
+                "tracker_id": rand.choice(TRACKERS)["id"],
+                "priority_id": rand.choice(PRIORITIES[:5])["id"],
+                "status_id": rand.choice(STATUSES)["id"],
+            }
+            if rand.random() < 0.6:
+                fields["assigned_to_id"] = rand.choice(user_ids + team_ids)
+            issue = data.add_issue(fields, rand.choice(user_ids) if user_ids else ADMIN_ID, created)
+
+            when = created
+            for _ in range(rand.randint(0, journals * 2)):
+                when += dt.timedelta(minutes=rand.randint(5, 3 * 24 * 60))
+                note = " ".join(rand.choices(WORDS, k=rand.randint(5, 60)))
+                author = rand.choice(user_ids) if user_ids else ADMIN_ID
+                data.update_issue(issue, {"notes": note}, author, timestamp=min(when, synctime.now()))
+
+        return data
+
+
+class LocalRedmine():
+    """aiohttp server for a RedmineData, run in a background thread with its own event loop"""
+    def __init__(self, data: RedmineData | None = None, token: str = DEFAULT_TOKEN,
+                 latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.data = data or RedmineData.generate()
+        self.token = token
+        self.latency = latency # seconds added to each request
+        self.jitter = jitter # max random seconds added on top of latency
+        self.error_rate = error_rate # fraction of requests that fail with a 503
+        self.fail_when: Callable[[web.Request], bool] | None = None # requests it's true for fail with a 503
+        self.random = random.Random(seed)
+        self.host = host
+        self.port = port
+        self.url = ""
+        self.stats: collections.Counter[str] = collections.Counter() # "GET /issues/{id}.json" -> count
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._runner: web.AppRunner | None = None
+        self._thread: threading.Thread | None = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def session(self) -> RedmineSession:
+        """a redmine session connected to this server"""
+        return RedmineSession(self.url, self.token)
+
+
+    def start(self) -> str:
+        """start serving in a background thread, returns the url"""
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._runner = web.AppRunner(self.app())
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, self.host, self.port)
+            self._loop.run_until_complete(site.start())
+            self.port = self._runner.addresses[0][1]
+            self.url = f"http://{self.host}:{self.port}"
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=serve, name="local-redmine", daemon=True)
+        self._thread.start()
+        started.wait()
+        log.info(f"local redmine running at {self.url}, {len(self.data.issues)} issues, {len(self.data.users)} users")
+        return self.url
+
+
+    def stop(self) -> None:
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware], client_max_size=64 * 1024 * 1024)
+        app.add_routes([
+            web.get("/issues.json", self.get_issues),
+            web.post("/issues.json", self.create_issue),
+            web.get(r"/issues/{id:\d+}.json", self.get_issue),
+            web.put(r"/issues/{id:\d+}.json", self.update_issue),
+            web.delete(r"/issues/{id:\d+}.json", self.delete_issue),
+            web.post(r"/issues/{id:\d+}/watchers.json", self.add_watcher),
+            web.get("/search.json", self.search),
+            web.get("/users.json", self.get_users),
+            web.post("/users.json", self.create_user),
+            web.get(r"/users/{id:\d+}.json", self.get_user),
+            web.put(r"/users/{id:\d+}.json", self.update_user),
+            web.delete(r"/users/{id:\d+}.json", self.delete_user),
+            web.get("/groups.json", self.get_groups),
+            web.post("/groups.json", self.create_group),
+            web.get(r"/groups/{id:\d+}.json", self.get_group),
+            web.delete(r"/groups/{id:\d+}.json", self.delete_group),
+            web.post(r"/groups/{id:\d+}/users.json", self.add_group_user),
+            web.delete(r"/groups/{id:\d+}/users/{user_id:\d+}.json", self.remove_group_user),
+            web.post(r"/projects/{project}/memberships.json", self.create_membership),
+            web.post("/uploads.json", self.upload),
+            web.get("/time_entries.json", self.get_time_entries),
+            web.post("/time_entries.json", self.create_time_entry),
+            web.get("/issue_statuses.json", self.enumeration("issue_statuses", STATUSES)),
+            web.get("/trackers.json", self.enumeration("trackers", TRACKERS)),
+            web.get("/custom_fields.json", self.enumeration("custom_fields", CUSTOM_FIELDS)),
+            web.get("/roles.json", self.enumeration("roles", ROLES)),
+            web.get("/enumerations/issue_priorities.json", self.enumeration("issue_priorities", PRIORITIES)),
+            web.get("/enumerations/time_entry_activities.json", self.enumeration("time_entry_activities", ACTIVITIES)),
+        ])
+        return app
+
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        route = request.match_info.route.resource
+        name = route.canonical if route else request.path
+        self.stats[f"{request.method} {name}"] += 1
+        request_id = f"local-{sum(self.stats.values())}"
+        headers = {"X-Request-Id": request_id}
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+        if (self.error_rate and self.random.random() < self.error_rate) or (self.fail_when and self.fail_when(request)):
+            return web.json_response({"errors": ["injected failure"]}, status=503, headers=headers)
+
+        if request.headers.get("X-Redmine-API-Key") != self.token:
+            return web.json_response({"errors": ["invalid api key"]}, status=401, headers=headers)
+
+        request[USER_ID] = ADMIN_ID
+        switch_user = request.headers.get("X-Redmine-Switch-User")
+        if switch_user:
+            user = self.data.find_login(switch_user)
+            if user is None:
+                return web.json_response({"errors": [f"unknown user {switch_user}"]}, status=412, headers=headers)
+            request[USER_ID] = user["id"]
+
+        # all handlers run on the server loop, so the data needs no locking
+        try:
+            response = await handler(request)
+        except web.HTTPException as ex:
+            ex.headers.update(headers)
+            raise
+        except Exception as ex:
+            log.exception(f"{request.method} {request.path_qs} failed")
+            return web.json_response({"errors": [str(ex)]}, status=500, headers=headers)
+        response.headers.update(headers)
+        return response
+
+
+    ## helpers
+
+    def page(self, request: web.Request, key: str, items: list) -> web.Response:
+        offset = int(request.query.get("offset", 0))
+        limit = min(int(request.query.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+        return web.json_response({
+            key: items[offset:offset + limit],
+            "total_count": len(items),
+            "offset": offset,
+            "limit": limit,
+        })
+
+
+    def enumeration(self, key: str, values: list[dict]):
+        async def handler(_request: web.Request) -> web.Response:
+            return web.json_response({key: values})
+        return handler
+
+
+    async def body(self, request: web.Request) -> dict:
+        try:
+            return json.loads(await request.text() or "{}")
+        except json.JSONDecodeError as ex:
+            raise web.HTTPUnprocessableEntity(text=json.dumps({"errors": [str(ex)]})) from ex
+
+
+    def lookup(self, collection: dict, request: web.Request, key: str = "id") -> dict:
+        item = collection.get(int(request.match_info[key]))
+        if item is None:
+            raise web.HTTPNotFound()
+        return item
+
+
+    ## issues
+
+    def issue_view(self, issue: dict, include: set[str]) -> dict:
+        view = {k: v for k, v in issue.items() if k not in ("journals", "watchers", "attachments")}
+        if "journals" in include:
+            view["journals"] = issue["journals"]
+        if "watchers" in include:
+            view["watchers"] = issue["watchers"]
+        if "attachments" in include:
+            view["attachments"] = issue["attachments"]
+        if "children" in include:
+            children = [{"id": child["id"], "tracker": child["tracker"], "subject": child["subject"]}
+                        for child in self.data.issues.values()
+                        if child.get("parent") and child["parent"]["id"] == issue["id"]]
+            if children:
+                view["children"] = children
+        return view
+
+
+    def matches(self, issue: dict, query, user_id: int) -> bool:
+        status = query.get("status_id", "open")
+        if status == "open" and issue["status"]["is_closed"]:
+            return False
+        if status == "closed" and not issue["status"]["is_closed"]:
+            return False
+        if status not in ("open", "closed", "*") and issue["status"]["id"] != int(status):
+            return False
+
+        if "issue_id" in query and str(issue["id"]) not in query["issue_id"].split(","):
+            return False
+
+        assigned = query.get("assigned_to_id")
+        if assigned:
+            assigned_id = user_id if assigned == "me" else int(assigned)
+            if not issue.get("assigned_to") or issue["assigned_to"]["id"] != assigned_id:
+                return False
+
+        for param, key in [("author_id", "author"), ("project_id", "project"),
+                           ("tracker_id", "tracker"), ("priority_id", "priority"), ("parent_id", "parent")]:
+            if param in query and (not issue.get(key) or issue[key]["id"] != int(query[param])):
+                return False
+
+        for param in ("created_on", "updated_on", "due_date"):
+            if param in query:
+                op, value = COMPARE_REGEX.match(query[param]).groups()
+                if not issue.get(param):
+                    return False
+                actual = parse_time(issue[param])
+                limit = parse_time(value)
+                if op == ">=" and actual < limit or op == "<=" and actual > limit:
+                    return False
+                if op is None and actual != limit:
+                    return False
+
+        return True
+
+
+    def sort(self, issues: list[dict], sort: str) -> list[dict]:
+        # stable sort, so apply the keys last to first
+        for key in reversed([term for term in sort.split(",") if term]):
+            name, _, order = key.partition(":")
+            if name in ("status", "priority"):
+                keyfunc = lambda issue, name=name: issue[name]["id"]
+            elif name in ("id", "updated_on", "created_on"):
+                keyfunc = lambda issue, name=name: issue[name]
+            else:
+                continue
+            issues.sort(key=keyfunc, reverse=(order == "desc"))
+        return issues
+
+
+    async def get_issues(self, request: web.Request) -> web.Response:
+        issues = [issue for issue in self.data.issues.values() if self.matches(issue, request.query, request[USER_ID])]
+        issues = self.sort(issues, request.query.get("sort", "id:desc"))
+        include = set(request.query.get("include", "").split(","))
+        return self.page(request, "issues", [self.issue_view(issue, include) for issue in issues])
+
+
+    async def get_issue(self, request: web.Request) -> web.Response:
+        issue = self.lookup(self.data.issues, request)
+        include = set(request.query.get("include", "").split(","))
+        return web.json_response({"issue": self.issue_view(issue, include)})
+
+
+    async def create_issue(self, request: web.Request) -> web.Response:
+        fields = (await self.body(request)).get("issue", {})
+        if not fields.get("subject"):
+            return web.json_response({"errors": ["Subject cannot be blank"]}, status=422)
+        issue = self.data.add_issue(fields, request[USER_ID])
+        return web.json_response({"issue": self.issue_view(issue, set())}, status=201)
+
+
+    async def update_issue(self, request: web.Request) -> web.Response:
+        issue = self.lookup(self.data.issues, request)
+        fields = (await self.body(request)).get("issue", {})
+        self.data.update_issue(issue, fields, request[USER_ID])
+        return web.Response(status=204)
+
+
+    async def delete_issue(self, request: web.Request) -> web.Response:
+        issue = self.lookup(self.data.issues, request)
+        del self.data.issues[issue["id"]]
+        return web.Response(status=204)
+
+
+    async def add_watcher(self, request: web.Request) -> web.Response:
+        issue = self.lookup(self.data.issues, request)
+        user_id = int((await self.body(request)).get("user_id", 0))
+        named = self.data.named(user_id)
+        if named is None:
+            return web.json_response({"errors": ["User is invalid"]}, status=422)
+        if named not in issue["watchers"]:
+            issue["watchers"].append(named)
+        return web.Response(status=204)
+
+
+    async def search(self, request: web.Request) -> web.Response:
+        terms = request.query.get("q", "").lower().split()
+        all_words = request.query.get("all_words", "1") == "1"
+        titles_only = request.query.get("titles_only", "0") == "1"
+        open_only = request.query.get("open_issues", "0") == "1"
+
+        results = []
+        for issue in sorted(self.data.issues.values(), key=lambda issue: issue["id"], reverse=True):
+            if open_only and issue["status"]["is_closed"]:
+                continue
+            text = issue["subject"].lower()
+            if not titles_only:
+                text += " " + issue["description"].lower()
+                text += " " + " ".join(journal["notes"].lower() for journal in issue["journals"])
+            found = [term in text for term in terms]
+            if terms and (all(found) if all_words else any(found)):
+                results.append({
+                    "id": issue["id"],
+                    "title": f"{issue['tracker']['name']} #{issue['id']} ({issue['status']['name']}): {issue['subject']}",
+                    "type": "issue",
+                    "url": f"{self.url}/issues/{issue['id']}",
+                    "description": issue["description"][:100],
+                    "datetime": issue["updated_on"],
+                })
+        return self.page(request, "results", results)
+
+
+    ## users
+
+    def user_view(self, user: dict, include: set[str]) -> dict:
+        view = dict(user)
+        if "memberships" in include:
+            view["memberships"] = [
+                {"id": membership["id"], "project": membership["project"],
+                 "roles": [role for role in ROLES if role["id"] in membership["role_ids"]]}
+                for membership in self.data.memberships.values() if membership["user_id"] == user["id"]]
+        if "groups" in include:
+            view["groups"] = [{"id": group["id"], "name": group["name"]}
+                              for group in self.data.groups.values() if user["id"] in group["user_ids"]]
+        return view
+
+
+    async def get_users(self, request: web.Request) -> web.Response:
+        statuses = [int(status) for status in request.query.get("status", "1").split(",") if status]
+        name = request.query.get("name", "").lower()
+        group_id = request.query.get("group_id")
+
+        users = []
+        for user in self.data.users.values():
+            if user["status"] not in statuses:
+                continue
+            if name and not any(name in str(user[key]).lower() for key in ("login", "firstname", "lastname", "mail")):
+                continue
+            if group_id and user["id"] not in self.data.groups.get(int(group_id), {}).get("user_ids", []):
+                continue
+            users.append(user)
+        return self.page(request, "users", users)
+
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        user = self.lookup(self.data.users, request)
+        include = set(request.query.get("include", "").split(","))
+        return web.json_response({"user": self.user_view(user, include)})
+
+
+    async def create_user(self, request: web.Request) -> web.Response:
+        fields = (await self.body(request)).get("user", {})
+        if not fields.get("login") or self.data.find_login(fields["login"]):
+            return web.json_response({"errors": ["Login has already been taken"]}, status=422)
+        user = self.data.add_user(fields["login"], fields.get("firstname", ""), fields.get("lastname", ""),
+                                  fields.get("mail", ""), status=int(fields.get("status", 1)))
+        return web.json_response({"user": user}, status=201)
+
+
+    async def update_user(self, request: web.Request) -> web.Response:
+        user = self.lookup(self.data.users, request)
+        fields = (await self.body(request)).get("user", {})
+        for key in ("login", "firstname", "lastname", "mail", "admin"):
+            if key in fields:
+                user[key] = fields[key]
+        if "status" in fields:
+            user["status"] = int(fields["status"])
+        for field in fields.get("custom_fields", []):
+            for current in user["custom_fields"]:
+                if current["id"] == int(field["id"]):
+                    current["value"] = field["value"]
+        user["updated_on"] = synctime.zulu(synctime.now())
+        return web.Response(status=204)
+
+
+    async def delete_user(self, request: web.Request) -> web.Response:
+        user = self.lookup(self.data.users, request)
+        del self.data.users[user["id"]]
+        for group in self.data.groups.values():
+            if user["id"] in group["user_ids"]:
+                group["user_ids"].remove(user["id"])
+        return web.Response(status=204)
+
+
+    ## groups
+
+    def group_view(self, group: dict, include: set[str]) -> dict:
+        view = {"id": group["id"], "name": group["name"]}
+        if "users" in include:
+            view["users"] = [self.data.named(user_id) for user_id in group["user_ids"] if user_id in self.data.users]
+        return view
+
+
+    async def get_groups(self, request: web.Request) -> web.Response:
+        return self.page(request, "groups", [self.group_view(group, set()) for group in self.data.groups.values()])
+
+
+    async def get_group(self, request: web.Request) -> web.Response:
+        group = self.lookup(self.data.groups, request)
+        include = set(request.query.get("include", "").split(","))
+        return web.json_response({"group": self.group_view(group, include)})
+
+
+    async def create_group(self, request: web.Request) -> web.Response:
+        fields = (await self.body(request)).get("group", {})
+        name = fields.get("name", "")
+        if not name or any(group["name"] == name for group in self.data.groups.values()):
+            return web.json_response({"errors": ["Name has already been taken"]}, status=422)
+        group = self.data.add_group(name, fields.get("user_ids"))
+        return web.json_response({"group": self.group_view(group, {"users"})}, status=201)
+
+
+    async def delete_group(self, request: web.Request) -> web.Response:
+        group = self.lookup(self.data.groups, request)
+        del self.data.groups[group["id"]]
+        return web.Response(status=204)
+
+
+    async def add_group_user(self, request: web.Request) -> web.Response:
+        group = self.lookup(self.data.groups, request)
+        user_id = int((await self.body(request)).get("user_id", 0))
+        if user_id not in self.data.users:
+            return web.json_response({"errors": ["User is invalid"]}, status=422)
+        if user_id not in group["user_ids"]:
+            group["user_ids"].append(user_id)
+        return web.Response(status=204)
+
+
+    async def remove_group_user(self, request: web.Request) -> web.Response:
+        group = self.lookup(self.data.groups, request)
+        user_id = int(request.match_info["user_id"])
+        if user_id not in group["user_ids"]:
+            raise web.HTTPNotFound()
+        group["user_ids"].remove(user_id)
+        return web.Response(status=204)
+
+
+    async def create_membership(self, request: web.Request) -> web.Response:
+        fields = (await self.body(request)).get("membership", {})
+        membership = {
+            "id": self.data.new_id(),
+            "project": PROJECTS[0],
+            "user_id": int(fields.get("user_id", 0)),
+            "role_ids": [int(role_id) for role_id in fields.get("role_ids", [])],
+        }
+        self.data.memberships[membership["id"]] = membership
+        return web.json_response({"membership": membership}, status=201)
+
+
+    ## uploads and time entries
+
+    async def upload(self, request: web.Request) -> web.Response:
+        if request.content_type.startswith("multipart/"):
+            # requests sends files= as multipart form data
+            form = await request.post()
+            part = next(iter(form.values()))
+            content = part.file.read()
+            content_type = part.content_type
+        else:
+            content = await request.read()
+            content_type = request.content_type
+        token = f"{self.data.new_id()}.{hashlib.md5(content).hexdigest()}"
+        self.data.uploads[token] = {
+            "filename": request.query.get("filename", ""),
+            "content_type": content_type,
+            "filesize": len(content),
+        }
+        return web.json_response({"upload": {"token": token}}, status=201)
+
+
+    async def get_time_entries(self, request: web.Request) -> web.Response:
+        entries = []
+        for entry in self.data.time_entries.values():
+            if "issue_id" in request.query and entry["issue"]["id"] != int(request.query["issue_id"]):
+                continue
+            if "user_id" in request.query and entry["user"]["id"] != int(request.query["user_id"]):
+                continue
+            if "from" in request.query and entry["spent_on"] < request.query["from"]:
+                continue
+            if "to" in request.query and entry["spent_on"] > request.query["to"]:
+                continue
+            entries.append(entry)
+        return self.page(request, "time_entries", entries)
+
+
+    async def create_time_entry(self, request: web.Request) -> web.Response:
+        fields = (await self.body(request)).get("time_entry", {})
+        issue = self.data.issues.get(int(fields.get("issue_id", 0)))
+        if issue is None:
+            return web.json_response({"errors": ["Issue is invalid"]}, status=422)
+        activity = next((a for a in ACTIVITIES if a["id"] == int(fields.get("activity_id", 0))), ACTIVITIES[0])
+        now = synctime.now()
+        entry = {
+            "id": self.data.new_id(),
+            "project": PROJECTS[0],
+            "issue": {"id": issue["id"]},
+            "user": self.data.named(int(fields.get("user_id", request[USER_ID]))),
+            "activity": {"id": activity["id"], "name": activity["name"]},
+            "hours": float(fields.get("hours", 0)),
+            "comments": fields.get("comments", ""),
+            "spent_on": fields.get("spent_on", now.strftime("%Y-%m-%d")),
+            "created_on": synctime.zulu(now),
+            "updated_on": synctime.zulu(now),
+        }
+        self.data.time_entries[entry["id"]] = entry
+        issue["spent_hours"] += entry["hours"]
+        return web.json_response({"time_entry": entry}, status=201)
+
+
+def main():
+    """run a standalone local redmine: python -m tests.local_redmine [port]"""
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = LocalRedmine(port=port)
+    server.start()
+    print(f"REDMINE_URL={server.url}\nREDMINE_TOKEN={server.token}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
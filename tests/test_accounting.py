@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Testing redmine call accounting"""
+
+import os
+import json
+import asyncio
+import logging
+import tempfile
+import unittest
+
+from redmine import accounting
+from redmine.accounting import Accounting, Histogram, endpoint_template, UNTAGGED
+from redmine.redmine import Client
+from redmine.session import RedmineSession
+from netbot.formatting import DiscordFormatter
+from tests.local_redmine import LocalRedmine, RedmineData
+
+
+log = logging.getLogger(__name__)
+
+
+class TestAccounting(unittest.TestCase):
+    """Account redmine calls made against the local redmine emulator"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalRedmine(RedmineData.generate(users=20, tickets=20, seed=5))
+        cls.server.start()
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+
+    def setUp(self):
+        self.accounting = Accounting()
+        self.session = RedmineSession(self.server.url, self.server.token, accounting=self.accounting)
+
+
+    def test_endpoint_template(self):
+        self.assertEqual("/issues/{id}.json", endpoint_template("/issues/1234.json?include=journals"))
+        self.assertEqual("/groups/{id}/users/{id}.json", endpoint_template("/groups/12/users/34.json"))
+        self.assertEqual("/issues.json", endpoint_template("/issues.json?status_id=open&limit=100"))
+
+
+    def test_histogram(self):
+        histogram = Histogram((1, 2, 4))
+        for value in [0.5, 1, 1.5, 3, 10]:
+            histogram.observe(value)
+        self.assertEqual(5, histogram.count)
+        self.assertEqual([2, 1, 1, 1], histogram.counts)
+        self.assertEqual(2, histogram.quantile(0.5))
+        self.assertEqual(float("inf"), histogram.quantile(1.0))
+
+
+    def test_operation(self):
+        issue_id = next(iter(self.server.data.issues))
+        with self.accounting.operation("/ticket details") as op:
+            self.session.get(f"/issues/{issue_id}.json?include=journals")
+            self.session.get("/issues/99999999.json")
+        self.assertEqual(2, op.calls)
+        self.session.get("/users.json")
+
+        stats = {stats.name: stats for stats in self.accounting.summary()}
+        details = stats["/ticket details"]
+        self.assertEqual(1, details.runs)
+        self.assertEqual(2, details.calls)
+        self.assertEqual(1, details.errors) # the 404
+        self.assertEqual(2, details.endpoints["GET /issues/{id}.json"])
+        self.assertGreater(details.received, 0)
+        self.assertEqual(2, details.latency.count)
+        self.assertEqual(1, details.calls_per_run.count)
+        self.assertEqual(1, stats[UNTAGGED].calls)
+
+
+    def test_context_propagation(self):
+        async def command():
+            with self.accounting.operation("/scn reindex"):
+                await asyncio.to_thread(self.session.get, "/users.json")
+                await asyncio.to_thread(self.session.get, "/groups.json")
+        asyncio.run(command())
+        stats = self.accounting.summary()[0]
+        self.assertEqual("/scn reindex", stats.name)
+        self.assertEqual(2, stats.calls)
+
+
+    def test_warmup_accounted(self):
+        # the warm-up runs in a thread pool, but is accounted to the caller
+        session = self.server.session()
+        accounting.ACCOUNTING.reset()
+        Client.from_session(session, default_project=1)
+        names = [stats.name for stats in accounting.ACCOUNTING.summary()]
+        self.assertEqual(["startup"], names)
+
+
+    def test_write(self):
+        with self.accounting.operation("email"):
+            self.session.get("/users.json")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.json")
+            self.accounting.write(path)
+            with open(path, encoding="utf-8") as file:
+                data = json.load(file)
+        self.assertEqual("email", data["operations"][0]["name"])
+        self.assertEqual(1, data["operations"][0]["endpoints"]["GET /users.json"])
+
+
+    def test_format_stats(self):
+        with self.accounting.operation("/ticket new"):
+            for _ in range(8):
+                self.session.get("/users.json")
+        msg = DiscordFormatter("http://localhost").format_stats(self.accounting.summary(), self.accounting.since)
+        self.assertIn("/ticket new", msg)
+        self.assertIn("8.0", msg)
+        self.assertTrue(msg.endswith("```"))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Smoke test the benchmark suite at a tiny scale, so it doesn't rot"""
+
+import logging
+import unittest
+
+from benchmarks.runner import Runner, BENCHMARKS
+from benchmarks.suite import Context
+
+
+log = logging.getLogger(__name__)
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Run every benchmark once over a small synthetic dataset"""
+
+    def test_suite(self):
+        context = Context(tickets=40, users=20, journals=2, emails=10, synced=0.25, seed=1)
+        runner = Runner(context, repeat=1)
+        try:
+            results = runner.run()
+        finally:
+            context.close()
+
+        self.assertEqual(len(BENCHMARKS), len(results))
+        for result in results:
+            self.assertIsNone(result.error, result.name)
+            self.assertGreater(result.ops, 0, result.name)
+
+        report = runner.report()
+        self.assertEqual(40, report["params"]["tickets"])
+        self.assertEqual(len(results), len(report["results"]))
+
+
+    def test_synthetic_repeatable(self):
+        first = Context(tickets=10, users=5, emails=5, seed=3)
+        second = Context(tickets=10, users=5, emails=5, seed=3)
+        self.assertEqual(first.emails()[0][:200], second.emails()[0][:200])
+        self.assertEqual([t.subject for t in first.tickets()], [t.subject for t in second.tickets()])
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Testing the sync loop against the fake discord and the local redmine emulator"""
+
+import logging
+import unittest
+
+import discord
+
+from tests import test_utils
+from tests.fake_discord import FakeDiscord, BOT_ID
+
+
+log = logging.getLogger(__name__)
+
+
+class TestFakeDiscord(test_utils.LocalRedmineTestCase):
+    """Exercise NetBot against a fake guild, over a real local redmine"""
+    users = 60
+    tickets = 60
+    journals = 3
+    seed = 11
+    sync_fraction = 0.5
+
+
+    async def test_sweep(self):
+        fake = FakeDiscord.from_data(self.data, messages=2, seed=11)
+        bot = fake.bot(self.redmine)
+        guild = fake.guilds[0]
+        self.assertEqual(len(self.synced), len(guild.threads))
+        incoming = sum(len(thread.messages) for thread in guild.threads)
+
+        await bot.sweep()
+
+        # one history page per thread, and every discord message is now a redmine note
+        self.assertEqual(len(self.synced), fake.stats["GET /channels/{id}/messages"])
+        notes = [journal["notes"] for issue in self.data.issues.values()
+                 for journal in issue["journals"] if journal["notes"].startswith('"Discord":')]
+        self.assertEqual(incoming, len(notes))
+        self.assertEqual(len(fake.sent()), fake.stats["POST /channels/{id}/messages"])
+        self.assertTrue(all(message.author.id == BOT_ID for message in fake.sent()))
+
+        # a second sweep finds nothing new
+        sent = len(fake.sent())
+        await bot.sweep()
+        self.assertEqual(sent, len(fake.sent()))
+
+
+    async def test_merge_notes(self):
+        fake = FakeDiscord.from_data(self.data, seed=11)
+        bot = fake.bot(self.redmine)
+        bot.merge_notes = True
+        guild = fake.guilds[0]
+        thread = guild.threads[0]
+        ticket_id = bot.parse_thread_title(thread.name)
+        alice, bob = guild.members[0], guild.members[1]
+        posts = [(alice, "one"), (alice, "two"), (alice, "three"), (bob, "four"), (alice, "five")]
+        messages = [fake.post(thread, member, content) for member, content in posts]
+
+        journals = len(self.data.issues[ticket_id]["journals"])
+        writes = bot.append_redmine_notes(self.redmine.ticket_mgr.get(ticket_id), messages)
+        self.assertEqual(3, writes) # alice x3, bob, alice
+
+        notes = [journal["notes"] for journal in self.data.issues[ticket_id]["journals"][journals:]]
+        self.assertEqual(3, len(notes))
+        self.assertTrue(all(note.startswith('"Discord":') for note in notes))
+        for message in messages[:3]:
+            self.assertIn(f'"Discord":{message.jump_url}: {message.content}', notes[0])
+        self.assertNotIn("four", notes[0])
+        self.assertIn(messages[3].jump_url, notes[1])
+        self.assertIn(messages[4].jump_url, notes[2])
+
+        # without merging, a note per message
+        bot.merge_notes = False
+        self.assertEqual(5, bot.append_redmine_notes(self.redmine.ticket_mgr.get(ticket_id), messages))
+
+
+    async def test_find_ticket_thread(self):
+        fake = FakeDiscord.from_data(self.data, seed=11)
+        bot = fake.bot(self.redmine)
+        for ticket_id in self.synced:
+            thread = bot.find_ticket_thread(ticket_id)
+            self.assertIsInstance(thread, discord.Thread)
+            self.assertEqual(ticket_id, bot.parse_thread_title(thread.name))
+        self.assertIsNone(bot.find_ticket_thread(99999999))
+
+
+    async def test_create_thread(self):
+        fake = FakeDiscord.from_data(self.data, seed=11)
+        bot = fake.bot(self.redmine)
+        channel = bot.get_channel_by_name("intake")
+        self.assertIsInstance(channel, discord.TextChannel)
+
+        thread = await channel.create_thread(name="Ticket #1: testing")
+        self.assertEqual(thread, bot.get_channel(thread.id))
+        self.assertEqual(channel, thread.parent)
+        with self.assertRaises(discord.HTTPException):
+            await thread.send("x" * 2001)
+        with self.assertRaises(discord.HTTPException):
+            await channel.create_thread(name="x" * 101)
+
+
+    async def test_rate_limit(self):
+        fake = FakeDiscord.from_data(self.data, seed=11, rate_limit=2, rate_period=0.05)
+        thread = fake.guilds[0].threads[0]
+        for i in range(6):
+            await thread.send(f"message {i}")
+        self.assertEqual(6, len(fake.sent()))
+        self.assertGreater(fake.stats["429"], 0)
+        self.assertGreater(fake.throttled, 0.0)
+
+        fake.retry_429 = False
+        with self.assertRaises(discord.HTTPException) as context:
+            for i in range(3):
+                await thread.send(f"message {i}")
+        self.assertEqual(429, context.exception.status)
+
+
+    async def test_sync_roles(self):
+        fake = FakeDiscord.from_data(self.data, seed=11)
+        bot = fake.bot(self.redmine)
+
+        # roles mirror the groups, less the users without a discord id
+        plan = await bot.sync_roles(dry_run=True)
+        self.assertEqual(0, len(plan.adds))
+        removes = len(plan.removes)
+
+        role = next(role for role in fake.guilds[0].roles if role.members)
+        role.members.pop()
+        plan = await bot.sync_roles(dry_run=True)
+        self.assertEqual(removes + 1, len(plan.removes))
+        self.assertIn(role.name, [change.team.name for change in plan.removes])
+
+
+    async def test_daily_tasks(self):
+        fake = FakeDiscord.from_data(self.data, seed=11)
+        bot = fake.bot(self.redmine)
+        await bot.run_daily_tasks()
+        # every reminder is posted to a channel or thread in the fake guild
+        for message in fake.sent():
+            self.assertIn(message.channel.guild, fake.guilds)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 """IMAP test cases"""
 import os
+import time
+import types
 import unittest
 import logging
 import glob
+import hashlib
+import tempfile
+import threading
+from unittest import mock
+from email.message import EmailMessage
 
 from dotenv import load_dotenv
 
 from redmine.model import Message
-from threader import imap
+from redmine.users import BlockedSenders, BLOCKED_RELOAD_FAILURES
+from threader import imap, neardup
+from threader.threadindex import ThreadIndex, THREAD_INDEX_ENV
 from tests import test_utils
+from tests.fake_imap import FakeMailbox, FakeImapClient
 
 
 log = logging.getLogger(__name__)
@@ -20,7 +30,11 @@ class TestMessages(test_utils.RedmineTestCase):
     """Test suite for IMAP functions"""
 
     def setUp(self):
-        self.imap: imap.Client = imap.Client()
+        self.imap: imap.Client = imap.Client(index=ThreadIndex())
+
+
+    def tearDown(self):
+        self.imap.index.close()
 
 
     def test_messages_stripping(self):
@@ -342,4 +356,399 @@ class TestMessages(test_utils.RedmineTestCase):
         finally:
             if user:
                 # remove the user after the test
-                self.redmine.user_mgr.remove(user)
\ No newline at end of file
+                self.redmine.user_mgr.remove(user)
+
+
+class SlowRedactor():
+    """a redactor that waits until ready() is true, as a slow LLM would"""
+    def __init__(self, ready, timeout: float = 5.0):
+        self.ready = ready
+        self.timeout = timeout
+        self.calls = 0
+        self.stalled = False
+
+
+    def redact_text(self, text: str):
+        self.calls += 1
+        deadline = time.monotonic() + self.timeout
+        while not self.ready():
+            if time.monotonic() > deadline:
+                self.stalled = True
+                break
+            time.sleep(0.01)
+        return types.SimpleNamespace(text=f"[redacted] {text}")
+
+
+class TestImapSession(test_utils.LocalRedmineTestCase):
+    """A long-lived IMAP session, against a fake mailbox and the local redmine"""
+
+    seed = 13
+    sync_fraction = 0.0
+    groups = ("users",) # the threader adds email senders to it
+
+    def setUp(self):
+        super().setUp()
+        self.mailbox = FakeMailbox()
+        self.subjects = [issue["subject"] for issue in self.data.issues.values()]
+
+
+    def client(self, **kwargs) -> FakeImapClient:
+        """a client of the fake mailbox, closed after the test"""
+        client = FakeImapClient(self.mailbox, self.redmine, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+
+    def deliver(self, count: int) -> list[int]:
+        # replies to existing tickets
+        return [self.mailbox.deliver(f"Jane Doe <jane{i}@example.org>", f"Re: {self.subjects[i % len(self.subjects)]}",
+                                     f"reply number {i}") for i in range(count)]
+
+
+    def test_batches(self):
+        uids = self.deliver(25)
+        client = self.client(batch_size=10)
+        self.assertEqual(25, client.synchronize())
+        self.assertEqual(uids, self.mailbox.seen())
+        self.assertEqual(1, self.mailbox.stats["login"])
+        self.assertEqual(6, self.mailbox.stats["fetch"]) # headers, then bodies, for each batch
+        self.assertEqual(3, self.mailbox.stats["add_flags"])
+
+        # the session stays open for the next sync
+        self.assertEqual(0, client.synchronize())
+        self.deliver(2)
+        self.assertEqual(2, client.synchronize())
+        self.assertEqual(1, self.mailbox.stats["login"])
+        client.close()
+        self.assertEqual(1, self.mailbox.stats["logout"])
+
+
+    def test_reconnect(self):
+        uids = self.deliver(12)
+        client = self.client(batch_size=5)
+        self.mailbox.fail("fetch")
+        self.mailbox.fail("add_flags")
+        self.assertEqual(12, client.synchronize())
+        self.assertEqual(uids, self.mailbox.seen())
+        self.assertEqual(3, self.mailbox.stats["login"])
+
+        # a connection that fails twice is dropped, and reopened on the next sync
+        self.deliver(1)
+        self.mailbox.fail("search", 2)
+        self.assertEqual(0, client.synchronize())
+        self.assertIsNone(client.server)
+        self.assertEqual(1, client.synchronize())
+
+
+    def test_skip_from_headers(self):
+        self.deliver(1)
+        self.mailbox.deliver("Away <away@example.org>", f"Re: {self.subjects[0]}", "out of the office",
+                             headers={"Auto-Submitted": "auto-replied"})
+        self.mailbox.deliver("Spam <spam@example.org>", f"Re: {self.subjects[0]}", "buy now")
+        twice = {"Message-ID": "<twice@example.org>"}
+        self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[1]}", "sent twice", headers=twice)
+        self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[1]}", "sent twice", headers=twice)
+        spammer = self.data.add_user("spam@example.org", "Spam", "Spammer", "spam@example.org")
+        self.data.find_group("blocked")["user_ids"].append(spammer["id"])
+
+        client = self.client()
+        self.assertEqual(2, client.synchronize())
+        self.assertEqual(5, len(self.mailbox.seen()))
+        self.assertEqual(2, self.mailbox.stats["fetch"]) # the headers, then the wanted bodies together
+
+        # and the duplicate is remembered for later deliveries
+        self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[1]}", "sent twice", headers=twice)
+        self.assertEqual(0, client.synchronize())
+
+
+    def test_error_dump(self):
+        uid = self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[0]}", "can't be processed")
+        client = self.client()
+        def fail(*args):
+            raise ValueError("processing failed")
+        client.handle_message = fail
+
+        self.assertEqual(0, client.synchronize())
+        self.assertEqual({imap.SEEN}, self.mailbox.flags[uid])
+        with open(os.path.join(client.error_dir, f"message-err-{uid}.eml"), "rb") as file:
+            self.assertEqual(self.mailbox.messages[uid], file.read())
+        self.assertFalse(glob.glob("message-err-*.eml"))
+
+
+    def test_large_message(self):
+        client = self.client()
+        client.full_fetch_max = 10_000
+        client.max_attachment = 50_000
+        uid = self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[0]}", "see attached",
+                                   attachments=[("small.bin", b"s" * 2000), ("large.bin", b"l" * 100_000)])
+        size = len(self.mailbox.messages[uid])
+
+        self.assertEqual(1, client.synchronize())
+        # only the text and the small attachment were downloaded
+        self.assertLess(self.mailbox.stats["bytes"], size / 10)
+        self.assertEqual(["small.bin"], [upload["filename"] for upload in self.data.uploads.values()])
+
+
+    def test_attachment_size(self):
+        # the limit is on the decoded size, whether the message is fetched whole or by part
+        client = self.client()
+        client.max_attachment = 50_000
+        for full_fetch_max in (10_000_000, 10_000):
+            client.full_fetch_max = full_fetch_max
+            self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[0]}", "see attached",
+                                 attachments=[("fits.bin", os.urandom(48_000)), ("large.bin", os.urandom(52_000))])
+            self.assertEqual(1, client.synchronize())
+        self.assertEqual(["fits.bin", "fits.bin"], [upload["filename"] for upload in self.data.uploads.values()])
+
+
+    def test_spooled_attachments(self):
+        client = self.client()
+        client.full_fetch_max = 10_000
+        client.spool_threshold = 1000
+        content = os.urandom(50_000)
+        self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[0]}", "by part",
+                             attachments=[("photo.jpg", content), ("note.txt", b"small")])
+        self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[1]}", "whole",
+                             attachments=[("scan.pdf", content[:5000])])
+        messages = []
+        handle_message = client.handle_message
+        def record(msg_id, message, *args):
+            messages.append(message)
+            return handle_message(msg_id, message, *args)
+        client.handle_message = record
+
+        self.assertEqual(2, client.synchronize())
+        # the uploads are the exact content, streamed from the spool files
+        uploads = {upload["filename"]: upload["filesize"] for upload in self.data.uploads.values()}
+        self.assertEqual({"photo.jpg": 50_000, "note.txt": 5, "scan.pdf": 5000}, uploads)
+        digests = {token.split(".")[1] for token in self.data.uploads}
+        self.assertIn(hashlib.md5(content).hexdigest(), digests)
+        attachments = {a.name: a for message in messages for a in message.attachments}
+        self.assertTrue(attachments["photo.jpg"].spooled)
+        self.assertTrue(attachments["scan.pdf"].spooled)
+        self.assertFalse(attachments["note.txt"].spooled)
+        # and the spools were removed after the upload
+        self.assertTrue(all(a.closed for a in attachments.values()))
+
+
+    def test_parse_attachments(self):
+        # attachments in the whole message are decoded into the spool a chunk at a time
+        client = self.client()
+        client.spool_threshold = 1000
+        content = os.urandom(300_000)
+        email = EmailMessage()
+        email["From"] = "Jane Doe <jane@example.org>"
+        email["Subject"] = "attached"
+        email.set_content("see attached")
+        email.add_attachment(content, maintype="application", subtype="octet-stream", filename="data.bin")
+        email.add_attachment("caf\u00e9 " * 400, subtype="plain", filename="notes.txt", cte="quoted-printable")
+        email.add_attachment(b"\xe9t\xe9\n" * 10, maintype="text", subtype="plain", filename="latin.txt", cte="8bit")
+
+        message = client.parse_message(email.as_bytes())
+        attachments = {attachment.name: attachment for attachment in message.attachments}
+        self.assertEqual(content, attachments["data.bin"].payload)
+        self.assertEqual(("caf\u00e9 " * 400 + "\n").encode(), attachments["notes.txt"].payload)
+        self.assertEqual(b"\xe9t\xe9\n" * 10, attachments["latin.txt"].payload)
+        self.assertTrue(attachments["data.bin"].spooled)
+        message.close_attachments()
+        self.assertTrue(all(attachment.closed for attachment in attachments.values()))
+
+
+    def test_thread_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ[THREAD_INDEX_ENV] = os.path.join(tmp, "threads.db")
+            try:
+                client = self.client()
+                self.mailbox.deliver("New Sender <new@example.org>", "the repeater is down", "since this morning",
+                                     headers={"Message-ID": "<first@example.org>"})
+                self.assertEqual(1, client.synchronize())
+                (ticket_id, _), = [(issue_id, issue) for issue_id, issue in self.data.issues.items()
+                                   if issue["subject"] == "the repeater is down"]
+
+                # a reply with a different subject is matched from its headers, without a search
+                searches = self.server.stats["GET /search.json"]
+                self.mailbox.deliver("Jane Doe <jane@example.org>", "Re: status?", "it's back up",
+                                     headers={"Message-ID": "<second@example.org>", "In-Reply-To": "<first@example.org>",
+                                              "References": "<first@example.org>"})
+                # and so is a reply to redmine's notification
+                self.mailbox.deliver("Jane Doe <jane@example.org>", "Re: [SCN] update", "thanks",
+                                     headers={"In-Reply-To": f"<redmine.issue-{ticket_id}.20260101.abc@example.org>"})
+                self.assertEqual(2, client.synchronize())
+                self.assertEqual(searches, self.server.stats["GET /search.json"])
+                self.assertEqual([ticket_id, ticket_id], [issue_id for issue_id, _ in self.notes("it's back up") +
+                                                          self.notes("thanks")])
+                client.close()
+
+                # the index is kept, so a new session still skips a duplicate delivery
+                client = self.client()
+                self.mailbox.deliver("Jane Doe <jane@example.org>", "Re: status?", "it's back up",
+                                     headers={"Message-ID": "<second@example.org>"})
+                self.assertEqual(0, client.synchronize())
+                self.assertEqual(3, len(client.index))
+                client.close()
+            finally:
+                del os.environ[THREAD_INDEX_ENV]
+
+
+    def test_blocked_senders(self):
+        spammer = self.data.add_user("spam@example.org", "Spam", "Spammer", "spam@example.org")
+        self.data.find_group("blocked")["user_ids"].append(spammer["id"])
+        self.mailbox.folders["Quarantine"] = []
+        client = self.client()
+        client.quarantine = "Quarantine"
+        blocked = self.redmine.user_mgr.blocked
+        self.assertTrue(blocked.is_blocked_address("Spam@Example.org")) # loads the team
+
+        # no redmine requests at all for blocked mail
+        requests = sum(self.server.stats.values())
+        uids = [self.mailbox.deliver("Spam <spam@example.org>", "buy now", f"offer number {i}") for i in range(3)]
+        self.assertEqual(0, client.synchronize())
+        self.assertEqual(requests, sum(self.server.stats.values()))
+        self.assertEqual(3, len(self.mailbox.folders["Quarantine"]))
+        self.assertTrue(all(imap.DELETED in self.mailbox.flags[uid] for uid in uids))
+
+        # without the folder, they're kept in the inbox
+        client.quarantine = "Missing"
+        uid = self.mailbox.deliver("Spam <spam@example.org>", "buy now", "last chance")
+        self.assertEqual(0, client.synchronize())
+        self.assertEqual({imap.SEEN}, self.mailbox.flags[uid])
+
+        # unblocking takes effect right away, and the team is reloaded when it's stale
+        user = self.redmine.user_mgr.get(spammer["id"])
+        self.redmine.user_mgr.unblock(user)
+        self.assertFalse(blocked.is_blocked(user))
+        team = self.redmine.user_mgr.get_team_by_name("blocked")
+        self.redmine.user_mgr.add_team_member(team, spammer["id"]) # blocked by another process
+        self.assertFalse(blocked.is_blocked_address("spam@example.org"))
+        blocked.loaded -= blocked.refresh
+        listings = self.server.stats["GET /users.json"]
+        self.assertTrue(blocked.is_blocked_address("spam@example.org"))
+        self.assertEqual(listings + 1, self.server.stats["GET /users.json"]) # the members, with their addresses
+
+        # when a reload fails, the last known members are used, and the failure is counted
+        failures = BLOCKED_RELOAD_FAILURES.values.get((), 0)
+        blocked.loaded -= blocked.refresh
+        with mock.patch.object(self.redmine.user_mgr.session, "get", return_value=None):
+            self.assertTrue(blocked.is_blocked_address("spam@example.org"))
+        self.assertEqual(failures + 1, BLOCKED_RELOAD_FAILURES.values[()])
+
+
+    def test_blocked_senders_retry(self):
+        spammer = self.data.add_user("spam@example.org", "Spam", "Spammer", "spam@example.org")
+        self.data.find_group("blocked")["user_ids"].append(spammer["id"])
+        blocked = BlockedSenders(self.redmine.user_mgr)
+
+        # the first load fails, so nobody is blocked yet
+        failures = BLOCKED_RELOAD_FAILURES.values.get((), 0)
+        with mock.patch.object(self.redmine.user_mgr.session, "get", return_value=None):
+            self.assertFalse(blocked.is_blocked_address("spam@example.org"))
+        self.assertEqual(failures + 1, BLOCKED_RELOAD_FAILURES.values[()])
+        self.assertIsNone(blocked.loaded)
+
+        # not tried again right away
+        requests = sum(self.server.stats.values())
+        self.assertFalse(blocked.is_blocked_address("spam@example.org"))
+        self.assertEqual(requests, sum(self.server.stats.values()))
+
+        # but well before the refresh
+        blocked.failed -= blocked.retry
+        self.assertTrue(blocked.is_blocked_address("spam@example.org"))
+        self.assertIsNotNone(blocked.loaded)
+        self.assertIsNone(blocked.failed)
+
+
+    def deliver_copies(self, count: int) -> None:
+        """the same text from one sender, a little different each time, as an SMS gateway might send it"""
+        text = "The repeater on the hill site is down again and the backup battery is flat, please call me"
+        for i in range(count):
+            self.mailbox.deliver("Sms Gateway <sms@example.org>", "sms alert", f"{text}{'!' * i} (copy {i})")
+
+
+    def test_near_duplicates(self):
+        self.deliver_copies(3)
+        client = self.client()
+        # a slow redaction, so the copies are all matched before the first ticket is created
+        redactor = client.redactor = SlowRedactor(lambda: False, timeout=0.5)
+        self.assertEqual(3, client.synchronize())
+
+        self.assertEqual(1, redactor.calls)
+        created = [issue_id for issue_id, issue in self.data.issues.items() if issue["subject"] == "sms alert"]
+        self.assertEqual(1, len(created))
+        self.assertEqual(created * 2, [issue_id for issue_id, _ in self.notes("please call me")])
+
+
+    def test_near_duplicates_dropped(self):
+        self.deliver_copies(2)
+        client = self.client()
+        client.near_dups.action = neardup.DROP
+        client.redactor = SlowRedactor(lambda: False, timeout=0.2)
+        resolved = []
+        resolve_user = client.resolve_user
+        def record(message, addr, *args):
+            resolved.append(addr)
+            return resolve_user(message, addr, *args)
+        client.resolve_user = record
+
+        self.assertEqual(2, client.synchronize())
+        self.assertEqual(2, len(self.mailbox.seen()))
+        self.assertEqual(1, len([issue for issue in self.data.issues.values() if issue["subject"] == "sms alert"]))
+        self.assertEqual([], self.notes("please call me"))
+        self.assertEqual(["sms@example.org"], resolved) # the dropped copy didn't look up its sender
+
+
+    def notes(self, text: str) -> list[tuple[int, int]]:
+        """(issue id, journal index) of the notes containing text"""
+        return [(issue_id, i) for issue_id, issue in self.data.issues.items()
+                for i, journal in enumerate(issue["journals"]) if text in journal["notes"]]
+
+
+    def test_pipeline(self):
+        self.mailbox.deliver("New Sender <new@example.org>", "antenna mast fell over", "slow to redact")
+        self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[0]}", "first reply")
+        self.mailbox.deliver("Jane Doe <jane@example.org>", f"Re: {self.subjects[0]}", "second reply")
+        self.deliver(1)
+
+        client = self.client()
+        redactor = client.redactor = SlowRedactor(lambda: self.notes("reply number 0"))
+        self.assertEqual(4, client.synchronize())
+
+        # the slow redaction didn't hold up the other emails
+        self.assertFalse(redactor.stalled)
+        self.assertEqual(1, redactor.calls) # only new tickets are redacted
+        created = [issue for issue in self.data.issues.values() if issue["subject"] == "antenna mast fell over"]
+        self.assertEqual(1, len(created))
+        self.assertIn("[redacted]", created[0]["description"])
+
+        # replies to the same ticket are written in order
+        (first_issue, first), = self.notes("first reply")
+        (second_issue, second), = self.notes("second reply")
+        self.assertEqual(first_issue, second_issue)
+        self.assertLess(first, second)
+
+
+    def test_idle(self):
+        client = self.client()
+        # no mail: IDLE is renewed until the timeout
+        client.idle_renew = 0.05
+        self.assertFalse(client.wait_for_mail(0.2))
+        self.assertGreater(self.mailbox.stats["idle"], 1)
+
+        # new mail wakes the wait right away
+        threading.Timer(0.05, self.deliver, (1,)).start()
+        start = time.monotonic()
+        self.assertTrue(client.wait_for_mail(10))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(1, client.synchronize())
+
+
+    def test_idle_fallback(self):
+        client = self.client()
+        self.mailbox.capabilities.discard(b"IDLE")
+        self.assertFalse(client.wait_for_mail(0.05))
+        self.assertEqual(0, self.mailbox.stats["idle"])
+
+        # a lost connection wakes the wait, to check for mail over a new one
+        self.mailbox.capabilities.add(b"IDLE")
+        self.mailbox.fail("idle")
+        self.assertTrue(client.wait_for_mail(10))
+        self.assertIsNone(client.server)
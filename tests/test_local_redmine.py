@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Testing the redmine client against the local redmine emulator"""
+
+import time
+import logging
+import unittest
+import datetime as dt
+
+from redmine import synctime
+from redmine.model import Message
+from redmine.redmine import Client
+from redmine.session import RedmineException
+from tests.local_redmine import LocalRedmine, RedmineData, STATUSES
+
+
+log = logging.getLogger(__name__)
+
+
+class TestLocalRedmine(unittest.TestCase):
+    """Exercise the redmine package over real HTTP, against a local emulator"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalRedmine(RedmineData.generate(users=150, tickets=120, seed=42))
+        cls.server.start()
+        cls.redmine = Client.from_session(cls.server.session(), default_project=1)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+
+    def setUp(self):
+        self.server.latency = 0.0
+        self.server.error_rate = 0.0
+
+
+    def test_seeded(self):
+        first = RedmineData.generate(users=10, tickets=10, seed=7)
+        second = RedmineData.generate(users=10, tickets=10, seed=7)
+        self.assertEqual([i["subject"] for i in first.issues.values()], [i["subject"] for i in second.issues.values()])
+
+
+    def test_paginated_users(self):
+        # more than one page of 100
+        self.assertEqual(151, len(self.redmine.user_mgr.get_all()))
+        self.assertIsNotNone(self.redmine.user_mgr.cache.find("user00149"))
+
+
+    def test_paginated_updates(self):
+        # more open tickets updated than fit in a page of 100
+        data = RedmineData.generate(users=5, tickets=150, seed=3)
+        since = synctime.now() - dt.timedelta(seconds=5)
+        for issue in data.issues.values():
+            issue["status"] = STATUSES[0]
+            issue["updated_on"] = synctime.zulu(synctime.now())
+        with LocalRedmine(data) as server:
+            redmine = Client.from_session(server.session(), default_project=1)
+            self.assertEqual(sorted(data.issues), sorted(t.id for t in redmine.ticket_mgr.updated_since(since)))
+
+            # a page that fails fails the whole check, rather than return the first page
+            server.fail_when = lambda request: request.path == "/issues.json" and request.query.get("offset") == "100"
+            with self.assertRaises(RedmineException):
+                redmine.ticket_mgr.updated_since(since)
+
+
+    def test_ticket_lifecycle(self):
+        user = self.redmine.user_mgr.find("user00001")
+        message = Message(user.mail, "Local emulator ticket")
+        message.set_note("created by test_ticket_lifecycle")
+
+        ticket = self.redmine.create_ticket(user, message)
+        self.assertEqual("Local emulator ticket", ticket.subject)
+        self.assertEqual(user.id, ticket.author.id)
+
+        self.redmine.ticket_mgr.append_message(ticket.id, user.login, "a follow-up note")
+        self.redmine.ticket_mgr.progress_ticket(ticket.id)
+
+        updated = self.redmine.ticket_mgr.get(ticket.id, include="journals")
+        self.assertEqual("In Progress", updated.status.name)
+        self.assertIn("a follow-up note", [note.notes for note in updated.journals])
+
+        found = self.redmine.ticket_mgr.search("emulator")
+        self.assertIn(ticket.id, [t.id for t in found])
+
+
+    def test_team_membership(self):
+        user = self.redmine.user_mgr.find("user00002")
+        team = self.redmine.user_mgr.get_team_by_name("research-team")
+
+        self.redmine.user_mgr.add_team_member(team, user.id)
+        self.assertTrue(self.redmine.user_mgr.is_user_in(user, self.redmine.user_mgr.get_team(team.id)))
+
+        self.redmine.user_mgr.remove_team_member(team, user.id)
+        self.assertFalse(self.redmine.user_mgr.is_user_in(user, self.redmine.user_mgr.get_team(team.id)))
+
+
+    def test_latency(self):
+        self.server.latency = 0.1
+        start = time.perf_counter()
+        self.redmine.ticket_mgr.get(next(iter(self.server.data.issues)))
+        self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+
+
+    def test_errors(self):
+        self.server.error_rate = 1.0
+        # GET failures are logged and return None, writes raise
+        self.assertIsNone(self.redmine.ticket_mgr.get(next(iter(self.server.data.issues))))
+        with self.assertRaises(RedmineException):
+            self.redmine.user_mgr.create_team("failing-team")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Testing the prometheus metrics endpoint"""
+
+import os
+import logging
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+from redmine.accounting import Accounting
+from redmine.metrics import Registry, MetricsServer, CONTENT_TYPE, DEFAULT_METRICS_HOST, METRICS_PORT_ENV
+
+
+log = logging.getLogger(__name__)
+
+
+class TestMetrics(unittest.TestCase):
+    """Render and serve metrics in the prometheus text format"""
+
+    def setUp(self):
+        self.accounting = Accounting()
+        self.registry = Registry(self.accounting)
+
+
+    def test_counter(self):
+        notes = self.registry.counter("notes_total", "Notes copied", ("direction",))
+        notes.inc(direction="to_discord")
+        notes.inc(3, direction="to_redmine")
+        text = self.registry.render()
+        self.assertIn("# TYPE notes_total counter", text)
+        self.assertIn('notes_total{direction="to_discord"} 1', text)
+        self.assertIn('notes_total{direction="to_redmine"} 3', text)
+        with self.assertRaises(ValueError):
+            notes.inc(channel="x")
+
+
+    def test_gauge(self):
+        depth = self.registry.gauge("queue_depth", "Pending jobs")
+        depth.set_function(lambda: 7)
+        self.assertIn("queue_depth 7", self.registry.render())
+
+        # an unreadable value keeps the last one
+        def unreadable() -> float:
+            raise OSError("no queue state")
+        depth.set_function(unreadable)
+        self.assertIn("queue_depth 7", self.registry.render())
+
+
+    def test_histogram(self):
+        sweep = self.registry.histogram("sweep_seconds", "Sweep time", buckets=(1, 5))
+        sweep.observe(0.5)
+        sweep.observe(3)
+        sweep.observe(30)
+        text = self.registry.render()
+        self.assertIn('sweep_seconds_bucket{le="1"} 1', text)
+        self.assertIn('sweep_seconds_bucket{le="5"} 2', text)
+        self.assertIn('sweep_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn("sweep_seconds_count 3", text)
+        self.assertIn("sweep_seconds_sum 33.5", text)
+
+
+    def test_accounting(self):
+        with self.accounting.operation("/ticket new"):
+            self.accounting.record("GET", "/issues/12.json", 200, 0, 100, 0.02)
+            self.accounting.record("POST", "/issues.json", 422, 50, 10, 0.2)
+        text = self.registry.render()
+        self.assertIn('redmine_request_seconds_count{operation="/ticket new"} 2', text)
+        self.assertIn('redmine_requests_total{operation="/ticket new",status="422"} 1', text)
+        self.assertIn('redmine_request_errors_total{operation="/ticket new"} 1', text)
+        self.assertIn('redmine_operation_runs_total{operation="/ticket new"} 1', text)
+
+
+    def test_server(self):
+        self.registry.counter("up_total", "Always one").inc()
+        with mock.patch.dict(os.environ, {METRICS_PORT_ENV: "0"}):
+            server = MetricsServer.fromenv()
+        server.stop()
+        self.assertEqual(DEFAULT_METRICS_HOST, server.host) # local only, unless METRICS_HOST is set
+
+        server = MetricsServer(self.registry)
+        url = server.start()
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertEqual(CONTENT_TYPE, response.headers["Content-Type"])
+                self.assertIn("up_total 1", response.read().decode())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url.replace("/metrics", "/other"), timeout=5)
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Testing near-duplicate detection of emails"""
+
+import logging
+import unittest
+
+from threader.neardup import NearDuplicates, simhash, distance
+
+
+log = logging.getLogger(__name__)
+
+
+TEXT = ("the repeater on the hill site is down again and the backup battery is flat please call me when you "
+        "get this message we tried to reset the controller twice but it keeps rebooting after a few minutes "
+        "and the logs show a power fault on the main board")
+
+
+class TestNearDuplicates(unittest.TestCase):
+    """Find recent, similar messages from the same sender"""
+
+    def test_simhash(self):
+        self.assertEqual(0, distance(simhash(TEXT), simhash(TEXT.upper() + "!!")))
+        self.assertEqual(0, distance(simhash(TEXT + " sent 10:42"), simhash(TEXT + " sent 11:07")))
+        self.assertLessEqual(distance(simhash(TEXT), simhash(TEXT.replace("twice", "again"))), 6)
+        other = "our net meeting moved to thursday evening so bring the new antenna plans and the budget for the tower"
+        self.assertGreater(distance(simhash(TEXT), simhash(other)), 12)
+        self.assertIsNone(simhash("thanks!"))
+
+
+    def test_match(self):
+        near = NearDuplicates(window=60)
+        first, new = near.match("sms@example.org", TEXT, now=0)
+        self.assertTrue(new)
+        ticket, new = near.match("SMS@example.org", TEXT + " again", now=10)
+        self.assertFalse(new)
+        self.assertIs(first, ticket)
+        first.set_result(42)
+        self.assertEqual(42, ticket.result())
+
+        # another sender, a short text, and after the window
+        self.assertTrue(near.match("other@example.org", TEXT, now=10)[1])
+        self.assertEqual((None, False), near.match("sms@example.org", "ok thanks", now=10))
+        later, new = near.match("sms@example.org", TEXT, now=100)
+        self.assertTrue(new)
+
+        # a message that failed to get a ticket is forgotten
+        later.set_result(None)
+        self.assertTrue(near.match("sms@example.org", TEXT, now=101)[1])
+
+
+    def test_bounded(self):
+        near = NearDuplicates(max_senders=3, per_sender=2)
+        for i in range(5):
+            near.match(f"sender{i}@example.org", TEXT, now=0)
+            near.match("sms@example.org", f"{TEXT} {'x ' * 20 * i}", now=0)
+        self.assertEqual(3, len(near.senders))
+        self.assertEqual(2, len(near.senders["sms@example.org"]))
+        self.assertEqual(["sender3@example.org", "sender4@example.org", "sms@example.org"], list(near.senders))
+
+        off = NearDuplicates(max_distance=-1)
+        self.assertEqual((None, False), off.match("sms@example.org", TEXT))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Prefix index test cases"""
+
+import sys
+import logging
+import unittest
+import threading
+from unittest.mock import MagicMock
+
+from redmine.prefix import PrefixIndex
+from redmine.tickets import RecentTickets
+from netbot.netbot import default_ticket
+from tests import test_utils
+
+
+log = logging.getLogger(__name__)
+
+
+class TestPrefixIndex(unittest.TestCase):
+    """Testing of the prefix index"""
+
+    def test_search(self):
+        index = PrefixIndex.build([
+            ("jsmith", ["jsmith", "john.smith@example.com", "John Smith"]),
+            ("sally", ["sally", "sally@example.org"]),
+        ])
+
+        self.assertEqual(["jsmith"], index.search("smi"))
+        self.assertEqual(["jsmith"], index.search("JOHN"))
+        self.assertEqual(["jsmith", "sally"], index.search("example"))
+        self.assertEqual(["sally"], index.search("sally@ex"))
+        self.assertEqual(["jsmith", "sally"], index.search(""))
+        self.assertEqual(["jsmith"], index.search("mith")) # substring fallback
+        self.assertEqual([], index.search("nobody"))
+        self.assertEqual(1, len(index.search("", limit=1)))
+
+
+    def test_add_remove(self):
+        index = PrefixIndex()
+        index.add("ops", "ops-team")
+        index.add("dev", "dev-team")
+        self.assertEqual(["dev", "ops"], index.search("team"))
+
+        index.remove("ops", "ops-team")
+        self.assertEqual(["dev"], index.search("team"))
+        self.assertEqual([], index.search("ops"))
+
+
+    def test_concurrent_adds(self):
+        index = PrefixIndex()
+        def add(worker: int):
+            for i in range(500):
+                index.add(f"user{worker}-{i}", f"user{worker}-{i}@example.org")
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6) # switch threads as often as possible
+        try:
+            workers = [threading.Thread(target=add, args=(worker,)) for worker in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(sorted(index.entries), index.entries)
+        self.assertEqual(["user3-499"], index.search("user3-499@"))
+
+
+    def test_recent_tickets(self):
+        recent = RecentTickets(max_size=2)
+        first = test_utils.mock_ticket(subject="Router offline")
+        second = test_utils.mock_ticket(subject="Antenna alignment")
+        third = test_utils.mock_ticket(subject="Router firmware")
+
+        recent.add_all([first, second, third])
+
+        # oldest evicted
+        self.assertEqual(2, len(recent))
+        self.assertEqual([(third.id, "Router firmware")], recent.search("rout"))
+        self.assertEqual([(second.id, "Antenna alignment")], recent.search(str(second.id)))
+        self.assertEqual([], recent.search("offline"))
+
+
+class TestUserAutocomplete(test_utils.MockRedmineTestCase):
+    """Mocked testing of the user and team autocomplete indicies"""
+
+    def test_complete_user(self):
+        self.assertIn("test-admin", self.user_mgr.cache.complete_user("test-ad"))
+        self.assertIn(self.user.login, self.user_mgr.cache.complete_user(self.user.mail))
+        self.assertIn(self.user.login, self.user_mgr.cache.complete_user(self.user.discord_id.name[:6]))
+
+
+    def test_complete_team(self):
+        self.assertIn("admin-team", self.user_mgr.cache.complete_team("adm"))
+        self.assertIn("admin-team", self.user_mgr.cache.complete_team("team"))
+
+
+    def test_complete_tracker(self):
+        self.assertIn("Software-Dev", self.tickets_mgr.complete_tracker("soft"))
+
+
+    def test_default_ticket(self):
+        ticket = self.mock_ticket(subject="Mesh node reboot loop")
+        self.tickets_mgr.recent.add(ticket)
+
+        ctx = MagicMock()
+        ctx.bot.redmine = self.redmine
+        ctx.interaction.channel.name = "Ticket #42: something else"
+
+        ctx.value = ""
+        choices = default_ticket(ctx)
+        self.assertEqual(42, choices[0].value) # thread ticket first
+
+        ctx.value = "mesh"
+        choices = default_ticket(ctx)
+        self.assertEqual([ticket.id], [choice.value for choice in choices])
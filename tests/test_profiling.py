@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Testing opt-in profiling"""
+
+import os
+import time
+import logging
+import tempfile
+import unittest
+
+from redmine.profiling import Profiler, safe_name
+
+
+log = logging.getLogger(__name__)
+
+
+def busy_work() -> int:
+    return sum(i * i for i in range(20_000))
+
+
+class TestProfiling(unittest.TestCase):
+    """Profile operations to a temp directory"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.profiler = Profiler(directory=self.tmp.name)
+
+
+    def tearDown(self):
+        self.profiler.disable()
+        self.tmp.cleanup()
+
+
+    def files(self) -> list[str]:
+        return sorted(os.listdir(self.tmp.name))
+
+
+    def test_safe_name(self):
+        self.assertEqual("ticket-query", safe_name("/ticket query"))
+        self.assertEqual("task-sync_due_threads", safe_name("task:sync_due_threads"))
+
+
+    def test_disabled(self):
+        with self.profiler.profile("/ticket query"):
+            busy_work()
+        self.assertEqual([], self.files())
+        self.assertEqual(0, self.profiler.profiled)
+        self.assertEqual("Profiling is off", self.profiler.status())
+
+
+    def test_profile(self):
+        self.profiler.enable()
+        with self.profiler.profile("/ticket query"):
+            busy_work()
+        files = self.files()
+        self.assertEqual(1, len(files))
+        self.assertTrue(files[0].startswith("ticket-query-"))
+        with open(os.path.join(self.tmp.name, files[0]), encoding="utf-8") as file:
+            report = file.read()
+        self.assertIn("/ticket query", report)
+        self.assertIn("busy_work", report)
+        self.assertIn("1 profiled", self.profiler.status())
+
+
+    def test_memory(self):
+        self.profiler.enable(memory=True)
+        with self.profiler.profile("email"):
+            _ = [bytes(1000) for _ in range(100)]
+        with open(self.profiler.last_file, encoding="utf-8") as file:
+            self.assertIn("allocation sites", file.read())
+
+
+    def test_overlap_skipped(self):
+        self.profiler.enable()
+        with self.profiler.profile("task:sync_due_threads"), self.profiler.profile("/ticket query"):
+            busy_work()
+        self.assertEqual(1, self.profiler.profiled)
+        self.assertEqual(1, self.profiler.skipped)
+        self.assertEqual(1, len(self.files()))
+
+
+    def test_exception(self):
+        self.profiler.enable()
+        with self.assertRaises(ValueError), self.profiler.profile("/ticket query"):
+            raise ValueError("failed")
+        # the failed run is still dumped, and the profiler is free again
+        self.assertEqual(1, len(self.files()))
+        self.assertIsNone(self.profiler.active)
+
+
+    def test_prune(self):
+        self.profiler.max_files = 2
+        self.profiler.enable()
+        for _ in range(4):
+            with self.profiler.profile("email"):
+                busy_work()
+            time.sleep(0.01) # distinct mtimes
+        self.assertEqual(2, len(self.files()))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
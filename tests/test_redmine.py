@@ -32,6 +32,9 @@ class TestRedmine(test_utils.MockRedmineTestCase):
 
     def test_reindex(self):
         self.redmine.reindex()
+        report = self.redmine.warmup_report
+        self.assertEqual({"tickets", "users"}, set(report.phases().keys()))
+        self.assertEqual(8, len(report.loads))
 
     def test_find_tracker(self):
         message = Message("test@example.com", "[Infra-Config] Test Subject")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Role sync test cases"""
+
+import unittest
+import logging
+from unittest.mock import MagicMock, patch
+
+import discord
+
+from netbot.rolesync import RoleSync
+from redmine.session import RedmineException
+from tests import test_utils
+
+
+log = logging.getLogger(__name__)
+
+
+def mock_member(name: str, roles: list|None = None) -> discord.Member:
+    member = MagicMock(discord.Member)
+    member.name = name
+    member.roles = roles or []
+    return member
+
+
+def mock_role(name: str, members: list) -> discord.Role:
+    role = MagicMock(discord.Role)
+    role.name = name
+    role.members = members
+    return role
+
+
+def mock_guild(roles: list) -> discord.Guild:
+    guild = MagicMock(discord.Guild)
+    guild.roles = roles
+    return guild
+
+
+class TestRoleSync(test_utils.MockRedmineTestCase, unittest.IsolatedAsyncioTestCase):
+    """Mocked testing of role sync"""
+
+    def setUp(self):
+        # fresh team records for each test, as apply updates the cache
+        self.user_mgr.reindex_teams()
+        self.sync = RoleSync(self.user_mgr)
+        self.admin = self.user_mgr.find("test-admin")
+        self.test_user = self.user_mgr.find("test-user")
+
+
+    def test_plan(self):
+        guild = mock_guild([
+            mock_role("software-dev-team", [mock_member("test-admin")]),
+            mock_role("admin-team", [mock_member("test-admin"), mock_member("unknown-discord-user")]),
+            mock_role("@everyone", [mock_member("test-admin")]),
+        ])
+
+        plan = self.sync.plan([guild])
+
+        self.assertEqual(1, len(plan.adds))
+        self.assertEqual(self.admin.id, plan.adds[0].user.id)
+        self.assertEqual("software-dev-team", plan.adds[0].team.name)
+
+        self.assertEqual(1, len(plan.removes))
+        self.assertEqual(self.test_user.id, plan.removes[0].user.id)
+
+        # admin-team is already in sync, @everyone has no team
+        self.assertEqual(["@everyone"], plan.missing)
+
+
+    @patch('tests.mock_session.MockSession.delete')
+    @patch('tests.mock_session.MockSession.post')
+    async def test_dry_run(self, mock_post:MagicMock, mock_delete:MagicMock):
+        guild = mock_guild([mock_role("software-dev-team", [mock_member("test-admin")])])
+
+        plan = await self.sync.apply(self.sync.plan([guild]), dry_run=True)
+
+        self.assertEqual(2, len(plan))
+        mock_post.assert_not_called()
+        mock_delete.assert_not_called()
+        team = self.user_mgr.cache.get_team_by_name("software-dev-team")
+        self.assertTrue(self.user_mgr.is_user_in(self.test_user, team))
+
+
+    @patch('tests.mock_session.MockSession.delete')
+    @patch('tests.mock_session.MockSession.post')
+    async def test_apply(self, mock_post:MagicMock, mock_delete:MagicMock):
+        guild = mock_guild([mock_role("software-dev-team", [mock_member("test-admin")])])
+
+        plan = await self.sync.apply(self.sync.plan([guild]))
+
+        self.assertEqual(0, len(plan.failed))
+        mock_post.assert_called_once()
+        mock_delete.assert_called_once()
+        self.assertEqual(f"/groups/30/users/{self.test_user.id}.json", mock_delete.call_args.args[0])
+
+        # cache updated in place, a second plan is empty
+        team = self.user_mgr.cache.get_team_by_name("software-dev-team")
+        self.assertTrue(self.user_mgr.is_user_in(self.admin, team))
+        self.assertFalse(self.user_mgr.is_user_in(self.test_user, team))
+        self.assertEqual(0, len(self.sync.plan([guild])))
+
+
+    @patch('tests.mock_session.MockSession.delete')
+    @patch('tests.mock_session.MockSession.post')
+    async def test_apply_failed(self, mock_post:MagicMock, mock_delete:MagicMock):
+        guild = mock_guild([mock_role("software-dev-team", [mock_member("test-admin")])])
+        mock_post.side_effect = RedmineException("POST failed, status=[422]", "test")
+
+        plan = await self.sync.apply(self.sync.plan([guild]))
+
+        # the add failed and is reported, the remove went ahead
+        self.assertEqual(1, len(plan.failed))
+        self.assertEqual(self.admin.id, plan.failed[0].user.id)
+        mock_delete.assert_called_once()
+
+
+    def test_plan_member(self):
+        dev_role = mock_role("software-dev-team", [])
+        admin_role = mock_role("admin-team", [])
+        before = mock_member("test-user", [dev_role])
+        after = mock_member("test-user", [admin_role])
+
+        plan = self.sync.plan_member(before, after)
+
+        self.assertEqual(1, len(plan.adds))
+        self.assertEqual("admin-team", plan.adds[0].team.name)
+        self.assertEqual(1, len(plan.removes))
+        self.assertEqual("software-dev-team", plan.removes[0].team.name)
+
+        # unmapped discord users are ignored
+        self.assertEqual(0, len(self.sync.plan_member(mock_member("nobody"), mock_member("nobody", [admin_role]))))
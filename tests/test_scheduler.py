@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Testing adaptive sync scheduling"""
+
+import logging
+import unittest
+import datetime as dt
+
+from redmine import synctime
+from netbot.netbot import SYNC_SWEEP_SECONDS, THREADS_DUE
+from netbot.scheduler import SyncScheduler
+from tests import test_utils
+from tests.fake_discord import FakeDiscord
+
+
+log = logging.getLogger(__name__)
+
+
+class TestSyncScheduler(unittest.TestCase):
+    """Schedule syncs by thread activity, within a budget"""
+
+    def setUp(self):
+        self.now = synctime.now()
+        self.scheduler = SyncScheduler(min_interval=20, max_interval=4 * 3600, budget=60)
+
+
+    def test_interval(self):
+        def interval(**idle) -> float:
+            return self.scheduler.interval(self.now - dt.timedelta(**idle), self.now).total_seconds()
+        self.assertEqual(20, interval(seconds=30)) # hot
+        self.assertEqual(360, interval(hours=1))
+        self.assertEqual(4 * 3600, interval(days=90)) # cold
+
+
+    def test_most_overdue_first(self):
+        self.scheduler.track([1, 2, 3], now=self.now)
+        self.scheduler.observe(1, self.now - dt.timedelta(days=30), now=self.now) # idle
+        self.scheduler.observe(2, self.now - dt.timedelta(minutes=10), now=self.now) # hot, due in a minute
+        self.assertEqual(3, self.scheduler.next_due(now=self.now)) # new, never synced
+        self.assertIsNone(self.scheduler.next_due(now=self.now))
+        self.scheduler.observe(3, self.now - dt.timedelta(days=2), now=self.now)
+
+        later = self.now + dt.timedelta(seconds=61)
+        self.assertEqual(2, self.scheduler.next_due(now=later))
+        self.assertIsNone(self.scheduler.next_due(now=later))
+
+        # hours later, all are due: the hot thread first, the idle ones in the order they fell due
+        hours = self.now + dt.timedelta(hours=5)
+        self.assertEqual([2, 1, 3], [self.scheduler.next_due(now=hours) for _ in range(3)])
+
+
+    def test_touch(self):
+        self.scheduler.observe(1, self.now - dt.timedelta(days=30), now=self.now)
+        self.assertIsNone(self.scheduler.next_due(now=self.now))
+        self.scheduler.touch(1, now=self.now)
+        self.assertEqual(1, self.scheduler.next_due(now=self.now))
+        self.scheduler.touch(99) # not tracked, ignored
+
+
+    def test_closed(self):
+        self.scheduler.observe(1, self.now - dt.timedelta(days=10), closed=True, now=self.now)
+        self.scheduler.observe(2, self.now - dt.timedelta(days=1), closed=True, now=self.now)
+        self.assertIsNone(self.scheduler.next_due(now=self.now + dt.timedelta(days=1)))
+        self.assertEqual(0, self.scheduler.overdue(now=self.now + dt.timedelta(days=1)))
+        self.assertEqual([1], self.scheduler.to_archive(now=self.now))
+        # reopened
+        self.assertFalse(self.scheduler.is_open(2))
+        self.scheduler.touch(2, now=self.now)
+        self.assertFalse(self.scheduler.is_closed(2))
+        self.assertTrue(self.scheduler.is_open(2))
+        self.assertFalse(self.scheduler.is_open(99)) # not scheduled
+        self.assertEqual(2, self.scheduler.next_due(now=self.now))
+
+
+    def test_track(self):
+        self.scheduler.track([1, 2], now=self.now)
+        self.scheduler.track([2, 3], now=self.now)
+        self.assertEqual({2, 3}, set(self.scheduler.schedules))
+        self.assertEqual(2, self.scheduler.overdue(now=self.now))
+
+
+    def test_budget(self):
+        self.scheduler.track(range(10), now=self.now)
+        synced = []
+        while (thread_id := self.scheduler.next_due(now=self.now)) is not None:
+            synced.append(thread_id)
+            self.scheduler.spend(15)
+        self.assertEqual(4, len(synced)) # 60 requests at 15 each
+        self.assertEqual(6, self.scheduler.overdue(now=self.now))
+
+
+class TestScheduledSync(test_utils.LocalRedmineTestCase):
+    """Run the scheduled sync against the fake discord and the local redmine"""
+    users = 30
+    tickets = 30
+    journals = 2
+    seed = 7
+
+
+    async def test_sync_due_threads(self):
+        fake = FakeDiscord.from_data(self.data, messages=1, seed=7)
+        bot = fake.bot(self.redmine)
+        bot.scheduler = SyncScheduler(budget=20, archive_after=0)
+        guild = fake.guilds[0]
+        ticks = SYNC_SWEEP_SECONDS.values[()].count if () in SYNC_SWEEP_SECONDS.values else 0
+
+        await bot.sync_due_threads()
+        self.assertEqual(ticks + 1, SYNC_SWEEP_SECONDS.values[()].count) # each tick is timed
+        first = fake.stats["GET /channels/{id}/messages"]
+        self.assertGreater(first, 0)
+        self.assertLess(first, len(guild.threads)) # the budget ran out
+        self.assertEqual(len(guild.threads) - first, bot.scheduler.overdue())
+        self.assertEqual(bot.scheduler.overdue(), THREADS_DUE.values[()]) # published by the tick
+
+        # with budget to spare, every thread is synced once, then none are due
+        bot.scheduler.budget = bot.scheduler.tokens = 1000
+        await bot.sync_due_threads()
+        self.assertEqual(len(guild.threads), fake.stats["GET /channels/{id}/messages"])
+        await bot.sync_due_threads()
+        self.assertEqual(len(guild.threads), fake.stats["GET /channels/{id}/messages"])
+        self.assertEqual(0, bot.scheduler.overdue())
+
+
+    async def test_own_sync_writes(self):
+        fake = FakeDiscord.from_data(self.data, messages=1, seed=7)
+        bot = fake.bot(self.redmine)
+        bot.scheduler = SyncScheduler(budget=1000, archive_after=0)
+        bot.updates_checked = synctime.now() - dt.timedelta(seconds=5)
+
+        # the sync records written to redmine by the sync don't make the threads due again
+        await bot.sync_due_threads()
+        written = [ticket_id for ticket_id in bot.sync_writes if not self.data.issues[ticket_id]["status"]["is_closed"]]
+        self.assertGreater(len(written), 0)
+        await bot.sync_updated_tickets()
+        self.assertEqual(0, bot.scheduler.overdue())
+
+        # a later change to the ticket does. updated_on is to the second, so it's a few seconds later.
+        ticket_id = written[0]
+        self.redmine.ticket_mgr.append_message(ticket_id, "admin", "a new note")
+        self.data.issues[ticket_id]["updated_on"] = synctime.zulu(synctime.now() + dt.timedelta(seconds=2))
+        await bot.sync_updated_tickets()
+        self.assertEqual(1, bot.scheduler.overdue())
+
+
+    async def test_failed_update_check(self):
+        fake = FakeDiscord.from_data(self.data, messages=1, seed=7)
+        bot = fake.bot(self.redmine)
+        bot.scheduler = SyncScheduler(budget=1000, archive_after=0)
+        await bot.sync_due_threads()
+        checked = bot.updates_checked = synctime.now() - dt.timedelta(seconds=5)
+        ticket_id = next(ticket_id for ticket_id in bot.sync_writes
+                         if not self.data.issues[ticket_id]["status"]["is_closed"])
+        self.redmine.ticket_mgr.append_message(ticket_id, "admin", "a new note")
+        self.data.issues[ticket_id]["updated_on"] = synctime.zulu(synctime.now() + dt.timedelta(seconds=2))
+
+        # a failed check doesn't move on, so the update is found by the next one
+        self.server.fail_when = lambda request: request.path == "/issues.json"
+        await bot.sync_updated_tickets()
+        self.assertEqual(checked, bot.updates_checked)
+        self.assertEqual(0, bot.scheduler.overdue())
+        self.server.fail_when = None
+        await bot.sync_updated_tickets()
+        self.assertGreater(bot.updates_checked, checked)
+        self.assertEqual(1, bot.scheduler.overdue())
+
+
+    async def test_closed_tickets(self):
+        fake = FakeDiscord.from_data(self.data, seed=7)
+        bot = fake.bot(self.redmine)
+        bot.scheduler = SyncScheduler(budget=1000, archive_after=7)
+        guild = fake.guilds[0]
+        closed = {thread.id for thread in guild.threads
+                  if self.data.issues[bot.parse_thread_title(thread.name)]["status"]["is_closed"]}
+        self.assertGreater(len(closed), 0)
+
+        # a final sync for closed tickets, then idle ones are archived
+        threads = len(guild.threads)
+        await bot.sync_due_threads()
+        self.assertEqual(threads, fake.stats["GET /channels/{id}/messages"])
+        archived = [thread for thread in guild._channels.values() if getattr(thread, "archived", False)]
+        self.assertGreater(len(archived), 1)
+        self.assertTrue(all(thread.id in closed for thread in archived))
+        self.assertEqual(threads - len(archived), len(guild.threads))
+
+        # the sweep skips closed tickets
+        fetched = fake.stats["GET /channels/{id}/messages"]
+        await bot.sweep()
+        self.assertEqual(len(guild.threads) - len(closed - {t.id for t in archived}),
+                         fake.stats["GET /channels/{id}/messages"] - fetched)
+
+        # reopening a ticket unarchives its thread, and it's synced again
+        reopened = archived[0]
+        ticket_id = bot.parse_thread_title(reopened.name)
+        bot.updates_checked = synctime.now() - dt.timedelta(seconds=5)
+        self.redmine.ticket_mgr.update(ticket_id, {"status_id": 1})
+        await bot.sync_updated_tickets()
+        self.assertFalse(reopened.archived)
+        self.assertIn(reopened, guild.threads)
+        await bot.sync_due_threads()
+        self.assertFalse(bot.scheduler.is_closed(reopened.id))
+
+        # posting in an archived thread brings it back, for a final sync of the new message
+        posted = archived[1]
+        fake.post(posted, guild.members[0], "is this fixed?")
+        await bot.sync_due_threads()
+        notes = self.data.issues[bot.parse_thread_title(posted.name)]["journals"]
+        self.assertTrue(any("is this fixed?" in note["notes"] for note in notes))
+        self.assertTrue(bot.scheduler.is_closed(posted.id))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
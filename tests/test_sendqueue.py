@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Testing batched, queued sends to discord"""
+
+import asyncio
+import logging
+import unittest
+
+import discord
+
+from netbot.formatting import pack_messages, MAX_MESSAGE_LEN
+from netbot.sendqueue import SendQueue
+from tests import test_utils
+from tests.local_redmine import RedmineData
+from tests.fake_discord import FakeDiscord
+
+
+log = logging.getLogger(__name__)
+
+
+class TestPackMessages(unittest.TestCase):
+    """Pack notes into as few messages as fit"""
+
+    def test_pack(self):
+        self.assertEqual([], pack_messages([]))
+        self.assertEqual(["a\n\nb\n\nc"], pack_messages(["a", "b", "c"]))
+        self.assertEqual(["aaaa\n\nbb", "cccc"], pack_messages(["aaaa", "bb", "cccc"], max_len=10))
+
+
+    def test_long_parts(self):
+        parts = ["x" * 1500, "y" * 1500, "z" * 2500, "short"]
+        messages = pack_messages(parts)
+        self.assertEqual(4, len(messages))
+        self.assertTrue(all(len(message) <= MAX_MESSAGE_LEN for message in messages))
+        # in order, never split
+        self.assertEqual(["x", "y", "z", "s"], [message[0] for message in messages])
+
+
+class TestSendQueue(unittest.IsolatedAsyncioTestCase):
+    """Send in order per channel, retrying 429s"""
+
+    def setUp(self):
+        self.data = RedmineData.generate(users=10, tickets=10, journals=1, seed=5)
+        self.data.sync_issues(1.0, seed=5)
+
+
+    async def test_ordered(self):
+        fake = FakeDiscord.from_data(self.data, seed=5, rate_limit=2, rate_period=0.05)
+        thread = fake.guilds[0].threads[0]
+        queue = SendQueue()
+        await asyncio.gather(queue.send(thread, "a1", "a2", "a3"), queue.send(thread, "b1", "b2"))
+        self.assertEqual(["a1", "a2", "a3", "b1", "b2"], [message.content for message in thread.messages[-5:]])
+        self.assertEqual(0, len(queue.locks)) # idle channels don't keep a lock
+
+
+    async def test_retry_429(self):
+        fake = FakeDiscord.from_data(self.data, seed=5, rate_limit=1, rate_period=0.05, retry_429=False)
+        thread = fake.guilds[0].threads[0]
+        await SendQueue(backoff=0.02).send(thread, "one", "two", "three")
+        self.assertEqual(["one", "two", "three"], [message.content for message in thread.messages[-3:]])
+        self.assertGreater(fake.stats["429"], 0)
+
+        with self.assertRaises(discord.HTTPException) as context:
+            await SendQueue(retries=0).send(thread, "four", "five")
+        self.assertEqual(429, context.exception.status)
+
+
+class TestBatchedSync(test_utils.LocalRedmineTestCase):
+    """Notes synced to discord are batched"""
+
+    users = 10
+    tickets = 10
+    journals = 6
+    seed = 5
+
+
+    async def test_fewer_messages(self):
+        fake = FakeDiscord.from_data(self.data, seed=5)
+        bot = fake.bot(self.redmine)
+        await bot.sweep()
+        sent = fake.sent()
+        self.assertGreater(len(sent), 0)
+        self.assertLess(fake.stats["POST /channels/{id}/messages"], self.notes_synced(fake))
+        self.assertTrue(all(len(message.content) <= MAX_MESSAGE_LEN for message in sent))
+
+
+    def notes_synced(self, fake: FakeDiscord) -> int:
+        """the number of notes in the sent messages, one author line each"""
+        return sum(message.content.count("> **") for message in fake.sent())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
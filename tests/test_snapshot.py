@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Snapshot test cases"""
+
+import os
+import json
+import logging
+import tempfile
+from unittest.mock import MagicMock, patch
+
+from redmine.redmine import Client
+from redmine.snapshot import Snapshot
+from tests import test_utils
+from tests.mock_session import MockSession
+
+
+log = logging.getLogger(__name__)
+
+
+class TestSnapshot(test_utils.MockRedmineTestCase):
+    """Mocked testing of cache snapshots"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.snapshot = Snapshot(os.path.join(self.tmpdir.name, "snapshot.json"))
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_save_restore(self):
+        self.snapshot.save(self.user_mgr, self.tickets_mgr)
+        self.assertTrue(self.snapshot.exists())
+
+        session = MockSession(self.tag)
+        redmine = Client.from_session(session, default_project=1, snapshot=None)
+        redmine.user_mgr.cache.cache_users([]) # clear, then restore
+        self.assertTrue(self.snapshot.restore(redmine.user_mgr, redmine.ticket_mgr))
+
+        cache = redmine.user_mgr.cache
+        self.assertEqual(self.user_mgr.cache.users, cache.users)
+        self.assertEqual(self.user_mgr.cache.roles, cache.roles)
+        self.assertEqual(self.user_mgr.cache.teams.keys(), cache.teams.keys())
+        self.assertEqual(self.user.id, cache.find_discord_user(self.user.discord_id.name).id)
+        self.assertEqual(self.tickets_mgr.statuses, redmine.ticket_mgr.statuses)
+        self.assertEqual(self.tickets_mgr.custom_fields, redmine.ticket_mgr.custom_fields)
+
+
+    def test_version_mismatch(self):
+        self.snapshot.save(self.user_mgr, self.tickets_mgr)
+        with open(self.snapshot.path, 'r', encoding="utf-8") as file:
+            data = json.load(file)
+        data['version'] = -1
+        with open(self.snapshot.path, 'w', encoding="utf-8") as file:
+            json.dump(data, file)
+
+        self.assertIsNone(self.snapshot.load())
+        self.assertFalse(self.snapshot.restore(self.user_mgr, self.tickets_mgr))
+
+
+    def test_missing(self):
+        self.assertFalse(self.snapshot.exists())
+        self.assertIsNone(self.snapshot.load())
+
+
+    def test_warm_start(self):
+        self.snapshot.save(self.user_mgr, self.tickets_mgr)
+
+        session = MockSession(self.tag)
+        with patch.object(session, 'get', wraps=session.get) as mock_get:
+            redmine = Client.from_session(session, default_project=1, snapshot=self.snapshot)
+            mock_get.assert_not_called()
+
+        self.assertTrue(redmine.warm_start)
+        self.assertIsNotNone(redmine.user_mgr.cache.find(self.user.login))
+
+
+    def test_cold_start_saves(self):
+        session = MockSession(self.tag)
+        redmine = Client.from_session(session, default_project=1, snapshot=self.snapshot)
+
+        self.assertFalse(redmine.warm_start)
+        self.assertTrue(self.snapshot.exists())
+
+
+    @patch('redmine.snapshot.Snapshot.save')
+    def test_reindex_saves(self, mock_save:MagicMock):
+        session = MockSession(self.tag)
+        redmine = Client.from_session(session, default_project=1)
+        redmine.snapshot = self.snapshot
+
+        redmine.reindex()
+        mock_save.assert_called_once()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Testing the local sync store"""
+
+import os
+import logging
+import tempfile
+import unittest
+import datetime as dt
+
+from redmine import synctime
+from redmine.model import SYNC_FIELD_NAME
+from redmine.synctime import SyncRecord
+from netbot.syncstore import SyncStore
+from tests import test_utils
+from tests.fake_discord import FakeDiscord
+
+
+log = logging.getLogger(__name__)
+
+
+class TestSyncStore(unittest.TestCase):
+    """Store and merge sync records in a temp database"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = SyncStore(os.path.join(self.tmp.name, "sync.db"))
+        self.now = synctime.now().replace(microsecond=0)
+
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+
+    def test_put_get(self):
+        self.assertIsNone(self.store.get(1))
+        self.store.put(SyncRecord(1, 100, self.now), SyncRecord(2, 200, self.now))
+        self.assertEqual(2, len(self.store))
+        record = self.store.get(1)
+        self.assertEqual((1, 100, self.now), (record.ticket_id, record.channel_id, record.last_sync))
+
+        self.store.put(SyncRecord(1, 100, self.now + dt.timedelta(minutes=1)))
+        self.assertEqual(self.now + dt.timedelta(minutes=1), self.store.get(1).last_sync)
+        self.store.remove(1)
+        self.assertIsNone(self.store.get(1))
+        self.assertEqual(1, len(self.store))
+
+
+    def test_merge(self):
+        earlier = self.now - dt.timedelta(hours=1)
+        local = SyncRecord(1, 100, self.now)
+        self.assertEqual(local, self.store.merge(local, None))
+        self.assertEqual(local, self.store.merge(local, SyncRecord(1, 0, earlier))) # legacy record
+        self.assertEqual(local, self.store.merge(local, SyncRecord(1, 100, earlier)))
+        # a later sync in redmine, by an older netbot
+        later = SyncRecord(1, 100, self.now + dt.timedelta(minutes=1))
+        self.assertEqual(later, self.store.merge(local, later))
+        # relocated: redmine wins, even if older
+        moved = SyncRecord(1, 200, earlier)
+        self.assertEqual(moved, self.store.merge(local, moved))
+        self.assertEqual(moved, self.store.merge(None, moved))
+
+
+class TestStoredSync(test_utils.LocalRedmineTestCase):
+    """Sync threads with a local store, against the fake discord and the local redmine"""
+    journals = 2
+    seed = 11
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmp.cleanup()
+
+
+    def syncdata(self) -> dict[int, str]:
+        return {issue_id: field["value"] for issue_id, issue in self.data.issues.items()
+                for field in issue["custom_fields"] if field["name"] == SYNC_FIELD_NAME}
+
+
+    async def test_sync_without_writes(self):
+        fake = FakeDiscord.from_data(self.data, messages=2, seed=11)
+        bot = fake.bot(self.redmine)
+        bot.sync_store = SyncStore(os.path.join(self.tmp.name, "sync.db"))
+        self.addCleanup(bot.sync_store.close)
+        guild = fake.guilds[0]
+
+        self.assertEqual(len(guild.threads), bot.reconcile_sync_store())
+        self.assertEqual(len(guild.threads), len(bot.sync_store))
+
+        # discord messages are synced, and the sync time is only saved locally
+        published = self.syncdata()
+        await bot.sweep()
+        self.assertGreater(fake.stats["POST /channels/{id}/messages"], 0)
+        self.assertEqual(published, self.syncdata())
+        thread = guild.threads[0]
+        ticket_id = bot.parse_thread_title(thread.name)
+        stored = bot.sync_store.get(ticket_id)
+        self.assertEqual(thread.id, stored.channel_id)
+        self.assertGreater(stored.last_sync, self.redmine.ticket_mgr.get(ticket_id).get_sync_record().last_sync)
+
+        # nothing new, so nothing more is posted
+        posted = fake.stats["POST /channels/{id}/messages"]
+        await bot.sweep()
+        self.assertEqual(posted, fake.stats["POST /channels/{id}/messages"])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
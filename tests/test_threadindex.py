@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Testing the Message-ID index of email threads"""
+
+import logging
+import unittest
+
+from redmine.model import Message
+from threader.threadindex import ThreadIndex
+
+
+log = logging.getLogger(__name__)
+
+
+class TestThreadIndex(unittest.TestCase):
+    """Match replies to tickets by their In-Reply-To and References"""
+
+    def setUp(self):
+        self.index = ThreadIndex()
+
+
+    def tearDown(self):
+        self.index.close()
+
+
+    def test_references(self):
+        message = Message("jane@example.org", "Re: Re: antenna")
+        message.set_thread(" <c@example.org> ", "<b@example.org>", "<a@example.org>\n <b@example.org>")
+        self.assertEqual("<c@example.org>", message.message_id)
+        self.assertEqual(["<b@example.org>", "<a@example.org>"], message.references) # most recent first
+
+        message.set_thread(None, None, None)
+        self.assertIsNone(message.message_id)
+        self.assertEqual([], message.references)
+
+
+    def test_lookup(self):
+        self.index.add(7, "<a@example.org>")
+        self.index.add(9, "<x@example.org>", ["<b@example.org>"]) # b wasn't delivered here
+        self.assertEqual(7, self.index.lookup(["<a@example.org>"]))
+        self.assertEqual(9, self.index.lookup(["<b@example.org>", "<a@example.org>"]))
+        self.assertEqual(12, self.index.lookup(["<redmine.issue-12.20260101120000.abc@example.org>"]))
+        self.assertIsNone(self.index.lookup(["<unknown@example.org>"]))
+        self.assertIsNone(self.index.lookup([]))
+
+        # only the emails that were added are processed, not the ones they reference
+        self.assertTrue(self.index.is_processed("<x@example.org>"))
+        self.assertFalse(self.index.is_processed("<b@example.org>"))
+        self.assertFalse(self.index.is_processed(None))
+
+        # a referenced email that's delivered later is processed, and keeps its ticket
+        self.index.add(9, "<b@example.org>", ["<a@example.org>"])
+        self.assertTrue(self.index.is_processed("<b@example.org>"))
+        self.assertEqual(7, self.index.lookup(["<a@example.org>"]))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
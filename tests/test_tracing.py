@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Testing email tracing, from the threader to the discord thread"""
+
+import os
+import logging
+import tempfile
+import unittest
+
+from redmine import tracing
+from redmine.model import Message, TRACE_FIELD_NAME
+from redmine.tracing import Tracer
+from netbot.cog_tickets import TicketsCog
+from threader import imap
+from threader.threadindex import ThreadIndex
+from tests import test_utils
+from tests.fake_discord import FakeDiscord
+
+
+log = logging.getLogger(__name__)
+
+
+class TestTracer(unittest.TestCase):
+    """Record spans to a temp JSONL file"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "traces.jsonl")
+        self.tracer = Tracer(self.path, process="threader")
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def test_disabled(self):
+        tracer = Tracer()
+        with tracer.trace("email") as root, tracer.span("parse") as span:
+            self.assertIsNone(tracer.trace_id())
+        self.assertIsNone(root)
+        self.assertIsNone(span)
+        self.assertEqual(0, len(tracer.spans))
+
+
+    def test_spans(self):
+        with self.tracer.trace("email", uid=12) as root:
+            with self.tracer.span("parse"):
+                pass
+            with self.assertRaises(ValueError), self.tracer.span("ticket"):
+                raise ValueError("failed")
+            self.tracer.annotate(ticket=34)
+        # outside a trace, spans aren't recorded
+        with self.tracer.span("match") as span:
+            self.assertIsNone(span)
+
+        parse, ticket, email = self.tracer.spans
+        self.assertEqual(root, email)
+        self.assertEqual({"uid": 12, "ticket": 34}, email.attributes)
+        self.assertIsNone(email.parent_id)
+        self.assertEqual(email.span_id, parse.parent_id)
+        self.assertEqual(email.trace_id, ticket.trace_id)
+        self.assertEqual("ValueError: failed", ticket.error)
+
+        spans = tracing.load([self.path])
+        self.assertEqual(["parse", "ticket", "email"], [span.name for span in spans])
+        timeline = tracing.timelines(spans)[email.trace_id]
+        self.assertEqual("email", timeline[0][1].name)
+        self.assertIn("ERROR ValueError", tracing.format_timeline(email.trace_id, timeline))
+
+
+    def test_resume(self):
+        netbot = Tracer(self.path, process="netbot")
+        with netbot.resume("abc123", "autothread", ticket=1) as autothread, netbot.resume("abc123", "sync") as sync:
+            self.assertEqual(autothread.span_id, sync.parent_id)
+        # each trace is only resumed once per process
+        with netbot.resume("abc123", "sync") as again:
+            self.assertIsNone(again)
+        with netbot.resume(None, "sync") as untraced:
+            self.assertIsNone(untraced)
+        self.assertEqual(2, len(netbot.spans))
+
+
+class TestEndToEnd(test_utils.LocalRedmineTestCase):
+    """Trace an email through the threader, to netbot over the fake discord"""
+
+    seed = 3
+    groups = ("users",) # the threader adds email senders to it
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "traces.jsonl")
+        self.saved = tracing.TRACER
+
+
+    def tearDown(self):
+        tracing.TRACER = self.saved
+        super().tearDown()
+        self.tmp.cleanup()
+
+
+    def use_tracer(self, process: str) -> Tracer:
+        tracing.TRACER = Tracer(self.path, process=process)
+        return tracing.TRACER
+
+
+    async def test_email_update(self):
+        fake = FakeDiscord.from_data(self.data, seed=3)
+        bot = fake.bot(self.redmine)
+
+        # the threader appends an email to an existing ticket
+        ticket = self.redmine.ticket_mgr.get(self.synced[0])
+        threader = imap.Client(self.redmine, ThreadIndex())
+        self.addCleanup(threader.index.close)
+        threader.redactor = None
+        message = Message("Jane Doe <jane.doe@example.org>", f"Re: {ticket.subject}")
+        message.set_note("the antenna is working again")
+        self.use_tracer("threader")
+        with tracing.trace("email", uid=1) as email:
+            threader.handle_message("1", message)
+        # the subject may match more than one ticket, so use the one that was updated
+        updated = next(span for span in tracing.TRACER.spans if span.name == "ticket")
+        self.assertEqual("update", updated.attributes["action"])
+        ticket = self.redmine.ticket_mgr.get(updated.attributes["ticket"])
+        self.assertEqual(email.trace_id, ticket.get_custom_field(TRACE_FIELD_NAME))
+
+        # netbot continues the trace when it syncs the note to discord
+        self.use_tracer("netbot")
+        await bot.sweep()
+        await bot.sweep()
+        spans = tracing.load([self.path])
+        names = {(span.process, span.name) for span in spans}
+        for stage in ["user", "upload", "match", "ticket", "email"]:
+            self.assertIn(("threader", stage), names)
+        synced = [span for span in spans if span.process == "netbot"]
+        self.assertEqual(1, len(synced))
+        self.assertEqual("sync", synced[0].name)
+        self.assertEqual(email.trace_id, synced[0].trace_id)
+
+
+    async def test_autothread(self):
+        fake = FakeDiscord.from_data(self.data, seed=3)
+        bot = fake.bot(self.redmine)
+        cog = TicketsCog(bot)
+
+        self.use_tracer("threader")
+        user = self.redmine.user_mgr.get_by_name("admin")
+        message = Message("admin@example.com", "traced new ticket")
+        message.set_note("a new ticket, to be auto-threaded")
+        with tracing.trace("email") as email:
+            ticket = self.redmine.create_ticket(user, message)
+        self.assertEqual(email.trace_id, ticket.get_custom_field(TRACE_FIELD_NAME))
+
+        self.use_tracer("netbot")
+        with tracing.resume(ticket.get_custom_field(TRACE_FIELD_NAME), "autothread", ticket=ticket.id):
+            self.assertTrue(await cog.sync_ticket(ticket))
+        names = [span.name for span in tracing.TRACER.spans]
+        self.assertEqual(["create_thread", "first_sync", "autothread"], names)
+        self.assertTrue(all(span.trace_id == email.trace_id for span in tracing.TRACER.spans))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
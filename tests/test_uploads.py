@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Testing content-addressed attachment uploads"""
+
+import os
+import struct
+import logging
+import unittest
+
+from redmine.model import Attachment
+from redmine.uploads import UploadCache, image_size, is_junk, JUNK, ATTACHED
+from tests import test_utils
+
+
+log = logging.getLogger(__name__)
+
+
+def png(width: int, height: int) -> bytes:
+    """the start of a PNG image, as far as its size"""
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", width, height) + b"\x08\x06"
+
+
+PIXEL = b"GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00;"
+
+
+class TestUploadCache(unittest.TestCase):
+    """Recognize junk images, and claim released tokens"""
+
+    def test_junk(self):
+        self.assertEqual((1, 1), image_size(PIXEL))
+        self.assertEqual((640, 480), image_size(png(640, 480)))
+        self.assertIsNone(image_size(b"%PDF-1.7"))
+        self.assertTrue(is_junk(Attachment("pixel.gif", "image/gif", PIXEL)))
+        self.assertFalse(is_junk(Attachment("logo.png", "image/png", png(120, 40))))
+        self.assertFalse(is_junk(Attachment("pixel.bin", "application/octet-stream", PIXEL)))
+
+
+    def test_claim(self):
+        cache = UploadCache(ttl=60)
+        attachment = Attachment("report.pdf", "application/pdf", b"report")
+        attachment.set_token("1.abc")
+        cache.release([attachment])
+        self.assertEqual("1.abc", cache.claim(attachment.digest))
+        self.assertIsNone(cache.claim(attachment.digest)) # claimed once
+
+        cache.release([attachment])
+        cache.attached(7, [attachment])
+        self.assertIsNone(attachment.token) # used up
+        self.assertTrue(cache.is_attached(attachment.digest, 7))
+        self.assertFalse(cache.is_attached(attachment.digest, 8))
+
+        expired = UploadCache(ttl=0)
+        attachment.set_token("2.def")
+        expired.release([attachment])
+        self.assertIsNone(expired.claim(attachment.digest))
+
+
+class TestUploads(test_utils.LocalRedmineTestCase):
+    """Upload attachments once, against the local redmine"""
+    users = 10
+    tickets = 10
+    seed = 5
+    sync_fraction = 0.0
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.redmine.user_mgr.get_by_name("admin")
+        self.ticket_ids = list(self.data.issues)
+
+
+    def reply(self, ticket_id: int, *contents: tuple[str, str, bytes]) -> list[Attachment]:
+        """upload the attachments and append them to the ticket, as the threader does"""
+        attachments = [Attachment(name, content_type, content) for name, content_type, content in contents]
+        tickets = self.redmine.ticket_mgr
+        tickets.upload_attachments(self.user, attachments, ticket_id)
+        tickets.append_message(ticket_id, self.user.login, "see attached", attachments)
+        return attachments
+
+
+    def attached(self, ticket_id: int) -> list[str]:
+        return [attachment["filename"] for attachment in self.data.issues[ticket_id]["attachments"]]
+
+
+    def uploads(self) -> int:
+        return self.server.stats["POST /uploads.json"]
+
+
+    def test_upload_once(self):
+        logo = ("logo.png", "image/png", png(120, 40) + os.urandom(500))
+        report = ("report.pdf", "application/pdf", os.urandom(2000))
+        ticket_id, other_id = self.ticket_ids[:2]
+
+        # the same content twice in one email, and a tracking pixel
+        attachments = self.reply(ticket_id, logo, report, ("copy.pdf",) + report[1:], ("pixel.gif", "image/gif", PIXEL))
+        self.assertEqual(2, self.uploads())
+        self.assertEqual(JUNK, attachments[3].skip)
+        self.assertEqual(["logo.png", "report.pdf"], self.attached(ticket_id))
+
+        # a reply with the same signature logo
+        attachments = self.reply(ticket_id, logo, ("photo.jpg", "image/jpeg", os.urandom(1000)))
+        self.assertEqual(3, self.uploads())
+        self.assertEqual(ATTACHED, attachments[0].skip)
+        self.assertEqual(["logo.png", "report.pdf", "photo.jpg"], self.attached(ticket_id))
+
+        # another ticket needs its own upload
+        self.reply(other_id, logo)
+        self.assertEqual(4, self.uploads())
+        self.assertIn("logo.png", self.attached(other_id))
+
+
+    def test_failed_email(self):
+        tickets = self.redmine.ticket_mgr
+        ticket_id = self.ticket_ids[0]
+        content = os.urandom(2000)
+        attachments = [Attachment("report.pdf", "application/pdf", content)]
+        tickets.upload_attachments(self.user, attachments, ticket_id)
+        tickets.uploads.release(attachments) # the email failed before it was added to the ticket
+
+        # processed again, the upload is attached without uploading it again
+        self.reply(ticket_id, ("report.pdf", "application/pdf", content))
+        self.assertEqual(1, self.uploads())
+        self.assertEqual(["report.pdf"], self.attached(ticket_id))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
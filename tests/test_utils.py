@@ -21,6 +21,7 @@ from redmine.session import RedmineSession
 from redmine.redmine import Client
 from netbot.netbot import NetBot, setup_logging, config
 from tests.mock_session import MockSession
+from tests.local_redmine import LocalRedmine, RedmineData
 
 
 log = logging.getLogger(__name__)
@@ -230,6 +231,29 @@ class MockBotTestCase(MockRedmineTestCase, unittest.IsolatedAsyncioTestCase):
         return ctx
 
 
+class LocalRedmineTestCase(unittest.IsolatedAsyncioTestCase):
+    """Abstract base class for testing against a local redmine, with fresh data for each test"""
+    users = 20
+    tickets = 20
+    journals = 1
+    seed = 0
+    sync_fraction = 1.0 # of the tickets with a discord thread, for FakeDiscord
+    groups: tuple[str, ...] = () # more groups, such as "users" for the threader
+
+    def setUp(self):
+        self.data = RedmineData.generate(users=self.users, tickets=self.tickets, journals=self.journals, seed=self.seed)
+        self.synced = self.data.sync_issues(self.sync_fraction, seed=self.seed)
+        for group in self.groups:
+            self.data.add_group(group)
+        self.server = LocalRedmine(self.data)
+        self.server.start()
+        self.redmine = Client.from_session(self.server.session(), default_project=1)
+
+
+    def tearDown(self):
+        self.server.stop()
+
+
 class RedmineTestCase(unittest.TestCase):
     """Abstract base class for testing redmine features"""
 
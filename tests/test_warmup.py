@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Warm-up test cases"""
+
+import time
+import logging
+import unittest
+
+from redmine.session import RedmineException
+from redmine.warmup import Warmup
+
+
+log = logging.getLogger(__name__)
+
+
+def sleeper(seconds: float):
+    def task():
+        time.sleep(seconds)
+    return task
+
+
+def failure():
+    raise ValueError("load failed")
+
+
+class TestWarmup(unittest.TestCase):
+    """Testing of the concurrent warm-up"""
+
+    def test_concurrent(self):
+        warmup = Warmup()
+        warmup.add("tickets", {"a": sleeper(0.2), "b": sleeper(0.2)})
+        warmup.add("users", {"c": sleeper(0.2), "d": sleeper(0.1)})
+
+        report = warmup.run()
+
+        # bounded by the slowest load, not the sum
+        self.assertLess(report.total, 0.5)
+        self.assertEqual(4, len(report.loads))
+        self.assertEqual({"tickets", "users"}, set(report.phases().keys()))
+        self.assertGreaterEqual(report.slowest().seconds, 0.2)
+        self.assertEqual(0, len(report.failed()))
+
+
+    def test_failure(self):
+        warmup = Warmup()
+        warmup.add("tickets", {"ok": sleeper(0.0), "bad": failure})
+
+        with self.assertRaises(RedmineException) as ctx:
+            warmup.run()
+        self.assertIn("tickets.bad", str(ctx.exception))
+
+
+    def test_timeout(self):
+        warmup = Warmup(timeout=0.1)
+        warmup.add("users", {"slow": sleeper(0.5)})
+
+        with self.assertRaises(RedmineException) as ctx:
+            warmup.run()
+        self.assertIn("timed out", str(ctx.exception))
@@ -7,16 +7,26 @@ import logging
 import email
 import email.policy
 import re
-import traceback
+import time
+import threading
+import functools
+import contextvars
 
 from io import StringIO
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
 from html.parser import HTMLParser
 
 from imapclient import IMAPClient, SEEN, DELETED
+from imapclient.exceptions import IMAPClientAbortError, IMAPClientError
 from dotenv import load_dotenv
 
-from redmine.model import Attachment, Message
-from redmine import redmine
+from redmine.model import Attachment, Message, Ticket, User, SPOOL_THRESHOLD
+from redmine import redmine, accounting, metrics, profiling, tracing
+from threader import neardup, triage
+from threader.triage import Triage
+from threader.threadindex import ThreadIndex
+from threader.neardup import NearDuplicates
 
 # Import HTTP client instead of local redactor
 from redactor.redactor_client import RedactorClient
@@ -24,6 +34,96 @@ from redactor.redactor_client import RedactorClient
 log = logging.getLogger(__name__)
 
 
+IMAP_BATCH_ENV = "IMAP_BATCH_SIZE" # messages fetched per request
+DEFAULT_BATCH_SIZE = 10
+IMAP_TIMEOUT = 60 # seconds, for the connection and each command
+IMAP_IDLE_ENV = "IMAP_IDLE" # wait for new mail with IMAP IDLE, if the server supports it. on by default
+IDLE_RENEW = 25 * 60 # seconds, IDLE is renewed before the server's 29 minute timeout
+# the connection was lost, and a new one might work
+CONNECTION_ERRORS = (IMAPClientAbortError, OSError)
+IMAP_WORKERS_ENV = "IMAP_WORKERS" # emails processed at once
+REDACT_WORKERS_ENV = "IMAP_REDACT_WORKERS" # redaction requests at once
+DEFAULT_WORKERS = 4
+DEFAULT_REDACT_WORKERS = 2
+REDMINE_WORKERS = 4 # user and upload stages at once
+QUARANTINE_ENV = "IMAP_QUARANTINE_FOLDER" # blocked senders' emails are copied here before they're deleted
+ERROR_DIR_ENV = "IMAP_ERROR_DIR" # emails that can't be processed are saved here, the working directory by default
+
+EMAIL_STAGE_SECONDS = metrics.histogram("threader_email_stage_seconds", "Email processing time, by stage", ("stage",),
+                                        buckets=metrics.STAGE_BUCKETS)
+EMAILS_PROCESSED = metrics.counter("threader_emails_total",
+                                   "Emails processed, by result: ok, error, or skipped as blocked, auto-reply or duplicate",
+                                   ("result",))
+IMAP_FETCHED_BYTES = metrics.counter("threader_imap_fetched_bytes_total",
+                                     "Bytes of message bodies downloaded, by fetch: full or parts", ("fetch",))
+REDACTION_SECONDS = metrics.histogram("threader_redaction_seconds", "Latency of redaction requests, by result: ok or error",
+                                      ("result",), buckets=metrics.STAGE_BUCKETS)
+TICKET_MATCHES = metrics.counter("threader_ticket_matches_total",
+                                 "Emails matched to a ticket, by how: thread, number, subject or none", ("match",))
+NEAR_DUPLICATES = metrics.counter("threader_near_duplicates_total",
+                                  "Emails found to be near duplicates of a recent one, by action: append or drop", ("action",))
+IMAP_UNSEEN = metrics.gauge("threader_imap_unseen", "Unseen messages in the inbox, at the last check")
+IMAP_CONNECTS = metrics.counter("threader_imap_connects_total", "IMAP connections opened, including reconnects")
+IMAP_WAKEUPS = metrics.counter("threader_imap_wakeups_total",
+                               "Waits for new mail, by result: mail, timeout, poll or error", ("result",))
+
+
+@contextmanager
+def stage(name: str):
+    """time a stage of processing an email, as a metric and as a span of the email's trace"""
+    with EMAIL_STAGE_SECONDS.time(stage=name), tracing.span(name):
+        yield
+
+
+def submit(pool: ThreadPoolExecutor, fn, *args):
+    """run fn in a stage's pool, in the current context: the email's trace and accounting operation"""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+def discard(future: Future | None) -> None:
+    """cancel a stage that's no longer needed, logging its failure if it already ran"""
+    if future and not future.cancel() and future.done() and future.exception():
+        log.warning(f"unused stage failed: {future.exception()}")
+
+
+class WriteOrder():
+    """
+    Emails in a batch are processed at once, but written to the same ticket in the
+    order they arrived: an email is written once the emails before it are matched
+    to their tickets, and any matched to the same ticket have been written.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.targets: dict[int, int | None] = {} # index -> matching ticket id, or None for a new ticket
+        self.written: set[int] = set()
+
+
+    def matched(self, index: int, ticket_id: int | None) -> None:
+        with self.condition:
+            self.targets[index] = ticket_id
+            self.condition.notify_all()
+
+
+    def done(self, index: int) -> None:
+        """the email was written, or failed"""
+        with self.condition:
+            self.targets.setdefault(index, None)
+            self.written.add(index)
+            self.condition.notify_all()
+
+
+    def ready(self, index: int, ticket_id: int) -> bool:
+        return all(i in self.targets and (self.targets[i] != ticket_id or i in self.written) for i in range(index))
+
+
+    @contextmanager
+    def turn(self, index: int, ticket_id: int):
+        """wait for the turn of the email at index to write to the ticket"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.ready(index, ticket_id))
+        yield
+
+
 class MLStripper(HTMLParser):
     """strip HTML from a string"""
     def __init__(self):
@@ -41,11 +141,29 @@ class MLStripper(HTMLParser):
 class Client(): ## imap.Client()
     """IMAP Client"""
 
-    def __init__(self):
+    def __init__(self, client: redmine.Client | None = None, index: ThreadIndex | None = None):
         self.host = os.getenv('IMAP_HOST')
         self.user = os.getenv('IMAP_USER')
         self.passwd = os.getenv('IMAP_PASSWORD')
-        self.redmine:redmine.Client = redmine.Client.fromenv()
+        self.batch_size = int(os.getenv(IMAP_BATCH_ENV, DEFAULT_BATCH_SIZE))
+        self.use_idle = os.getenv(IMAP_IDLE_ENV, "on").lower() in profiling.TRUE_VALUES
+        self.idle_renew = IDLE_RENEW
+        self.full_fetch_max = int(os.getenv(triage.FULL_FETCH_MAX_ENV, triage.DEFAULT_FULL_FETCH_MAX))
+        self.max_attachment = int(os.getenv(triage.MAX_ATTACHMENT_ENV, triage.DEFAULT_MAX_ATTACHMENT))
+        self.spool_threshold = int(os.getenv(triage.SPOOL_THRESHOLD_ENV, SPOOL_THRESHOLD))
+        self.index = index if index is not None else ThreadIndex.fromenv() # Message-ID -> ticket
+        self.quarantine = os.getenv(QUARANTINE_ENV)
+        self.error_dir = os.getenv(ERROR_DIR_ENV, ".")
+        self.near_dups = NearDuplicates.fromenv()
+        # a bounded pool for each stage, so a slow redaction doesn't hold up other emails
+        self.email_pool = ThreadPoolExecutor(int(os.getenv(IMAP_WORKERS_ENV, DEFAULT_WORKERS)), "email")
+        self.user_pool = ThreadPoolExecutor(REDMINE_WORKERS, "user")
+        # emails from the same sender find or create their user one at a time
+        self.user_locks = [threading.Lock() for _ in range(REDMINE_WORKERS * 4)]
+        self.redact_pool = ThreadPoolExecutor(int(os.getenv(REDACT_WORKERS_ENV, DEFAULT_REDACT_WORKERS)), "redact")
+        self.server: IMAPClient | None = None # the session, kept open between syncs
+        self.server_lock = threading.RLock() # for parts fetched by the email workers
+        self.redmine:redmine.Client = client or redmine.Client.fromenv()
 
         redactor_url = os.getenv('REDACTOR_URL')
         if redactor_url:
@@ -53,7 +171,7 @@ class Client(): ## imap.Client()
             try:
                 self.redactor = RedactorClient(redactor_url)
                 log.info("Connected to remote LLM API for redaction")
-            except Exception as e:
+            except RuntimeError as e:
                 log.error(f"Failed to connect to LLM API: {e}")
                 log.error("Emails will NOT be redacted!")
                 self.redactor = None
@@ -95,18 +213,25 @@ class Client(): ## imap.Client()
         to_header = root.get("To")
         cc_header = root.get("Cc")
         message = Message(from_address, subject, to_header, cc_header)
+        message.set_thread(root.get("Message-ID"), root.get("In-Reply-To"), root.get("References"))
         payload = ""
 
-        for part in root.walk():
-            content_type = part.get_content_type()
-            if part.is_attachment():
-                message.add_attachment( Attachment(
-                    name=part.get_filename(),
-                    content_type=content_type,
-                    payload=part.get_payload(decode=True)))
-                log.debug(f"Added attachment: {part.get_filename()} {content_type}")
-            elif content_type == 'text/plain':
-                payload = part.get_payload(decode=True).decode('UTF-8')
+        try:
+            for part in root.walk():
+                content_type = part.get_content_type()
+                if part.is_attachment():
+                    attachment = self.spool_payload(part)
+                    if attachment.size > self.max_attachment:
+                        log.info(f"Skipping attachment {part.get_filename()}, {attachment.size} bytes")
+                        attachment.close()
+                        continue
+                    message.add_attachment(attachment)
+                    log.debug(f"Added attachment: {part.get_filename()} {content_type}")
+                elif content_type == 'text/plain':
+                    payload = part.get_payload(decode=True).decode('UTF-8')
+        except Exception:
+            message.close_attachments()
+            raise
 
         if payload == "":
             payload = root.get_body().get_content()
@@ -120,6 +245,102 @@ class Client(): ## imap.Client()
 
         return message
 
+    def spool(self, part: triage.Part, data: bytes) -> Attachment:
+        """an attachment, decoded from the fetched part"""
+        attachment = Attachment(name=part.filename, content_type=part.content_type,
+                                spool_threshold=self.spool_threshold)
+        try:
+            part.decode_into(data, attachment)
+        except Exception:
+            attachment.close()
+            raise
+        log.debug(f"Added attachment: {part.filename} {part.content_type}, {attachment.size} bytes")
+        return attachment
+
+
+    def spool_payload(self, part: email.message.EmailMessage) -> Attachment:
+        """an attachment, decoded from its part of a parsed email a chunk at a time"""
+        attachment = Attachment(name=part.get_filename(), content_type=part.get_content_type(),
+                                spool_threshold=self.spool_threshold)
+        encoding = str(part.get("Content-Transfer-Encoding", "7bit")).strip().lower()
+        if part.is_multipart() or encoding not in ("base64", "quoted-printable"):
+            # 8bit and binary content is already bytes, and uuencoded content is rare
+            attachment.write(part.get_payload(decode=True) or b"")
+            return attachment
+        try:
+            triage.decode_into(encoding, part.get_payload().encode("ascii", "replace"), attachment)
+        except Exception:
+            attachment.close()
+            raise
+        return attachment
+
+
+    def parse_parts(self, triaged: Triage, bodies: dict[str, bytes]) -> Message:
+        """
+        build a message from its headers and the parts that were fetched, by section.
+        attachments that weren't fetched with the text are fetched one at a time, and spooled.
+        """
+        headers = triaged.headers
+        message = Message(headers.get("From"), headers.get("Subject"), headers.get("To"), headers.get("Cc"))
+        message.set_thread(headers.get("Message-ID"), headers.get("In-Reply-To"), headers.get("References"))
+        plain = html = ""
+
+        wanted = triaged.wanted_parts(self.max_attachment)
+        try:
+            for part in triaged.parts:
+                if part.attachment and part in wanted:
+                    data = bodies.pop(part.section, None) or self.fetch_section(triaged.uid, part.section)
+                    if data is not None:
+                        attachment = self.spool(part, data)
+                        if attachment.size > self.max_attachment:
+                            # its size was an estimate
+                            log.info(f"Skipping attachment {part.filename}, {attachment.size} bytes")
+                            attachment.close()
+                        else:
+                            message.add_attachment(attachment)
+                    continue
+                if part.section not in bodies:
+                    continue
+                content = part.decode(bodies[part.section])
+                if part.content_type == "text/plain":
+                    plain = content.decode(part.charset or "UTF-8", errors="replace")
+                elif part.content_type == "text/html" and not html:
+                    html = content.decode(part.charset or "UTF-8", errors="replace")
+        except Exception:
+            message.close_attachments()
+            raise
+
+        payload = plain
+        if payload == "":
+            payload = html
+            if self.is_html_doc(payload):
+                payload = self.strip_html_tags(payload)
+
+        payload = self.strip_forwards(payload)
+        message.set_note(payload)
+        return message
+
+
+    def triage(self, uid, item: dict) -> Triage:
+        """what to do with a message, from its headers and structure"""
+        headers = triage.parse_headers(item[b"BODY[HEADER]"])
+        try:
+            parts = triage.parse_bodystructure(item[b"BODYSTRUCTURE"])
+        except triage.STRUCTURE_ERRORS as ex:
+            log.warning(f"Unable to parse the structure of message {uid}, fetching it all: {ex}")
+            parts = []
+        triaged = Triage(uid, headers, int(item.get(b"RFC822.SIZE", 0)), parts)
+
+        _, _, addr = self.parse_email_address(triaged.from_address)
+        if self.index.is_processed(triaged.message_id):
+            triaged.skip = triage.DUPLICATE
+        elif triage.is_auto_reply(headers):
+            triaged.skip = triage.AUTO_REPLY
+        elif self.redmine.user_mgr.blocked.is_blocked_address(addr):
+            triaged.skip = triage.BLOCKED
+        return triaged
+
+
     def strip_html_tags(self, text:str) -> str:
         s = MLStripper()
         s.feed(text)
@@ -164,80 +385,175 @@ class Client(): ## imap.Client()
 
         return buffer.strip()
 
-    def handle_message(self, msg_id:str, message:Message):
-        first, last, addr = self.parse_email_address(message.from_address)
-        subject = message.subject_cleaned()
-        log.debug(f'uid:{msg_id} - from:{last}, {first}, email:{addr}, subject:{subject}')
-
-        # NOTE: Might need a setting to override "search for matching ticket"
-        # Simplyfying assumption: If the subject has a valid tracker tag -> [Valid-Tracker-Name]
-        # Then skip the searches in first, next.
-
-        # Redact message using remote API
-        original_note = message.note
+    def redact(self, msg_id, note: str):
+        """redact PII from a note with the remote API, or None if there's no redactor or it failed"""
+        if not self.redactor:
+            log.warning("No redactor available, creating ticket WITHOUT redaction")
+            return None
 
-        if self.redactor:
+        with stage("redact"):
+            start = time.perf_counter()
             try:
                 log.info(f"Redacting PII from message {msg_id} via LLM API...")
-                redacted = self.redactor.redact_text(original_note)
+                redacted = self.redactor.redact_text(note)
+                REDACTION_SECONDS.observe(time.perf_counter() - start, result="ok")
                 log.info(f"Redaction complete for message {msg_id}")
-            except Exception as e:
+                return redacted
+            except (RuntimeError, ValueError, KeyError) as e: # failed, or an unexpected response
+                REDACTION_SECONDS.observe(time.perf_counter() - start, result="error")
                 log.error(f"Redaction failed for message {msg_id}: {e}")
                 log.warning("Creating ticket WITHOUT redaction")
-                redacted = None
-        else:
-            log.warning("No redactor available, creating ticket WITHOUT redaction")
-            redacted = None
-
-        # Get user
-        user = self.redmine.user_mgr.get_by_name(addr)
-        if user is None:
-            log.debug(f"Unknown email address, no user found: {addr}, {message.from_address}")
-            user = self.redmine.user_mgr.create(addr, first, last, user_login=None)
-            log.info(f"Unknown user: {addr}, created new account.")
-
-        self.redmine.user_mgr.join_team(user, "users")
+                tracing.annotate(result="error")
+                return None
+
+
+    def resolve_user(self, message: Message, addr: str, first: str, last: str) -> User:
+        """find or create the sender, in the users group"""
+        with stage("user"), self.user_locks[hash(addr) % len(self.user_locks)]:
+            user = self.redmine.user_mgr.get_by_name(addr)
+            if user is None:
+                log.debug(f"Unknown email address, no user found: {addr}, {message.from_address}")
+                user = self.redmine.user_mgr.create(addr, first, last, user_login=None)
+                log.info(f"Unknown user: {addr}, created new account.")
+            # make sure user is in users group
+            self.redmine.user_mgr.join_team(user, "users")
+        return user
+
+
+    def upload(self, user: User, message: Message, ticket_id: int | None = None):
+        """upload the attachments, except content already attached to the ticket"""
+        with stage("upload"):
+            try:
+                self.redmine.ticket_mgr.upload_attachments(user, message.attachments, ticket_id)
+            finally:
+                # only the upload tokens are needed from here
+                message.close_attachments()
+
+
+    def match_ticket(self, message: Message) -> int | None:
+        """
+        the id of the existing ticket for an email, if any: from the emails it replies to,
+        then a ticket number in the subject, and searching for the subject as a last resort
+        """
+        with stage("match"):
+            ticket_id = self.index.lookup(message.references)
+            if ticket_id:
+                log.debug(f"found ticket id={ticket_id} for reply to: {message.references[0]}")
+                TICKET_MATCHES.inc(match="thread")
+                return ticket_id
 
-        # Upload attachments
-        self.redmine.ticket_mgr.upload_attachments(user, message.attachments)
+            # this uses a simple REGEX '#\d+' to match ticket numbers
+            subject = message.subject_cleaned()
+            ticket = self.redmine.find_ticket_from_str(subject)
+            if ticket:
+                TICKET_MATCHES.inc(match="number")
+                return ticket.id
+
+            tickets = self.redmine.ticket_mgr.match_subject(subject)
+            if tickets:
+                if len(tickets) >= 2:
+                    log.warning(f"subject query returned {len(tickets)} results, using first: {subject}")
+                log.debug(f"found ticket id={tickets[0].id} for subject: {subject}")
+                TICKET_MATCHES.inc(match="subject")
+                return tickets[0].id
+
+            TICKET_MATCHES.inc(match="none")
+            return None
+
+
+    def near_duplicate(self, addr: str, message: Message) -> tuple[int | None, Future | None]:
+        """
+        the ticket of a recent near duplicate from the same sender, waiting for it if it's
+        being created. if there's none, the future to set to the ticket created for this email.
+        """
+        text = f"{message.subject_cleaned()}\n{message.note}"
+        while True:
+            ticket, new = self.near_dups.match(addr, text)
+            if ticket is None or new:
+                return None, ticket
+            ticket_id = ticket.result()
+            if ticket_id:
+                log.info(f"Message from {addr} is a near duplicate of ticket #{ticket_id}")
+                NEAR_DUPLICATES.inc(action=self.near_dups.action)
+                return ticket_id, None
+            # the earlier email failed, and is forgotten: try again
+
+
+    def handle_message(self, msg_id:str, message:Message, order: WriteOrder | None = None, index: int = 0):
+        """
+        Add an email to its ticket, or create a new ticket. The sender is resolved
+        while the ticket is matched, unless near duplicates are dropped: then it's
+        resolved once the email is known not to be one. Attachments the ticket doesn't already have
+        are uploaded. Only new tickets are redacted, as only their description is
+        public. An email with no ticket that's a near duplicate of a recent one from
+        the same sender is added to that ticket, or dropped, rather than redacted again.
+        With an order, writes to the same ticket wait for the emails before this one, at index.
+        """
+        first, last, addr = self.parse_email_address(message.from_address)
+        subject = message.subject_cleaned()
+        log.debug(f'uid:{msg_id} - from:{last}, {first}, email:{addr}, subject:{subject}')
 
-        # Check for existing ticket
-        tickets = self.redmine.ticket_mgr.match_subject(subject)
+        # NOTE: Might need a setting to override "search for matching ticket"
+        # Simplyfying assumption: If the subject has a valid tracker tag -> [Valid-Tracker-Name]
+        # Then skip the searches in first, next.
 
-        if len(tickets) == 1:
-            ticket = tickets[0]
-            log.debug(f"found ticket id={ticket.id} for subject: {subject}")
-        elif len(tickets) >= 2:
-            log.warning(f"subject query returned {len(tickets)} results, using first: {subject}")
-            ticket = tickets[0]
+        user_future = None
+        if self.near_dups.action != neardup.DROP:
+            user_future = submit(self.user_pool, self.resolve_user, message, addr, first, last)
+        ticket_id = claim = None
+        try:
+            ticket_id = self.match_ticket(message)
+            if ticket_id is None:
+                ticket_id, claim = self.near_duplicate(addr, message)
+                if ticket_id and self.near_dups.action == neardup.DROP:
+                    # no redmine writes at all, not even the sender's account
+                    log.info(f"Dropping message {msg_id} from {addr}, a near duplicate of ticket #{ticket_id}")
+                    tracing.annotate(ticket=ticket_id, action="drop")
+                    ticket_id = None
+                    return
+        except BaseException:
+            discard(user_future)
+            raise
+        finally:
+            if order:
+                order.matched(index, ticket_id)
+
+        if user_future is None:
+            user_future = submit(self.user_pool, self.resolve_user, message, addr, first, last)
+
+        if ticket_id:
+            user = user_future.result()
+            self.upload(user, message, ticket_id)
+            with order.turn(index, ticket_id) if order else nullcontext(), stage("ticket"):
+                # Update existing ticket
+                # self.redmine.ticket_mgr.append_message(ticket.id, user.login, message.note, message.attachments) TODO: CHANGE LATER 2/9
+                # Use API key account (admin) instead of impersonating sender
+                # This avoids 403 permission errors for external users
+                attributed_note = f"**From:** {user.name} ({user.mail})\n\n{message.note}"
+                self.redmine.ticket_mgr.append_message(ticket_id, None, attributed_note, message.attachments)
+                self.index.add(ticket_id, message.message_id, message.references)
+                log.info(f"Updated ticket #{ticket_id} with message from {user.login} and {len(message.attachments)} attachments")
+                tracing.annotate(ticket=ticket_id, action="update")
+            return
+
+        ticket = None
+        try:
+            ticket = self.new_ticket(msg_id, message, user_future)
+        finally:
+            if claim:
+                # near duplicates of this email waiting for its ticket
+                claim.set_result(ticket.id if ticket else None)
 
-        # next, find ticket using the subject, if possible
-        if ticket is None:
-            # this uses a simple REGEX '#\d+' to match ticket numbers
-            ticket = self.redmine.find_ticket_from_str(subject)
 
-        # get user id from from_address
-        user = self.redmine.user_mgr.get_by_name(addr)
-        if user is None:
-            log.debug(f"Unknown email address, no user found: {addr}, {message.from_address}")
-            # create new user
-            user = self.redmine.user_mgr.create(addr, first, last, user_login=None)
-            log.info(f"Unknow user: {addr}, created new account.")
-        # make sure user is in users group
-        self.redmine.user_mgr.join_team(user, "users")
-
-        #  upload any attachments
-        self.redmine.ticket_mgr.upload_attachments(user, message.attachments)
-
-        if ticket:
-            # Update existing ticket
-            # self.redmine.ticket_mgr.append_message(ticket.id, user.login, message.note, message.attachments) TODO: CHANGE LATER 2/9
-            # Use API key account (admin) instead of impersonating sender
-            # This avoids 403 permission errors for external users
-            attributed_note = f"**From:** {user.name} ({user.mail})\n\n{message.note}"
-            self.redmine.ticket_mgr.append_message(ticket.id, None, attributed_note, message.attachments)
-            log.info(f"Updated ticket #{ticket.id} with message from {user.login} and {len(message.attachments)} attachments")
-        else:
+    def new_ticket(self, msg_id, message: Message, user_future) -> Ticket:
+        """create a ticket for an email, redacting the description"""
+        # Redact message using remote API
+        original_note = message.note
+        redact_future = submit(self.redact_pool, self.redact, msg_id, original_note)
+        user = user_future.result()
+        self.upload(user, message)
+        redacted = redact_future.result()
+        with stage("ticket"):
             if redacted:
                 # Store REDACTED in description (public facing)
                 message.note = redacted.text
@@ -259,47 +575,257 @@ class Client(): ## imap.Client()
                 # No redaction available, store original in description only
                 message.note = original_note
                 ticket = self.redmine.create_ticket(user, message)
+            self.index.add(ticket.id, message.message_id, message.references)
             log.info(f"Created new ticket for: {ticket}, with {len(message.attachments)} attachments")
+            tracing.annotate(ticket=ticket.id, action="create")
+            return ticket
 
-    def synchronize(self):
-        """Process ONE email, then return. Returns number of emails processed (0 or 1)."""
-        processed_count = 0
-        try:
-            with IMAPClient(host=self.host, ssl=True) as server:
-                server.login(self.user, self.passwd)
-                server.select_folder("INBOX", readonly=False)
-                log.info(f'logged into imap {self.host}')
 
-                messages = server.search("UNSEEN")
-                log.info(f"processing {len(messages)} new messages from {self.host}")
+    def open(self) -> IMAPClient:
+        """a new IMAP connection, logged in with the inbox selected"""
+        server = IMAPClient(host=self.host, ssl=True, timeout=IMAP_TIMEOUT)
+        server.login(self.user, self.passwd)
+        server.select_folder("INBOX", readonly=False)
+        IMAP_CONNECTS.inc()
+        log.info(f'logged into imap {self.host}')
+        return server
 
-                if not messages:
-                    # No emails to process
-                    log.info("done. processed 0 messages")
-                    return 0
 
-                # Process ONLY the first email
-                uid = messages[0]  # Get first unread email
-                message_data = server.fetch([uid], "RFC822")
+    def connection(self) -> IMAPClient:
+        """the current IMAP session, opening one if needed"""
+        if self.server is None:
+            self.server = self.open()
+        return self.server
 
+
+    def drop(self) -> None:
+        """drop a lost connection, without waiting on the server"""
+        if self.server:
+            try:
+                self.server.shutdown()
+            except (IMAPClientError, OSError) as ex:
+                log.debug(f"error shutting down imap connection: {ex}")
+            self.server = None
+
+
+    def close(self) -> None:
+        """log out and close the IMAP session"""
+        if self.server:
+            try:
+                self.server.logout()
+            except (IMAPClientError, OSError) as ex:
+                log.debug(f"error logging out of imap: {ex}")
+            self.server = None
+
+
+    def call(self, method: str, *args):
+        """call an IMAPClient method on the session, reconnecting once if the connection was lost"""
+        with self.server_lock:
+            try:
+                return getattr(self.connection(), method)(*args)
+            except CONNECTION_ERRORS as ex:
+                log.warning(f"imap connection lost during {method}, reconnecting: {ex}")
+                self.drop()
+                return getattr(self.connection(), method)(*args)
+
+
+    def supports_idle(self) -> bool:
+        return self.use_idle and self.call("has_capability", "IDLE")
+
+
+    def wait_for_mail(self, timeout: float) -> bool:
+        """
+        Wait up to timeout seconds for new mail. With IMAP IDLE, this returns as soon
+        as the server reports new mail, and IDLE is renewed every idle_renew seconds.
+        Without it, this just sleeps, to poll again. Returns True if there's new mail.
+        """
+        try:
+            if not self.supports_idle():
+                time.sleep(timeout)
+                IMAP_WAKEUPS.inc(result="poll")
+                return False
+
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                server = self.connection()
+                server.idle()
                 try:
-                    data = message_data[uid][b"RFC822"]
-                    message = self.parse_message(data)
-                    self.handle_message(uid, message)
-                    server.add_flags(uid, [SEEN, DELETED])
-                    processed_count = 1
-                    log.info("done. processed 1 message")
-                except Exception as e:
-                    log.error(f"Message {uid} can not be processed: {e}")
-                    traceback.print_exc()
-                    with open(f"message-err-{uid}.eml", "wb") as file:
-                        file.write(data)
-                    server.add_flags(uid, [SEEN])
-                    processed_count = 0
-
-        except Exception as ex:
-            log.error(f"caught exception syncing IMAP: {ex}")
-            traceback.print_exc()
+                    responses = server.idle_check(timeout=min(remaining, self.idle_renew))
+                finally:
+                    _, done_responses = server.idle_done()
+                if any(response[1] == b"EXISTS" for response in responses + done_responses
+                       if isinstance(response, tuple) and len(response) > 1):
+                    IMAP_WAKEUPS.inc(result="mail")
+                    return True
+            IMAP_WAKEUPS.inc(result="timeout")
+            return False
+        except CONNECTION_ERRORS as ex:
+            # check for mail right away, over a new connection
+            log.warning(f"imap connection lost while waiting for mail: {ex}")
+            IMAP_WAKEUPS.inc(result="error")
+            self.drop()
+            return True
+
+
+    def process(self, uid, parse, raw: bytes, order: WriteOrder | None = None, index: int = 0) -> bool:
+        """
+        process one email, parsed by parse(). returns True if processed, False if it failed.
+        raw is saved to a file in error_dir when processing fails.
+        """
+        message = None
+        try:
+            with (accounting.operation("email"), profiling.profile("email"),
+                  EMAIL_STAGE_SECONDS.time(stage="total")):
+                with stage("parse"):
+                    message = parse()
+                self.handle_message(uid, message, order, index)
+            EMAILS_PROCESSED.inc(result="ok")
+            return True
+        except Exception:
+            EMAILS_PROCESSED.inc(result="error")
+            tracing.annotate(result="error")
+            log.exception(f"Message {uid} can not be processed")
+            with open(os.path.join(self.error_dir, f"message-err-{uid}.eml"), "wb") as file:
+                file.write(raw)
+            return False
+        finally:
+            if message:
+                # uploads that weren't attached can be used when the email is processed again
+                self.redmine.ticket_mgr.uploads.release(message.attachments)
+                message.close_attachments()
+
+
+    def fetch_parts(self, triaged: Triage) -> dict[str, bytes]:
+        """fetch the text parts of a large message, by section. attachments are fetched by parse_parts."""
+        wanted = [part for part in triaged.parts if part.is_text()]
+        if not wanted:
+            return {}
+        with stage("fetch"):
+            fetched = self.call("fetch", [triaged.uid], [f"BODY.PEEK[{part.section}]" for part in wanted])
+        item = fetched.get(triaged.uid, {})
+        bodies = {part.section: item[f"BODY[{part.section}]".encode()] for part in wanted
+                  if f"BODY[{part.section}]".encode() in item}
+        IMAP_FETCHED_BYTES.inc(sum(len(body) for body in bodies.values()), fetch="parts")
+        return bodies
+
+
+    def fetch_section(self, uid, section: str) -> bytes | None:
+        """fetch one part of a message, so only one attachment is in memory at a time"""
+        with stage("fetch"):
+            fetched = self.call("fetch", [uid], [f"BODY.PEEK[{section}]"])
+        data = fetched.get(uid, {}).get(f"BODY[{section}]".encode())
+        if data is not None:
+            IMAP_FETCHED_BYTES.inc(len(data), fetch="parts")
+        return data
+
+
+    def ingest(self, item: Triage, index: int, order: WriteOrder, fetched: dict, headers: dict) -> bool:
+        """process an email of a batch, from the whole message if it was fetched, or by part"""
+        uid = item.uid
+        try:
+            with tracing.trace("email", uid=uid):
+                if uid in fetched:
+                    data = fetched[uid][b"RFC822"]
+                    return self.process(uid, functools.partial(self.parse_message, data), data, order, index)
+                # a large message, fetched by part
+                return self.process(uid, lambda: self.parse_parts(item, self.fetch_parts(item)),
+                                    headers[uid][b"BODY[HEADER]"], order, index)
+        finally:
+            order.done(index)
+
+
+    def process_batch(self, uids: list) -> int:
+        """
+        triage a batch of emails from their headers, fetch and process the ones that
+        are wanted, then flag them together. Returns the number processed.
+        """
+        with stage("fetch"):
+            headers = self.call("fetch", uids, triage.HEADER_ITEMS)
+        triaged = []
+        batch_ids = set()
+        for uid in uids:
+            if uid not in headers:
+                log.warning(f"Message {uid} is no longer in the inbox, skipping")
+                continue
+            item = self.triage(uid, headers[uid])
+            if item.message_id and not item.skip:
+                if item.message_id in batch_ids:
+                    item.skip = triage.DUPLICATE # delivered twice in the same batch
+                batch_ids.add(item.message_id)
+            triaged.append(item)
+
+        # small messages are fetched whole, in one request
+        whole = [item.uid for item in triaged if not item.skip and item.full_fetch(self.full_fetch_max)]
+        fetched = {}
+        if whole:
+            with stage("fetch"):
+                fetched = self.call("fetch", whole, "RFC822")
+            IMAP_FETCHED_BYTES.inc(sum(len(item[b"RFC822"]) for item in fetched.values()), fetch="full")
+
+        # the wanted emails are processed at once, each in its own trace
+        order = WriteOrder()
+        wanted = [item for item in triaged if not item.skip]
+        futures = {item.uid: self.email_pool.submit(self.ingest, item, index, order, fetched, headers)
+                   for index, item in enumerate(wanted)}
+
+        done = [] # processed or skipped
+        failed = []
+        processed = 0
+        for item in triaged:
+            uid = item.uid
+            if item.skip:
+                log.info(f"Skipping message {uid} from {item.from_address}: {item.skip}")
+                EMAILS_PROCESSED.inc(result=item.skip)
+                done.append(uid)
+            elif futures[uid].result():
+                done.append(uid)
+                processed += 1
+            else:
+                failed.append(uid)
+
+        blocked = [item.uid for item in triaged if item.skip == triage.BLOCKED]
+        if blocked and self.quarantine and not self.quarantined(blocked):
+            # kept in the inbox, rather than lost
+            done = [uid for uid in done if uid not in blocked]
+            failed.extend(blocked)
+
+        if done:
+            self.call("add_flags", done, [SEEN, DELETED])
+        if failed:
+            self.call("add_flags", failed, [SEEN])
+        return processed
+
+
+    def quarantined(self, uids: list) -> bool:
+        """copy the emails of blocked senders to the quarantine folder. False if they couldn't be."""
+        try:
+            self.call("copy", uids, self.quarantine)
+            log.info(f"Quarantined {len(uids)} messages from blocked senders in {self.quarantine}")
+            return True
+        except IMAPClientError as ex:
+            log.error(f"Unable to quarantine messages {uids} in {self.quarantine}: {ex}")
+            return False
+
+
+    def synchronize(self) -> int:
+        """
+        Process all the unseen emails, fetched in batches of batch_size, over a
+        session that's kept open between calls. Returns the number processed.
+        """
+        processed_count = 0
+        try:
+            messages = self.call("search", "UNSEEN")
+            IMAP_UNSEEN.set(len(messages))
+            log.info(f"processing {len(messages)} new messages from {self.host}")
+
+            for start in range(0, len(messages), self.batch_size):
+                processed_count += self.process_batch(messages[start:start + self.batch_size])
+            log.info(f"done. processed {processed_count} messages")
+
+        except Exception:
+            log.exception("caught exception syncing IMAP")
+            # start with a fresh connection next time
+            self.drop()
 
         return processed_count
 
@@ -424,4 +950,6 @@ class Client(): ## imap.Client()
 if __name__ == '__main__':
     log.info('initializing IMAP threader')
     load_dotenv()
-    Client().synchronize()
\ No newline at end of file
+    imap_client = Client()
+    imap_client.synchronize()
+    imap_client.close()
\ No newline at end of file
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Near-duplicate emails: the same text sent again by the same sender, found by SimHash"""
+
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+
+
+log = logging.getLogger(__name__)
+
+
+NEAR_DUP_DISTANCE_ENV = "IMAP_NEAR_DUP_DISTANCE" # bits of 64 that may differ, -1 to turn detection off
+NEAR_DUP_WINDOW_ENV = "IMAP_NEAR_DUP_WINDOW" # seconds a message is compared with later ones
+NEAR_DUP_ACTION_ENV = "IMAP_NEAR_DUP_ACTION" # append or drop
+DEFAULT_DISTANCE = 6 # a changed word or two in a paragraph, unrelated texts differ in about 32
+DEFAULT_WINDOW = 24 * 60 * 60
+MAX_SENDERS = 1000 # senders remembered, least recent are forgotten
+PER_SENDER = 10 # recent messages remembered for each sender
+MIN_WORDS = 5 # shorter texts ("thanks!") aren't compared
+
+# what's done with a near duplicate
+APPEND = "append"
+DROP = "drop"
+
+
+def simhash(text: str) -> int | None:
+    """
+    64 bit SimHash of the words of a text, or None if it's too short to compare. Words are
+    less noisy than shingles for texts as short as emails: a changed word moves a few bits.
+    Case, punctuation and numbers are ignored, so timestamps and counters don't make copies differ.
+    """
+    words = re.findall(r"\w+", re.sub(r"\d+", "0", text.lower()))
+    if len(words) < MIN_WORDS:
+        return None
+    weights = [0] * 64
+    for word in words:
+        value = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def distance(a: int, b: int) -> int:
+    """the number of bits that differ"""
+    return (a ^ b).bit_count()
+
+
+@dataclass
+class Recent():
+    """a recent message from a sender: its SimHash, when it arrived, and its ticket, once it's written"""
+    fingerprint: int
+    arrived: float
+    ticket: Future
+
+
+class NearDuplicates():
+    """
+    The SimHash of recent messages, by sender.
+
+    A message is a near duplicate of one from the same sender within window
+    seconds, if their hashes differ in at most max_distance bits. The first
+    message gets the ticket, and the others wait for it, so copies processed
+    at once don't each create a ticket and a redaction. Memory is bounded by
+    max_senders and per_sender.
+    """
+    def __init__(self, max_distance: int = DEFAULT_DISTANCE, window: float = DEFAULT_WINDOW,
+                 action: str = APPEND, max_senders: int = MAX_SENDERS, per_sender: int = PER_SENDER):
+        self.max_distance = max_distance
+        self.window = window
+        self.action = action
+        self.max_senders = max_senders
+        self.per_sender = per_sender
+        self.lock = threading.Lock()
+        self.senders: OrderedDict[str, deque[Recent]] = OrderedDict() # least recent first
+
+
+    @classmethod
+    def fromenv(cls) -> "NearDuplicates":
+        action = os.getenv(NEAR_DUP_ACTION_ENV, APPEND).lower()
+        if action not in (APPEND, DROP):
+            log.warning(f"Unknown {NEAR_DUP_ACTION_ENV}={action}, using {APPEND}")
+            action = APPEND
+        return cls(
+            max_distance=int(os.getenv(NEAR_DUP_DISTANCE_ENV, DEFAULT_DISTANCE)),
+            window=float(os.getenv(NEAR_DUP_WINDOW_ENV, DEFAULT_WINDOW)),
+            action=action,
+        )
+
+
+    def match(self, sender: str, text: str, now: float | None = None) -> tuple[Future | None, bool]:
+        """
+        the ticket of a recent near duplicate from the sender, and False. if there's
+        none, the future to set to the ticket for this message, and True. (None, False)
+        if the text isn't compared.
+        """
+        if self.max_distance < 0:
+            return None, False
+        fingerprint = simhash(text)
+        if fingerprint is None:
+            return None, False
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            recent = self.senders.pop(sender.lower(), None) or deque(maxlen=self.per_sender)
+            self.senders[sender.lower()] = recent
+            while len(self.senders) > self.max_senders:
+                self.senders.popitem(last=False)
+            # forget messages outside the window, and ones that failed to get a ticket
+            for entry in list(recent):
+                if now - entry.arrived > self.window or (entry.ticket.done() and entry.ticket.result() is None):
+                    recent.remove(entry)
+            for entry in reversed(recent):
+                if distance(entry.fingerprint, fingerprint) <= self.max_distance:
+                    return entry.ticket, False
+            ticket = Future()
+            recent.append(Recent(fingerprint, now, ticket))
+            return ticket, True
+
+
+    def __len__(self) -> int:
+        return sum(len(recent) for recent in self.senders.values())
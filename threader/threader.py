@@ -28,6 +28,7 @@ def main():
     for name, service in services.items():
         log.info(f"starting synchronize for {name}")
         service.synchronize()
+        service.close()
 
 
 if __name__ == '__main__':
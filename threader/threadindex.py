@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Local, durable index of email Message-IDs to tickets, to thread replies without searching redmine"""
+
+import os
+import re
+import sqlite3
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+THREAD_INDEX_ENV = "THREADER_INDEX_DB" # path of the sqlite database
+DEFAULT_INDEX_DB = "threader-index.db" # in the working directory, so the index is kept across restarts
+# the Message-ID of redmine's notifications: <redmine.issue-123.20240101120000.abc123@example.org>
+REDMINE_ISSUE_ID = re.compile(r"^<redmine\.issue-(\d+)\.")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY,
+    ticket_id INTEGER NOT NULL,
+    processed INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class ThreadIndex():
+    """
+    The ticket of each email, by Message-ID, in a local sqlite database.
+
+    When an email creates or updates a ticket, its Message-ID is saved as
+    processed, along with the ids it replied to and referenced, unless they're
+    already known. A reply is matched to its ticket by its In-Reply-To and
+    References, most recent first, before searching redmine by subject. A
+    reply to one of redmine's own notifications has the ticket id in the
+    notification's Message-ID. Processed Message-IDs are how duplicate
+    deliveries are recognized, across restarts.
+    """
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(SCHEMA)
+
+
+    @classmethod
+    def fromenv(cls) -> "ThreadIndex":
+        """an index at the THREADER_INDEX_DB path, or threader-index.db in the working directory"""
+        path = os.getenv(THREAD_INDEX_ENV) or DEFAULT_INDEX_DB
+        log.info(f"thread index: {path}")
+        return cls(path)
+
+
+    def close(self) -> None:
+        self.db.close()
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+    def add(self, ticket_id: int, message_id: str | None, references: list[str] | None = None) -> None:
+        """an email was added to a ticket: save it as processed, and the emails it references"""
+        with self.lock, self.db:
+            if message_id:
+                self.db.execute(
+                    "INSERT INTO messages (message_id, ticket_id, processed) VALUES (?, ?, 1) "
+                    "ON CONFLICT(message_id) DO UPDATE SET ticket_id = excluded.ticket_id, processed = 1",
+                    (message_id, ticket_id))
+            self.db.executemany("INSERT OR IGNORE INTO messages (message_id, ticket_id) VALUES (?, ?)",
+                                [(reference, ticket_id) for reference in references or []])
+
+
+    def is_processed(self, message_id: str | None) -> bool:
+        if not message_id:
+            return False
+        with self.lock:
+            row = self.db.execute("SELECT processed FROM messages WHERE message_id = ?", (message_id,)).fetchone()
+        return bool(row and row[0])
+
+
+    def lookup(self, references: list[str]) -> int | None:
+        """the ticket of the most recent email referenced, most recent first"""
+        if not references:
+            return None
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT message_id, ticket_id FROM messages WHERE message_id IN ({','.join('?' * len(references))})",
+                references).fetchall()
+        tickets = dict(rows)
+        for reference in references:
+            if reference in tickets:
+                return tickets[reference]
+            match = REDMINE_ISSUE_ID.match(reference)
+            if match:
+                return int(match.group(1))
+        return None
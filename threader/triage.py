@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Header-first triage of IMAP messages: what to do with an email, before downloading it"""
+
+import io
+import base64
+import quopri
+import logging
+import binascii
+import email.policy
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
+from dataclasses import dataclass, field
+
+
+log = logging.getLogger(__name__)
+
+
+FULL_FETCH_MAX_ENV = "IMAP_FULL_FETCH_MAX" # bytes, larger messages are fetched by part
+MAX_ATTACHMENT_ENV = "IMAP_MAX_ATTACHMENT" # bytes, larger attachments are not downloaded
+DEFAULT_FULL_FETCH_MAX = 256 * 1024
+SPOOL_THRESHOLD_ENV = "IMAP_SPOOL_THRESHOLD" # bytes, larger attachments are spooled to a temporary file
+DEFAULT_MAX_ATTACHMENT = 5 * 1024 * 1024 # the redmine default attachment_max_size
+DECODE_CHUNK = 64 * 1024 # bytes of encoded content decoded at a time
+BASE64_LINE = 76 # characters in a line of base64, each followed by CRLF
+
+# everything needed to triage a message, without its body
+HEADER_ITEMS = ["BODY.PEEK[HEADER]", "BODYSTRUCTURE", "RFC822.SIZE"]
+AUTO_REPLY_HEADERS = ["X-Autoreply", "X-Autorespond"]
+
+# a BODYSTRUCTURE that isn't what it should be
+STRUCTURE_ERRORS = (ValueError, TypeError, LookupError, AttributeError)
+
+# why a message is skipped
+BLOCKED = "blocked"
+AUTO_REPLY = "auto-reply"
+DUPLICATE = "duplicate"
+
+
+@dataclass
+class Part():
+    """a leaf part of a message, from its BODYSTRUCTURE"""
+    section: str # IMAP section number: "1", "2.1"
+    content_type: str
+    encoding: str
+    size: int
+    charset: str | None = None
+    filename: str | None = None
+    attachment: bool = False
+
+
+    def is_text(self) -> bool:
+        return not self.attachment and self.content_type in ("text/plain", "text/html")
+
+
+    def decoded_size(self) -> int:
+        """
+        about how big the part is once decoded. size is of the encoded part: base64 is 4
+        characters for every 3 bytes, in lines of 76 and a line break. others are no bigger decoded.
+        """
+        if self.encoding == "base64":
+            return self.size * 3 * BASE64_LINE // (4 * (BASE64_LINE + 2))
+        return self.size
+
+
+    def decode(self, data: bytes) -> bytes:
+        """decode the content transfer encoding of the part"""
+        if self.encoding == "base64":
+            return base64.b64decode(data)
+        if self.encoding == "quoted-printable":
+            return quopri.decodestring(data)
+        return data
+
+
+    def decode_into(self, data: bytes, out) -> None:
+        """decode the content transfer encoding of the part into out, a chunk at a time"""
+        decode_into(self.encoding, data, out)
+
+
+def decode_into(encoding: str, data: bytes, out) -> None:
+    """decode content in a content transfer encoding into out, a chunk at a time"""
+    if encoding == "base64":
+        pending = b""
+        view = memoryview(data)
+        for start in range(0, len(view), DECODE_CHUNK):
+            chunk = pending + bytes(view[start:start + DECODE_CHUNK]).translate(None, b" \t\r\n")
+            whole = len(chunk) - len(chunk) % 4 # base64 decodes in 4 character groups
+            out.write(binascii.a2b_base64(chunk[:whole]))
+            pending = chunk[whole:]
+        if pending:
+            out.write(binascii.a2b_base64(pending + b"=" * (-len(pending) % 4))) # missing padding
+    elif encoding == "quoted-printable":
+        quopri.decode(io.BytesIO(data), out)
+    else:
+        out.write(data)
+
+
+@dataclass
+class Triage():
+    """what's known about a message from its headers and structure"""
+    uid: int
+    headers: EmailMessage
+    size: int
+    parts: list[Part] = field(default_factory=list)
+    skip: str | None = None # why the message is skipped, if it is
+
+
+    @property
+    def message_id(self) -> str | None:
+        return self.headers.get("Message-ID")
+
+
+    @property
+    def from_address(self) -> str:
+        return self.headers.get("From", "")
+
+
+    def full_fetch(self, max_size: int) -> bool:
+        """fetch the whole message, if it's small or its structure is unknown"""
+        return self.size <= max_size or not self.parts
+
+
+    def wanted_parts(self, max_attachment: int) -> list[Part]:
+        """the text parts, and the attachments that aren't too big to upload. inline parts are ignored, as in a full fetch."""
+        wanted = []
+        for part in self.parts:
+            if part.is_text():
+                wanted.append(part)
+            elif part.attachment:
+                # the limit is on the decoded size, as when the whole message is fetched
+                if part.decoded_size() <= max_attachment:
+                    wanted.append(part)
+                else:
+                    log.info(f"Skipping attachment {part.filename} of message {self.uid}, about {part.decoded_size()} bytes")
+        return wanted
+
+
+def parse_headers(data: bytes) -> EmailMessage:
+    return BytesHeaderParser(policy=email.policy.default).parsebytes(data)
+
+
+def is_auto_reply(headers: EmailMessage) -> bool:
+    """an out-of-office or other automatic reply, RFC 3834 or the common vendor headers"""
+    auto_submitted = headers.get("Auto-Submitted")
+    if auto_submitted and auto_submitted.strip().lower() != "no":
+        return True
+    if any(headers.get(name) for name in AUTO_REPLY_HEADERS):
+        return True
+    return (headers.get("Precedence") or "").strip().lower() == "auto_reply"
+
+
+def decode_str(value) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+def param_dict(params) -> dict[str, str]:
+    """a BODYSTRUCTURE parameter list, (name, value, name, value...), as a dict with lowercase names"""
+    if not params:
+        return {}
+    items = [decode_str(item) for item in params]
+    return {items[i].lower(): items[i + 1] for i in range(0, len(items) - 1, 2)}
+
+
+def parse_bodystructure(structure, prefix: str = "") -> list[Part]:
+    """the leaf parts of a BODYSTRUCTURE, as parsed by IMAPClient"""
+    if structure.is_multipart:
+        parts = []
+        for i, child in enumerate(structure[0], start=1):
+            parts.extend(parse_bodystructure(child, f"{prefix}{i}."))
+        return parts
+
+    main_type = decode_str(structure[0]).lower()
+    sub_type = decode_str(structure[1]).lower()
+    params = param_dict(structure[2])
+    # extension data, from md5, follows the line count of text parts, and the envelope, body and lines of messages
+    if main_type == "text":
+        md5 = 8
+    elif (main_type, sub_type) == ("message", "rfc822"):
+        md5 = 10
+    else:
+        md5 = 7
+    disposition = structure[md5 + 1] if len(structure) > md5 + 1 else None
+    disposition_type = ""
+    if disposition:
+        disposition_type = decode_str(disposition[0]).lower()
+        params.update(param_dict(disposition[1]))
+    filename = params.get("filename") or params.get("name")
+
+    return [Part(
+        section=prefix.rstrip(".") or "1",
+        content_type=f"{main_type}/{sub_type}",
+        encoding=(decode_str(structure[5]) or "7bit").lower(),
+        size=int(structure[6] or 0),
+        charset=params.get("charset"),
+        filename=filename,
+        attachment=disposition_type == "attachment",
+    )]
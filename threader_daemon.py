@@ -84,6 +84,7 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 from threader.imap import Client
 from redaction_queue import RedactionQueue
+from redmine import accounting, metrics
 
 logging.basicConfig(
     level=logging.INFO,
@@ -91,6 +92,9 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+POLL_SECONDS = 60 # longest wait between checks of the edit queue, and between IMAP polls without IDLE
+QUEUE_DEPTH = metrics.gauge("threader_redaction_queue_depth", "Pending jobs in the redaction queue")
+
 shutdown_requested = False
 
 def signal_handler(sig, frame):
@@ -111,9 +115,13 @@ async def main():
     # Load environment variables
     load_dotenv()
     
+    # Optional prometheus endpoint, on METRICS_PORT
+    metrics.MetricsServer.fromenv()
+    
     # Create client and queue manager
     client = Client()
     queue = RedactionQueue()
+    QUEUE_DEPTH.set_function(queue.pending_count)
     
     while not shutdown_requested:
         try:
@@ -126,7 +134,8 @@ async def main():
                 
                 try:
                     # Process the edit job
-                    client.process_edit_job(edit_job)
+                    with accounting.operation("edit_job"):
+                        client.process_edit_job(edit_job)
                     queue.mark_complete(edit_job['id'])
                     log.info(f"Completed edit job: {edit_job['id']}")
                 except Exception as e:
@@ -139,15 +148,17 @@ async def main():
             # No edit jobs, check IMAP
             log.info("Checking IMAP for new messages...")
             processed_count = client.synchronize()
+            accounting.write_metrics()
             
             if processed_count > 0:
                 log.info(f"Processed {processed_count} email(s)")
                 # Immediately check for next job
                 continue
             else:
-                # No work to do - wait 60 seconds
-                log.info("No pending jobs. Waiting 60 seconds before next check...")
-                await asyncio.sleep(60)
+                # No work to do - wait for new mail, and check the queue at least every POLL_SECONDS
+                log.info(f"No pending jobs. Waiting up to {POLL_SECONDS} seconds for new mail...")
+                if await asyncio.to_thread(client.wait_for_mail, POLL_SECONDS):
+                    log.info("New mail")
                 
         except KeyboardInterrupt:
             log.info("Keyboard interrupt received")
@@ -156,6 +167,7 @@ async def main():
             log.error(f"Error in main loop: {e}", exc_info=True)
             await asyncio.sleep(60)
     
+    client.close()
     log.info("Threader Daemon stopped")
 
 if __name__ == "__main__":